@@ -1,4 +1,8 @@
+import io
+import math
+import os
 import pickle
+from collections.abc import Mapping
 
 import torch
 import torch.distributed as dist
@@ -30,6 +34,70 @@ def reduce_tensor(tensor):
     return tensor
 
 
+class ReducedDict(Mapping):
+    """
+    Result of reduce_dict, a read-only dict whose values are the reduced 0-dim tensors.
+    The reduction is waited for on first access, so that it overlaps with whatever runs in between.
+    """
+
+    def __init__(self, keys, bucket, work=None, divisor=1):
+        self._keys = keys
+        self._bucket = bucket
+        self._work = work
+        self._divisor = divisor
+        self._values = None
+
+    def wait(self):
+        """
+        Returns:
+            dict: the reduced values
+        """
+        if self._values is None:
+            if self._work is not None:
+                self._work.wait()
+                self._work = None
+            if self._divisor != 1:
+                self._bucket /= self._divisor
+            self._values = dict(zip(self._keys, self._bucket.unbind(0)))
+        return self._values
+
+    def __getitem__(self, key):
+        return self.wait()[key]
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+
+def reduce_dict(metrics, average=True, async_op=True):
+    """
+    Sum or average scalar metrics over all processes with a single all_reduce of one flat bucket,
+    instead of one collective per metric.
+    Args:
+        metrics: dict of scalars, 0-dim (or single element) tensors or numbers
+        average: divide the sums by the world size
+        async_op: return before the reduction completes, it is waited for when a value is read
+    Returns:
+        ReducedDict: dict-like, same keys (in the same order on all processes), 0-dim float tensors
+    """
+    keys = list(metrics.keys())
+    world_size = get_world_size()
+    with torch.no_grad():
+        if world_size > 1:
+            device = _collective_device()
+        else:
+            device = next((v.device for v in metrics.values() if isinstance(v, torch.Tensor)), torch.device('cpu'))
+        values = [v.detach().reshape(()).float() if isinstance(v, torch.Tensor) else torch.tensor(float(v))
+                  for v in metrics.values()]
+        bucket = torch.stack([v.to(device) for v in values]) if len(values) > 0 else torch.zeros((0,))
+        if world_size == 1 or len(values) == 0:
+            return ReducedDict(keys, bucket)
+        work = dist.all_reduce(bucket, async_op=async_op)
+    return ReducedDict(keys, bucket, work, world_size if average else 1)
+
+
 def get_world_size():
     if not dist.is_available():
         return 1
@@ -65,6 +133,15 @@ def synchronize():
     dist.barrier()
 
 
+def _collective_device():
+    """
+    Device of the tensors passed to collectives: the current cuda device for nccl, cpu for gloo and mpi.
+    """
+    if dist.get_backend() == dist.Backend.NCCL:
+        return torch.device('cuda', torch.cuda.current_device())
+    return torch.device('cpu')
+
+
 def all_gather(data):
     """
     Run all_gather on arbitrary picklable data (not necessarily tensors)
@@ -80,11 +157,12 @@ def all_gather(data):
     # serialized to a Tensor
     buffer = pickle.dumps(data)
     storage = torch.ByteStorage.from_buffer(buffer)
-    tensor = torch.ByteTensor(storage).to("cuda")
+    device = _collective_device()
+    tensor = torch.ByteTensor(storage).to(device)
 
     # obtain Tensor size of each rank
-    local_size = torch.IntTensor([tensor.numel()]).to("cuda")
-    size_list = [torch.IntTensor([0]).to("cuda") for _ in range(world_size)]
+    local_size = torch.IntTensor([tensor.numel()]).to(device)
+    size_list = [torch.IntTensor([0]).to(device) for _ in range(world_size)]
     dist.all_gather(size_list, local_size)
     size_list = [int(size.item()) for size in size_list]
     max_size = max(size_list)
@@ -94,9 +172,9 @@ def all_gather(data):
     # gathering tensors of different shapes
     tensor_list = []
     for _ in size_list:
-        tensor_list.append(torch.ByteTensor(size=(max_size,)).to("cuda"))
+        tensor_list.append(torch.ByteTensor(size=(max_size,)).to(device))
     if local_size != max_size:
-        padding = torch.ByteTensor(size=(max_size - local_size,)).to("cuda")
+        padding = torch.ByteTensor(size=(max_size - local_size,)).to(device)
         tensor = torch.cat((tensor, padding), dim=0)
     dist.all_gather(tensor_list, tensor)
 
@@ -106,3 +184,157 @@ def all_gather(data):
         data_list.append(pickle.loads(buffer))
 
     return data_list
+
+
+def all_gather_tensors(tensor, buffer_size=None, out_device=None):
+    """
+    all_gather for tensors, without serialization. The first dimension may differ between ranks,
+    the other dimensions and the dtype must be the same.
+    Args:
+        tensor: tensor of this rank
+        buffer_size: if given, gather at most about buffer_size bytes from all ranks at once,
+            so that the collective buffers stay bounded for large tensors
+        out_device: device of the results, default the device of tensor
+    Returns:
+        list[Tensor]: tensors gathered from each rank
+    """
+    world_size = get_world_size()
+    if world_size == 1:
+        return [tensor if out_device is None else tensor.to(out_device)]
+    out_device = tensor.device if out_device is None else torch.device(out_device)
+    device = _collective_device()
+
+    # one size exchange for all rounds
+    local_size = torch.tensor([tensor.shape[0]], dtype=torch.int64, device=device)
+    size_list = [torch.zeros_like(local_size) for _ in range(world_size)]
+    dist.all_gather(size_list, local_size)
+    size_list = [int(size.item()) for size in size_list]
+    max_size = max(size_list)
+
+    row_bytes = max(math.prod(tensor.shape[1:]), 1) * tensor.element_size()
+    rows = max(max_size, 1) if buffer_size is None else max(1, buffer_size // (row_bytes * world_size))
+    pieces = [[] for _ in range(world_size)]
+    for begin in range(0, max_size, rows):
+        # pad the chunk of each rank to the same number of rows
+        chunk = tensor[begin:begin + rows].to(device)
+        padded = chunk.new_zeros((min(rows, max_size - begin),) + tuple(tensor.shape[1:]))
+        padded[:chunk.shape[0]] = chunk
+        chunk_list = [torch.empty_like(padded) for _ in range(world_size)]
+        dist.all_gather(chunk_list, padded)
+        for i, (size, chunk) in enumerate(zip(size_list, chunk_list)):
+            if size > begin:
+                pieces[i].append(chunk[:size - begin].to(out_device))
+    return [torch.cat(p, dim=0) if len(p) > 0 else tensor.new_zeros((0,) + tuple(tensor.shape[1:]),
+                                                                     device=out_device)
+            for p in pieces]
+
+
+def _send_samples(data, dst, chunk_bytes, device):
+    # samples are pickled one by one and sent in messages of about chunk_bytes, a size of 0 ends the stream
+    def send(payload):
+        dist.send(torch.tensor([len(payload)], dtype=torch.int64, device=device), dst)
+        dist.send(torch.frombuffer(bytearray(payload), dtype=torch.uint8).to(device), dst)
+
+    pending, size = [], 0
+    for sample in data:
+        pending.append(pickle.dumps(sample, protocol=pickle.HIGHEST_PROTOCOL))
+        size += len(pending[-1])
+        if size >= chunk_bytes:
+            send(b''.join(pending))
+            pending, size = [], 0
+    if pending:
+        send(b''.join(pending))
+    dist.send(torch.zeros((1,), dtype=torch.int64, device=device), dst)
+
+
+def _recv_samples(src, device):
+    size = torch.zeros((1,), dtype=torch.int64, device=device)
+    while True:
+        dist.recv(size, src)
+        n = int(size.item())
+        if n == 0:
+            return
+        payload = torch.empty((n,), dtype=torch.uint8, device=device)
+        dist.recv(payload, src)
+        f = io.BytesIO(payload.cpu().numpy().tobytes())
+        while f.tell() < n:
+            yield pickle.load(f)
+
+
+def gather_to_main(data, dataset_size=None, chunk_bytes=64 << 20):
+    """
+    Gather per-sample results to the main process, streamed rank by rank in messages of bounded size
+    so that, unlike all_gather, no process other than the main one holds the results of other ranks.
+    The results of the ranks are concatenated in rank order, which is the dataset order for
+    OrderedDistributedSampler, and truncated to dataset_size to drop the samples it repeats as padding.
+    Args:
+        data: list of picklable per-sample results of this rank, in the order of its sampler
+        dataset_size: length of the dataset, None to keep the padding
+        chunk_bytes: approximate size of a message
+    Returns:
+        list: results of all samples on the main process, None on the other processes
+    """
+    world_size = get_world_size()
+    if world_size == 1:
+        return list(data)[:dataset_size]
+    device = _collective_device()
+    if get_rank() != 0:
+        _send_samples(data, 0, chunk_bytes, device)
+        return None
+    results = list(data)
+    for src in range(1, world_size):
+        results.extend(_recv_samples(src, device))
+    return results[:dataset_size]
+
+
+def gather_to_file(data, path, dataset_size=None):
+    """
+    Like gather_to_main, but through the file system: every rank writes its results to a shard file
+    next to path (which must be on a file system shared by all processes), then the main process merges
+    the shards in rank order into path one sample at a time, so that memory stays bounded by one sample.
+    Read the result with load_gathered.
+    Args:
+        data: iterable of picklable per-sample results of this rank, in the order of its sampler
+        path: output file
+        dataset_size: length of the dataset, None to keep the padding of OrderedDistributedSampler
+    Returns:
+        str: path, once the file is complete on all processes
+    """
+    world_size = get_world_size()
+    rank = get_rank()
+    shard = f'{path}.rank{rank}' if world_size > 1 else path
+    with open(shard, 'wb') as f:
+        for sample in data:
+            pickle.dump(sample, f, protocol=pickle.HIGHEST_PROTOCOL)
+    if world_size == 1 and dataset_size is None:
+        return path
+    synchronize()
+    if rank == 0:
+        shards = [f'{path}.rank{i}' for i in range(world_size)] if world_size > 1 else [path]
+        tmp = path + '.tmp'
+        count = 0
+        with open(tmp, 'wb') as out:
+            for shard in shards:
+                for sample in load_gathered(shard):
+                    if dataset_size is not None and count >= dataset_size:
+                        break
+                    pickle.dump(sample, out, protocol=pickle.HIGHEST_PROTOCOL)
+                    count += 1
+        os.replace(tmp, path)
+        if world_size > 1:
+            for shard in shards:
+                os.remove(shard)
+    synchronize()
+    return path
+
+
+def load_gathered(path):
+    """
+    Iterate over the samples of a file written by gather_to_file, without loading them all.
+    """
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
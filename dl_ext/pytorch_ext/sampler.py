@@ -23,7 +23,6 @@ class OrderedDistributedSampler(Sampler):
     """
 
     def __init__(self, dataset, num_replicas=None, rank=None):
-        super().__init__(dataset)
         if num_replicas is None:
             if not dist.is_available():
                 raise RuntimeError("Requires distributed package to be available")
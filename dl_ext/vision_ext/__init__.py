@@ -1,5 +1,8 @@
-from .project import project
+from .project import project, project_batch
 from .conv import conv_size_out
 from .transforms import imagenet_normalize, imagnet_revert_normalize
+from .voxel import voxelize, bev_maps
+from .rotation import euler_xyz_to_matrix, axis_angle_to_matrix, quaternion_to_matrix, rotation_6d_to_matrix, \
+    compose_pose
 # from .datasets import *
 # from .models import *
@@ -0,0 +1,446 @@
+"""
+KITTI 3D object detection evaluation, following the official devkit (evaluate_object.cpp):
+2D bbox, bird's eye view and 3D AP plus AOS, at easy, moderate and hard difficulties,
+with 40 (default, as on the leaderboard) or 11 recall positions.
+Overlaps are computed as vectorized matrices per frame and frames are processed in a process pool.
+Example:
+    >>> results = evaluate(KITTIROOT, 'training', 'output/data', imgids=val_ids)
+    >>> print(format_results(results))
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Sequence, Union
+
+import numpy as np
+
+from .io._label import _parse_label_text, _empty_label_arrays
+from .io._packed import PackedSplit
+from .io.label_2 import load_labels_2_arrays
+from .structures.box3d import box2d_iou, bev_iou, box3d_iou, boxes3d_from_arrays, boxes3d_to_bev
+from .structures.kitti_object_3d import KITTIObjectClass
+
+MIN_HEIGHT = (40, 25, 25)
+MAX_OCCLUSION = (0, 1, 2)
+MAX_TRUNCATION = (0.15, 0.3, 0.5)
+DIFFICULTIES = ('easy', 'moderate', 'hard')
+METRICS = ('bbox', 'bev', '3d', 'aos')
+NUM_SAMPLE_POINTS = 41
+
+# classes whose ground truth is neither counted nor penalized when evaluating a class
+NEIGHBOR_CLASSES = {KITTIObjectClass.Car: KITTIObjectClass.Van,
+                    KITTIObjectClass.Pedestrian: KITTIObjectClass.Person_sitting}
+
+DEFAULT_MIN_OVERLAPS = {
+    'bbox': {'Car': 0.7, 'Pedestrian': 0.5, 'Cyclist': 0.5, 'Van': 0.7, 'Person_sitting': 0.5, 'Truck': 0.7,
+             'Tram': 0.7},
+    'bev': {'Car': 0.7, 'Pedestrian': 0.5, 'Cyclist': 0.5, 'Van': 0.7, 'Person_sitting': 0.5, 'Truck': 0.7,
+            'Tram': 0.7},
+    '3d': {'Car': 0.7, 'Pedestrian': 0.5, 'Cyclist': 0.5, 'Van': 0.7, 'Person_sitting': 0.5, 'Truck': 0.7,
+           'Tram': 0.7},
+}
+
+
+def get_difficulty(arrays):
+    """
+    :param arrays: columnar labels, see load_label_2_arrays
+    :return: (N,) int8, 0 easy, 1 moderate, 2 hard, -1 for objects beyond hard
+    """
+    height = arrays['box2d'][:, 3] - arrays['box2d'][:, 1]
+    difficulty = np.full((height.shape[0],), -1, dtype=np.int8)
+    for d in reversed(range(len(DIFFICULTIES))):
+        ok = ((height > MIN_HEIGHT[d]) & (arrays['occluded'] <= MAX_OCCLUSION[d]) &
+              (arrays['truncated'] <= MAX_TRUNCATION[d]))
+        difficulty[ok] = d
+    return difficulty
+
+
+def _clean_data(gt, dt, cls, difficulty):
+    """
+    :return: ignored_gt (N,) in {-1: other class, 0: valid, 1: ignored},
+             ignored_dt (M,) in {-1: other class, 0: valid, 1: too small}, number of valid gt
+    """
+    height = gt['box2d'][:, 3] - gt['box2d'][:, 1]
+    ignore = ((gt['occluded'] > MAX_OCCLUSION[difficulty]) | (gt['truncated'] > MAX_TRUNCATION[difficulty]) |
+              (height <= MIN_HEIGHT[difficulty]))
+    same = gt['cls'] == cls
+    neighbor = gt['cls'] == NEIGHBOR_CLASSES.get(cls, -1)
+    ignored_gt = np.full((gt['cls'].shape[0],), -1, dtype=np.int8)
+    ignored_gt[neighbor | (same & ignore)] = 1
+    ignored_gt[same & ~ignore] = 0
+
+    dt_height = np.abs(dt['box2d'][:, 3] - dt['box2d'][:, 1])
+    ignored_dt = np.where(dt['cls'] == cls, 0, -1).astype(np.int8)
+    ignored_dt[dt_height < MIN_HEIGHT[difficulty]] = 1
+    return ignored_gt, ignored_dt, int((ignored_gt == 0).sum())
+
+
+def _match(overlaps, candidates, scores, ignored_gt, ignored_dt, active, compute_fp):
+    """
+    Greedy assignment of detections to ground truth, as computeStatistics of the devkit.
+    :param overlaps: (M, N) list of lists
+    :param candidates: per gt, detections of the class with overlap > min_overlap, in detection order
+    :param scores: per detection
+    :param active: per detection, False for detections under the score threshold
+    :return: tp detection index per gt (-1 if none), assigned flag per detection, fn
+    """
+    assigned = [False] * len(ignored_dt)
+    matched = [-1] * len(ignored_gt)
+    fn = 0
+    for i, cands in enumerate(candidates):
+        if ignored_gt[i] == -1:
+            continue
+        det_idx = -1
+        max_overlap = 0
+        found = False
+        assigned_ignored_det = False
+        for j in cands:
+            if assigned[j] or not active[j]:
+                continue
+            overlap = overlaps[j][i]
+            if not compute_fp:
+                if not found or scores[j] > scores[det_idx]:
+                    det_idx = j
+                    found = True
+            elif ignored_dt[j] == 0 and (overlap > max_overlap or assigned_ignored_det):
+                max_overlap = overlap
+                det_idx = j
+                found = True
+                assigned_ignored_det = False
+            elif not found and ignored_dt[j] == 1:
+                det_idx = j
+                found = True
+                assigned_ignored_det = True
+        if not found:
+            if ignored_gt[i] == 0:
+                fn += 1
+        elif ignored_gt[i] == 1 or ignored_dt[det_idx] == 1:
+            assigned[det_idx] = True
+        else:
+            matched[i] = det_idx
+            assigned[det_idx] = True
+    return matched, assigned, fn
+
+
+def _candidates(overlaps, ignored_gt, ignored_dt, min_overlap):
+    """
+    :return: per gt, detections of the class with overlap > min_overlap, empty for gt of other classes
+    """
+    candidate_mask = (overlaps > min_overlap) & (ignored_dt != -1)[:, None]
+    return [np.nonzero(candidate_mask[:, i])[0].tolist() if ignored_gt[i] != -1 else []
+            for i in range(len(ignored_gt))]
+
+
+def _frame_tp_scores(overlaps, dt, ignored_gt, ignored_dt, min_overlap):
+    """
+    First pass of the devkit: scores of the detections matched to valid ground truth without score threshold,
+    the thresholds of the precision recall curve are chosen among them.
+    """
+    if not (ignored_dt != -1).any():
+        return np.zeros((0,), dtype=dt['score'].dtype)
+    matched, _, _ = _match(overlaps.tolist(), _candidates(overlaps, ignored_gt, ignored_dt, min_overlap),
+                           dt['score'].tolist(), ignored_gt.tolist(), ignored_dt.tolist(),
+                           [True] * len(ignored_dt), compute_fp=False)
+    return dt['score'][[j for j in matched if j >= 0]]
+
+
+def _match_thresholds(overlaps, candidates, ignored_gt, ignored_dt, active):
+    """
+    _match with compute_fp for all thresholds at once, the loop over ground truth runs on (T, ...) arrays.
+    Among the unassigned active candidates of a gt, the devkit keeps the valid detection of largest overlap
+    (the first one on ties), else the first ignored detection.
+    :param active: (T, M) per threshold, detections scored above it
+    :return: (T, N) tp detection index per gt (-1 if none), (T, M) assigned, (T,) fn
+    """
+    T = active.shape[0]
+    rows = np.arange(T)
+    assigned = np.zeros(active.shape, dtype=bool)
+    matched = np.full((T, len(ignored_gt)), -1, dtype=np.int64)
+    fn = np.zeros((T,), dtype=np.int64)
+    for i, cands in enumerate(candidates):
+        if ignored_gt[i] == -1:
+            continue
+        if len(cands) == 0:
+            fn += ignored_gt[i] == 0
+            continue
+        cands = np.asarray(cands)
+        available = active[:, cands] & ~assigned[:, cands]
+        valid = available & (ignored_dt[cands] == 0)
+        ignored = available & (ignored_dt[cands] == 1)
+        best = np.argmax(np.where(valid, overlaps[cands, i], -np.inf), axis=1)
+        det = np.where(valid.any(axis=1), cands[best],
+                       np.where(ignored.any(axis=1), cands[np.argmax(ignored, axis=1)], -1))
+        found = det >= 0
+        if ignored_gt[i] == 0:
+            fn += ~found
+        assigned[rows[found], det[found]] = True
+        if ignored_gt[i] == 0:
+            tp = found & (ignored_dt[np.maximum(det, 0)] == 0)
+            matched[tp, i] = det[tp]
+    return matched, assigned, fn
+
+
+def _frame_statistics(overlaps, dc_overlaps, gt, dt, ignored_gt, ignored_dt, min_overlap, thresholds,
+                      compute_aos):
+    """
+    Second pass of the devkit: statistics of one frame for one class, difficulty and metric.
+    :return: (T, 4) tp, fp, fn, similarity when only detections scored at least thresholds[t] are kept
+    """
+    stats = np.zeros((len(thresholds), 4), dtype=np.float64)
+    stats[:, 2] = (ignored_gt == 0).sum()
+    if len(thresholds) == 0 or not (ignored_dt != -1).any():
+        return stats
+    candidates = _candidates(overlaps, ignored_gt, ignored_dt, min_overlap)
+    active = dt['score'][None] >= np.asarray(thresholds)[:, None]
+    matched, assigned, fn = _match_thresholds(overlaps, candidates, ignored_gt, ignored_dt, active)
+    unassigned = active & (ignored_dt == 0) & ~assigned
+    if dc_overlaps.shape[1] > 0:
+        # as computeStatistics of evaluate_object.cpp for every metric (the python port of second.pytorch
+        # only does it for bbox): false positives overlapping a DontCare box in 2D are not counted
+        unassigned &= ~(dc_overlaps.max(axis=1) > min_overlap)
+    tp = matched >= 0
+    stats[:, 0] = tp.sum(axis=1)
+    stats[:, 1] = unassigned.sum(axis=1)
+    stats[:, 2] = fn
+    if compute_aos:
+        delta = gt['alpha'][None].astype(np.float64) - dt['alpha'][np.maximum(matched, 0)]
+        similarity = np.where(tp, (1.0 + np.cos(delta)) / 2.0, 0).sum(axis=1)
+        # the devkit's similarity is -1 without tp and fp and is then left out of the sum
+        stats[:, 3] = np.where((stats[:, 0] > 0) | (stats[:, 1] > 0), similarity, 0)
+    return stats
+
+
+def _frame_overlaps(gt, dt, metric):
+    if metric == 'bbox':
+        return box2d_iou(dt['box2d'].astype(np.float64), gt['box2d'].astype(np.float64))
+    boxes_dt = boxes3d_from_arrays(dt).astype(np.float64)
+    boxes_gt = boxes3d_from_arrays(gt).astype(np.float64)
+    if metric == 'bev':
+        return bev_iou(boxes3d_to_bev(boxes_dt), boxes3d_to_bev(boxes_gt))
+    return box3d_iou(boxes_dt, boxes_gt)
+
+
+def _frames_overlaps(gt_annos, dt_annos, metrics):
+    """
+    :return: per frame {metric: (M, N) overlaps, 'dontcare': (M, D) 2D intersection over detection area
+             with DontCare boxes, used by every metric}
+    """
+    frames = []
+    for gt, dt in zip(gt_annos, dt_annos):
+        dc = gt['cls'] == KITTIObjectClass.DontCare
+        overlaps = {m: _frame_overlaps(gt, dt, m) for m in metrics}
+        overlaps['dontcare'] = box2d_iou(dt['box2d'].astype(np.float64), gt['box2d'][dc].astype(np.float64),
+                                         criterion=0)
+        frames.append(overlaps)
+    return frames
+
+
+def _iterate_frames(gt_annos, dt_annos, frames_overlaps, classes, metrics, min_overlaps):
+    for gt, dt, overlaps in zip(gt_annos, dt_annos, frames_overlaps):
+        for cls in classes:
+            for difficulty in range(len(DIFFICULTIES)):
+                ignored_gt, ignored_dt, num_valid_gt = _clean_data(gt, dt, cls, difficulty)
+                for metric in metrics:
+                    min_overlap = min_overlaps[metric][KITTIObjectClass(cls).name]
+                    yield ((cls, difficulty, metric), gt, dt, overlaps[metric], overlaps['dontcare'],
+                           ignored_gt, ignored_dt, num_valid_gt, min_overlap)
+
+
+def _frames_tp_scores(gt_annos, dt_annos, classes, metrics, min_overlaps):
+    """
+    Worker of the first pass of evaluate_arrays.
+    :return: {(class, difficulty, metric): (number of valid gt, tp scores)} of a chunk of frames,
+             overlaps of the frames, reused by the second pass
+    """
+    frames_overlaps = _frames_overlaps(gt_annos, dt_annos, metrics)
+    results = {}
+    for key, gt, dt, overlaps, _, ignored_gt, ignored_dt, num_valid_gt, min_overlap in \
+            _iterate_frames(gt_annos, dt_annos, frames_overlaps, classes, metrics, min_overlaps):
+        num_gt, scores = results.setdefault(key, (0, []))
+        scores.append(_frame_tp_scores(overlaps, dt, ignored_gt, ignored_dt, min_overlap))
+        results[key] = (num_gt + num_valid_gt, scores)
+    return {k: (n, np.concatenate(scores)) for k, (n, scores) in results.items()}, frames_overlaps
+
+
+def _frames_statistics(gt_annos, dt_annos, frames_overlaps, classes, metrics, min_overlaps, thresholds):
+    """
+    Worker of the second pass of evaluate_arrays, {(class, difficulty, metric): (T, 4) statistics}
+    summed over a chunk of frames.
+    """
+    results = {}
+    for key, gt, dt, overlaps, dc_overlaps, ignored_gt, ignored_dt, _, min_overlap in \
+            _iterate_frames(gt_annos, dt_annos, frames_overlaps, classes, metrics, min_overlaps):
+        stats = _frame_statistics(overlaps, dc_overlaps, gt, dt, ignored_gt, ignored_dt, min_overlap,
+                                  thresholds[key], compute_aos=key[2] == 'bbox')
+        results[key] = results[key] + stats if key in results else stats
+    return results
+
+
+def _get_thresholds(scores, num_gt, num_sample_points=NUM_SAMPLE_POINTS):
+    scores = np.sort(scores)[::-1]
+    current_recall = 0
+    thresholds = []
+    for i, score in enumerate(scores):
+        l_recall = (i + 1) / num_gt
+        if i < (len(scores) - 1):
+            r_recall = (i + 2) / num_gt
+        else:
+            r_recall = l_recall
+        if ((r_recall - current_recall) < (current_recall - l_recall)) and (i < (len(scores) - 1)):
+            continue
+        thresholds.append(score)
+        current_recall += 1 / (num_sample_points - 1.0)
+    return np.array(thresholds)
+
+
+def _curve_thresholds(tp_scores):
+    """
+    :param tp_scores: {key: (number of valid gt, tp scores of all frames)}
+    """
+    return {k: _get_thresholds(scores, n) if n > 0 else np.zeros((0,)) for k, (n, scores) in tp_scores.items()}
+
+
+def _average_precision(pr, num_recall_points):
+    """
+    :param pr: (T, 4) tp, fp, fn, similarity summed over frames at each threshold
+    :return: AP and AOS in percent
+    """
+    precision = np.zeros((NUM_SAMPLE_POINTS,))
+    aos = np.zeros((NUM_SAMPLE_POINTS,))
+    precision[:len(pr)] = pr[:, 0] / (pr[:, 0] + pr[:, 1])
+    aos[:len(pr)] = pr[:, 3] / (pr[:, 0] + pr[:, 1])
+    precision = np.maximum.accumulate(precision[::-1])[::-1]
+    aos = np.maximum.accumulate(aos[::-1])[::-1]
+    if num_recall_points == 40:
+        return precision[1:].sum() / 40 * 100, aos[1:].sum() / 40 * 100
+    elif num_recall_points == 11:
+        return precision[::4].sum() / 11 * 100, aos[::4].sum() / 11 * 100
+    raise ValueError(f'expect num_recall_points in [11, 40], but found {num_recall_points}')
+
+
+def _chunks(n, num_chunks):
+    bounds = np.linspace(0, n, num_chunks + 1).astype(int)
+    return [(b, e) for b, e in zip(bounds[:-1], bounds[1:]) if e > b]
+
+
+def evaluate_arrays(gt_annos: Sequence[dict], dt_annos: Sequence[dict],
+                    classes=('Car', 'Pedestrian', 'Cyclist'), metrics=METRICS, min_overlaps=None,
+                    num_recall_points=40, num_workers=None):
+    """
+    :param gt_annos: per frame ground truth, columnar labels as returned by load_label_2_arrays
+    :param dt_annos: per frame detections, columnar labels with a score column
+    :param classes: class names or KITTIObjectClass
+    :param metrics: subset of bbox, bev, 3d, aos
+    :param min_overlaps: {metric: {class name: min overlap}}, default DEFAULT_MIN_OVERLAPS
+    :param num_recall_points: 40 or 11
+    :param num_workers: processes, default os.cpu_count(), 0 to run in the calling process
+    :return: {class name: {metric: (3,) AP of easy, moderate, hard}}
+    """
+    assert len(gt_annos) == len(dt_annos)
+    for m in metrics:
+        if m not in METRICS:
+            raise ValueError(f'expect metric in {METRICS}, but found {m}')
+    classes = [KITTIObjectClass[c] if isinstance(c, str) else KITTIObjectClass(c) for c in classes]
+    min_overlaps = min_overlaps if min_overlaps is not None else DEFAULT_MIN_OVERLAPS
+    stat_metrics = [m for m in ('bbox', 'bev', '3d') if m in metrics or (m == 'bbox' and 'aos' in metrics)]
+    if num_recall_points not in (11, 40):
+        raise ValueError(f'expect num_recall_points in [11, 40], but found {num_recall_points}')
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    args = (classes, stat_metrics, min_overlaps)
+    # two passes as in the devkit: tp scores of all frames give the thresholds (at most 41 per curve),
+    # then the statistics of every frame are computed at these thresholds only
+    if num_workers == 0 or len(gt_annos) < 2 * num_workers:
+        tp_scores, frames_overlaps = _frames_tp_scores(gt_annos, dt_annos, *args)
+        stats = _frames_statistics(gt_annos, dt_annos, frames_overlaps, *args, _curve_thresholds(tp_scores))
+    else:
+        chunks = _chunks(len(gt_annos), num_workers * 4)
+        with ProcessPoolExecutor(num_workers) as executor:
+            tp_scores, chunks_overlaps = {}, []
+            for f in [executor.submit(_frames_tp_scores, gt_annos[b:e], dt_annos[b:e], *args) for b, e in chunks]:
+                chunk_scores, frames_overlaps = f.result()
+                chunks_overlaps.append(frames_overlaps)
+                for k, (n, scores) in chunk_scores.items():
+                    tp_scores.setdefault(k, []).append((n, scores))
+            tp_scores = {k: (sum(n for n, _ in v), np.concatenate([s for _, s in v])) for k, v in tp_scores.items()}
+            thresholds = _curve_thresholds(tp_scores)
+            stats = {}
+            for f in [executor.submit(_frames_statistics, gt_annos[b:e], dt_annos[b:e], frames_overlaps, *args,
+                                      thresholds) for (b, e), frames_overlaps in zip(chunks, chunks_overlaps)]:
+                for k, v in f.result().items():
+                    stats[k] = stats[k] + v if k in stats else v
+    aps = {}
+    for cls in classes:
+        aps[cls.name] = {m: np.zeros((len(DIFFICULTIES),)) for m in metrics}
+        for difficulty in range(len(DIFFICULTIES)):
+            for metric in stat_metrics:
+                key = (cls, difficulty, metric)
+                if key not in tp_scores or tp_scores[key][0] == 0:
+                    continue
+                ap, aos = _average_precision(stats[key], num_recall_points)
+                if metric in metrics:
+                    aps[cls.name][metric][difficulty] = ap
+                if metric == 'bbox' and 'aos' in metrics:
+                    aps[cls.name]['aos'][difficulty] = aos
+    return aps
+
+
+def _split_frames(arrays, offsets):
+    return [{k: v[b:e] for k, v in arrays.items()} for b, e in zip(offsets[:-1], offsets[1:])]
+
+
+def load_predictions(pred_dir: str, imgids: Sequence[Union[str, int]]):
+    """
+    Load detections in kitti format, {pred_dir}/{imgid}.txt with a score column, missing files have no detection.
+    :param pred_dir: directory of txt files, or a packed file written by save_labels_bulk
+    :return: per frame columnar labels
+    """
+    packed = PackedSplit(pred_dir) if os.path.isfile(pred_dir) else None
+    annos = []
+    for imgid in imgids:
+        name = (imgid if isinstance(imgid, str) else '%06d' % imgid) + '.txt'
+        if packed is not None:
+            row = packed.row(imgid)
+            source = f'row {row} ({name}) of {pred_dir}'
+            arrays = None if row is None else packed.label_arrays(row, 2)
+            arrays = {k: np.array(v) for k, v in arrays.items()} if arrays is not None else _empty_label_arrays()
+        else:
+            source = os.path.join(pred_dir, name)
+            if os.path.exists(source):
+                with open(source) as f:
+                    arrays = _parse_label_text(f.read())
+            else:
+                arrays = _empty_label_arrays()
+        if 'score' not in arrays:
+            if len(arrays['cls']) > 0:
+                raise ValueError(f'{source} has no score column')
+            arrays['score'] = np.zeros((0,), dtype=np.float32)
+        annos.append(arrays)
+    return annos
+
+
+def evaluate(kitti_root: str, split: str, pred_dir: str, imgids: Sequence[Union[str, int]] = None,
+             classes=('Car', 'Pedestrian', 'Cyclist'), metrics=METRICS, min_overlaps=None,
+             num_recall_points=40, num_workers=None):
+    """
+    Evaluate detections in pred_dir against label_2 of a split.
+    :param kitti_root:
+    :param split:
+    :param pred_dir: directory of {imgid}.txt in kitti format with scores, or a packed file, see load_predictions
+    :param imgids: default all images with a label
+    :return: see evaluate_arrays
+    """
+    if imgids is None:
+        label_dir = os.path.join(kitti_root, 'object', split, 'label_2')
+        imgids = sorted(int(name[:-4]) for name in os.listdir(label_dir) if name.endswith('.txt'))
+    gt_annos = _split_frames(*load_labels_2_arrays(kitti_root, split, imgids))
+    dt_annos = load_predictions(pred_dir, imgids)
+    return evaluate_arrays(gt_annos, dt_annos, classes, metrics, min_overlaps, num_recall_points, num_workers)
+
+
+def format_results(results):
+    lines = []
+    for cls, aps in results.items():
+        lines.append(f'{cls} AP (easy, moderate, hard):')
+        for metric, ap in aps.items():
+            lines.append(f'{metric:>4}: {ap[0]:.4f}, {ap[1]:.4f}, {ap[2]:.4f}')
+    return '\n'.join(lines)
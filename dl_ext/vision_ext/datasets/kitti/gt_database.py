@@ -0,0 +1,133 @@
+"""
+Ground truth database for gt sampling augmentation: the velodyne points inside every labelled 3D box of a split,
+stored in one packed file (see io/_packed.py) that is memory-mapped by GTDatabase.
+Points are (x, y, z, intensity) in velodyne coordinate, translated so that the bottom center of the box is the origin.
+Example:
+    >>> build_gt_database(KITTIROOT, 'training')
+    >>> db = GTDatabase(default_gt_database_path(KITTIROOT, 'training'))
+    >>> for i in db.indices('Car', min_points=5): db.points(i)
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Sequence, Union
+
+import numpy as np
+from tqdm import tqdm
+
+from .eval import get_difficulty
+from .io._label import _interest_class_ids
+from .io._packed import _Container, _write_container
+from .io.calib import load_calib
+from .io.image_info import load_image_info
+from .io.label_2 import load_label_2_arrays
+from .io.pack import _list_imgids
+from .io.velodyne import load_velodyne
+from .structures.box3d import boxes3d_from_arrays, points_in_boxes3d
+from .structures.kitti_object_3d import KITTIObjectClass
+
+default_gt_classes = [c for c in KITTIObjectClass if c != KITTIObjectClass.DontCare]
+
+
+def default_gt_database_path(kitti_root: str, split: str):
+    return os.path.join(kitti_root, 'object', f'{split}_gt_database.dlpack')
+
+
+def _frame_gt_objects(kitti_root: str, split: str, imgid: int, image_size, classes):
+    arrays = load_label_2_arrays(kitti_root, split, imgid, classes)
+    calib = load_calib(kitti_root, split, imgid, image_size)
+    velodyne = load_velodyne(kitti_root, split, imgid, mmap=True)
+    boxes = boxes3d_from_arrays(arrays)
+    point_idx, box_idx = points_in_boxes3d(calib.lidar_to_rect(np.asarray(velodyne[:, :3])), boxes)
+    order = np.argsort(box_idx, kind='stable')
+    point_idx, box_idx = point_idx[order], box_idx[order]
+    points = np.array(velodyne[point_idx], dtype=np.float32)
+    if len(boxes) > 0:
+        points[:, :3] -= calib.rect_to_lidar(boxes[:, :3]).astype(np.float32)[box_idx]
+    return {'imgid': np.full((len(boxes),), imgid, dtype=np.int64),
+            'label_index': np.arange(len(boxes), dtype=np.int32),
+            'cls': arrays['cls'],
+            'difficulty': get_difficulty(arrays),
+            'box3d': boxes,
+            'num_points': np.bincount(box_idx, minlength=len(boxes)).astype(np.int64),
+            'points': points}
+
+
+def _gt_objects_chunk(kitti_root: str, split: str, imgids, image_sizes, classes):
+    return [_frame_gt_objects(kitti_root, split, imgid, image_size, classes)
+            for imgid, image_size in zip(imgids, image_sizes)]
+
+
+def build_gt_database(kitti_root: str, split: str, out_path: str = None, imgids: Sequence[Union[str, int]] = None,
+                      classes=None, num_workers=None, chunk_size=32):
+    """
+    :param kitti_root:
+    :param split:
+    :param out_path: default kitti_root/object/{split}_gt_database.dlpack
+    :param imgids: default all frames with a label_2
+    :param classes: default all classes except DontCare
+    :param num_workers: processes, default os.cpu_count(), 0 to run in the calling process
+    :param chunk_size: frames per task
+    :return: out_path
+    """
+    if out_path is None:
+        out_path = default_gt_database_path(kitti_root, split)
+    if imgids is None:
+        imgids = _list_imgids(kitti_root, split, 'label_2')
+    imgids = [int(imgid) for imgid in imgids]
+    classes = default_gt_classes if classes is None else list(_interest_class_ids(classes))
+    # image sizes are looked up here, so that workers do not each scan the image info index
+    image_sizes = [load_image_info(kitti_root, split, imgid)[1::-1] for imgid in imgids]
+    chunks = [(imgids[b:b + chunk_size], image_sizes[b:b + chunk_size]) for b in range(0, len(imgids), chunk_size)]
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    if num_workers == 0:
+        frames = [f for c in tqdm(chunks, desc='gt database', leave=False)
+                  for f in _gt_objects_chunk(kitti_root, split, *c, classes)]
+    else:
+        with ProcessPoolExecutor(num_workers) as executor:
+            futures = [executor.submit(_gt_objects_chunk, kitti_root, split, *c, classes) for c in chunks]
+            frames = [f for future in tqdm(futures, desc='gt database', leave=False) for f in future.result()]
+
+    specs = {}
+    for k in ('imgid', 'label_index', 'cls', 'difficulty', 'box3d', 'num_points'):
+        specs[k] = np.concatenate([f[k] for f in frames]) if frames else np.zeros((0,))
+    offsets = np.zeros((len(specs['num_points']) + 1,), dtype=np.int64)
+    np.cumsum(specs.pop('num_points'), out=offsets[1:])
+    specs['offsets'] = offsets
+    specs['points'] = (np.float32, (int(offsets[-1]), 4), (f['points'] for f in frames))
+    _write_container(out_path, specs, {'kitti_root': os.path.abspath(kitti_root), 'split': split})
+    return out_path
+
+
+class GTDatabase(_Container):
+    """
+    Memory-mapped ground truth database, see build_gt_database.
+    Per object arrays: imgid, label_index (row in load_label_2_arrays), cls, difficulty (see eval.get_difficulty),
+    box3d (x, y, z, h, w, l, ry in rect coordinate) and offsets into points.
+    """
+
+    def __len__(self):
+        return len(self['imgid'])
+
+    @property
+    def num_points(self):
+        return np.diff(self['offsets'])
+
+    def points(self, i: int):
+        """
+        :return: (N, 4) read-only view of the points of object i
+        """
+        offsets = self['offsets']
+        return self['points'][offsets[i]:offsets[i + 1]]
+
+    def indices(self, cls: Union[str, int], min_points: int = 0, difficulties: Sequence[int] = None):
+        """
+        :param cls: class name or KITTIObjectClass
+        :param min_points: drop objects with less points
+        :param difficulties: keep objects of these difficulties only, default all
+        :return: indices of the objects
+        """
+        keep = (self['cls'] == _interest_class_ids([cls])[0]) & (self.num_points >= min_points)
+        if difficulties is not None:
+            keep &= np.isin(self['difficulty'], difficulties)
+        return np.nonzero(keep)[0]
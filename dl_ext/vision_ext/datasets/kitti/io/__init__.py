@@ -12,6 +12,10 @@ kitti
         --testing
             ...
 Currently, these functions support calib,image_2,image_3 and label_2
+A whole split can be packed into one memory-mapped file with pack_split,
+after which calib, label, image info and velodyne loading read from it.
+Predictions are written in kitti format with save_label, save_labels_bulk or KITTILabelWriter.
+KITTI raw and tracking sequences are read by KITTIRawSequence and KITTITrackingSequence, see sequence.py.
 Parameter explanation:
     imgid: int or str, for example: 2333 or '002333'
     kitti_root: to kitti. not to object.
@@ -24,3 +28,9 @@ from .label_2 import *
 from .label_3 import *
 from .velodyne import *
 from .image_info import *
+from .pack import pack_split
+from ._packed import PackedSplit, register_packed
+from .frame_reader import KITTIFrameReader
+from .save_label import save_label, save_labels_bulk, KITTILabelWriter
+from .image_tensor import load_image_2_tensor, load_image_3_tensor, load_stereo_tensor, ImageBufferRing
+from .sequence import KITTIRawSequence, KITTITrackingSequence, load_raw_calib, load_tracking_calib, oxts_to_poses
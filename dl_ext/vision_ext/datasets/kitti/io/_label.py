@@ -1,11 +1,22 @@
 import os
-from typing import Union
+from typing import Union, Sequence
+
+import numpy as np
 
 from ..structures.kitti_object_3d import KITTIObjectClass, KITTIObject3D
+from ._packed import _packed_row, _get_packed
 
 default_interest_classes = list(map(int, KITTIObjectClass))
 
 
+def _label_path(kitti_root: str, split: str, imgid: Union[str, int], view: int):
+    assert view in (2, 3)
+    label_i_dir = os.path.join(kitti_root, 'object', split, f'label_{view}')
+    if not isinstance(imgid, str):
+        imgid = '%06d' % imgid
+    return os.path.join(label_i_dir, imgid + '.txt')
+
+
 def _load_label_i(kitti_root: str, split: str, imgid: Union[str, int], view: int, interest_classes=None):
     """
     Load label_view
@@ -16,21 +27,21 @@ def _load_label_i(kitti_root: str, split: str, imgid: Union[str, int], view: int
     :param interest_classes: default all classes, including dontcare
     :return:
     """
-    assert view in (2, 3)
-    label_i_dir = os.path.join(kitti_root, 'object', split, f'label_{view}')
-    if not isinstance(imgid, str):
-        imgid = '%06d' % imgid
-    absolute_path = os.path.join(label_i_dir, imgid + '.txt')
-    with open(absolute_path) as f:
-        lines = f.read().splitlines()
-    labels = []
-    for l in lines:
-        items = l.split()
-        cls = items[0]
-        truncated, occluded, alpha, x1, y1, x2, y2, h, w, l, x, y, z, ry = map(float, items[1:])
-        label = KITTIObject3D(KITTIObjectClass[cls], truncated, occluded, alpha,
-                              x1, y1, x2, y2, h, w, l, x, y, z, ry)
-        labels.append(label)
+    arrays = _load_packed_label_arrays(kitti_root, split, imgid, view)
+    if arrays is not None:
+        labels = _label_arrays_to_objects(arrays)
+    else:
+        absolute_path = _label_path(kitti_root, split, imgid, view)
+        with open(absolute_path) as f:
+            lines = f.read().splitlines()
+        labels = []
+        for l in lines:
+            items = l.split()
+            cls = items[0]
+            truncated, occluded, alpha, x1, y1, x2, y2, h, w, l, x, y, z, ry = map(float, items[1:])
+            label = KITTIObject3D(KITTIObjectClass[cls], truncated, occluded, alpha,
+                                  x1, y1, x2, y2, h, w, l, x, y, z, ry)
+            labels.append(label)
     if interest_classes is not None:
         for i, ic in enumerate(interest_classes):
             if isinstance(ic, str):
@@ -38,3 +49,151 @@ def _load_label_i(kitti_root: str, split: str, imgid: Union[str, int], view: int
 
         labels = list(filter(lambda x: x.cls in interest_classes, labels))
     return labels
+
+
+def _label_arrays_to_objects(arrays):
+    columns = np.concatenate([arrays['truncated'][:, None], arrays['occluded'][:, None], arrays['alpha'][:, None],
+                              arrays['box2d'], arrays['dims'], arrays['loc'], arrays['ry'][:, None]], axis=1)
+    # go through the shortest decimal repr so that values equal the ones parsed from text by float()
+    columns = columns.astype(str).astype(np.float64)
+    return [KITTIObject3D(KITTIObjectClass(int(cls)), *values)
+            for cls, values in zip(arrays['cls'], columns.tolist())]
+
+
+def _load_packed_label_arrays(kitti_root: str, split: str, imgid: Union[str, int], view: int):
+    packed, row = _packed_row(kitti_root, split, imgid)
+    if packed is None:
+        return None
+    arrays = packed.label_arrays(row, view)
+    if arrays is None:
+        return None
+    return {k: np.array(v) for k, v in arrays.items()}
+
+
+def _empty_label_arrays(with_score=False):
+    arrays = {'cls': np.zeros((0,), dtype=np.int8),
+              'truncated': np.zeros((0,), dtype=np.float32),
+              'occluded': np.zeros((0,), dtype=np.int8),
+              'alpha': np.zeros((0,), dtype=np.float32),
+              'box2d': np.zeros((0, 4), dtype=np.float32),
+              'dims': np.zeros((0, 3), dtype=np.float32),
+              'loc': np.zeros((0, 3), dtype=np.float32),
+              'ry': np.zeros((0,), dtype=np.float32)}
+    if with_score:
+        arrays['score'] = np.zeros((0,), dtype=np.float32)
+    return arrays
+
+
+def _parse_label_text(text: str):
+    """
+    Parse the content of one or more label files at once.
+    :param text: label lines, 15 columns for ground truth or 16 columns (with score) for predictions
+    :return: dict of columns, see _load_label_i_arrays
+    """
+    tokens = np.array(text.split())
+    num_lines = sum(1 for l in text.splitlines() if l.strip())
+    if num_lines == 0:
+        return _empty_label_arrays()
+    num_cols = tokens.size // num_lines
+    assert num_cols in (15, 16) and num_cols * num_lines == tokens.size, \
+        f'expect 15 or 16 columns per label line, got {tokens.size} tokens in {num_lines} lines'
+    tokens = tokens.reshape(num_lines, num_cols)
+    names, inverse = np.unique(tokens[:, 0], return_inverse=True)
+    lookup = np.empty((len(names),), dtype=np.int8)
+    for i, name in enumerate(names):
+        lookup[i] = KITTIObjectClass[name]
+    values = tokens[:, 1:].astype(np.float32)
+    arrays = {'cls': lookup[inverse.reshape(-1)],
+              'truncated': values[:, 0],
+              'occluded': values[:, 1].astype(np.int8),
+              'alpha': values[:, 2],
+              'box2d': values[:, 3:7],
+              'dims': values[:, 7:10],
+              'loc': values[:, 10:13],
+              'ry': values[:, 13]}
+    if num_cols == 16:
+        arrays['score'] = values[:, 14]
+    return arrays
+
+
+def _interest_class_ids(interest_classes):
+    return np.array([KITTIObjectClass[c] if isinstance(c, str) else int(c) for c in interest_classes],
+                    dtype=np.int8)
+
+
+def _filter_label_arrays(arrays, interest_classes):
+    keep = np.isin(arrays['cls'], _interest_class_ids(interest_classes))
+    return {k: v[keep] for k, v in arrays.items()}, keep
+
+
+def _load_label_i_arrays(kitti_root: str, split: str, imgid: Union[str, int], view: int, interest_classes=None):
+    """
+    Load label_view as a dict of columns instead of a list of KITTIObject3D.
+    :param kitti_root:
+    :param split:
+    :param imgid:
+    :param view:
+    :param interest_classes: default all classes, including dontcare
+    :return: dict with keys
+        cls: (N,) int8, value of KITTIObjectClass
+        truncated: (N,) float32
+        occluded: (N,) int8
+        alpha: (N,) float32
+        box2d: (N, 4) float32, x1, y1, x2, y2
+        dims: (N, 3) float32, h, w, l
+        loc: (N, 3) float32, x, y, z
+        ry: (N,) float32
+        score: (N,) float32, only present for prediction files
+    """
+    arrays = _load_packed_label_arrays(kitti_root, split, imgid, view)
+    if arrays is None:
+        with open(_label_path(kitti_root, split, imgid, view)) as f:
+            arrays = _parse_label_text(f.read())
+    if interest_classes is not None:
+        arrays, _ = _filter_label_arrays(arrays, interest_classes)
+    return arrays
+
+
+def _load_labels_i_arrays(kitti_root: str, split: str, imgids: Sequence[Union[str, int]], view: int,
+                          interest_classes=None):
+    """
+    Load label_view of many images into one dict of concatenated columns.
+    Objects of imgids[i] are arrays[k][offsets[i]:offsets[i + 1]].
+    :return: arrays, offsets (len(imgids) + 1,) int64
+    """
+    arrays, counts = _load_packed_labels_arrays(kitti_root, split, imgids, view)
+    if arrays is None:
+        arrays, counts = _read_labels_arrays(kitti_root, split, imgids, view)
+    if interest_classes is not None:
+        arrays, keep = _filter_label_arrays(arrays, interest_classes)
+        frame = np.repeat(np.arange(len(counts)), counts)
+        counts = np.bincount(frame[keep], minlength=len(counts)).astype(np.int64)
+    offsets = np.zeros((len(counts) + 1,), dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return arrays, offsets
+
+
+def _read_labels_arrays(kitti_root: str, split: str, imgids: Sequence[Union[str, int]], view: int):
+    texts = []
+    for imgid in imgids:
+        with open(_label_path(kitti_root, split, imgid, view)) as f:
+            texts.append(f.read())
+    counts = np.array([sum(1 for l in t.splitlines() if l.strip()) for t in texts], dtype=np.int64)
+    return _parse_label_text('\n'.join(texts)), counts
+
+
+def _load_packed_labels_arrays(kitti_root: str, split: str, imgids: Sequence[Union[str, int]], view: int):
+    packed = _get_packed(kitti_root, split)
+    if packed is None or f'label_{view}/offsets' not in packed:
+        return None, None
+    rows = [packed.row(imgid) for imgid in imgids]
+    if any(row is None for row in rows):
+        return None, None
+    offsets = packed[f'label_{view}/offsets']
+    rows = np.array(rows, dtype=np.int64)
+    counts = offsets[rows + 1] - offsets[rows]
+    index = np.repeat(offsets[rows] - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+    prefix = f'label_{view}/'
+    arrays = {k[len(prefix):]: packed[k][index] for k in packed.keys()
+              if k.startswith(prefix) and k != prefix + 'offsets'}
+    return arrays, counts
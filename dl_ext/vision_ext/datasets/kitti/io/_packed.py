@@ -0,0 +1,154 @@
+"""
+Reader and writer of the packed binary container used to cache a whole kitti split in one file.
+Layout: 8 bytes magic, uint64 header length, json header, then 64-byte aligned raw arrays.
+The whole file is np.memmap-ed once and every array is a zero-copy view into it.
+"""
+import json
+import os
+import struct
+from typing import Union
+
+import numpy as np
+
+_MAGIC = b'DLEXPACK'
+_ALIGN = 64
+
+_packed_paths = {}
+_packed_splits = {}
+
+
+def _align(n):
+    return (n + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+def _write_container(path: str, specs: dict, meta: dict = None):
+    """
+    :param path:
+    :param specs: name -> np.ndarray, or name -> (dtype, shape, iterable of chunks) for arrays too large to hold
+    :param meta: json serializable dict
+    """
+    layout = {}
+    offset = 0
+    for name, spec in specs.items():
+        if isinstance(spec, np.ndarray):
+            dtype, shape = spec.dtype, spec.shape
+        else:
+            dtype, shape, _ = spec
+            dtype = np.dtype(dtype)
+        layout[name] = {'dtype': dtype.str, 'shape': list(shape), 'offset': offset}
+        offset = _align(offset + int(np.prod(shape)) * dtype.itemsize)
+    header = json.dumps({'arrays': layout, 'meta': meta or {}}).encode()
+    data_start = _align(len(_MAGIC) + 8 + len(header))
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for name, spec in specs.items():
+            f.seek(data_start + layout[name]['offset'])
+            if isinstance(spec, np.ndarray):
+                f.write(np.ascontiguousarray(spec).tobytes())
+            else:
+                dtype, _, chunks = spec
+                for chunk in chunks:
+                    f.write(np.ascontiguousarray(chunk, dtype=dtype).tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+
+class _Container:
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            magic = f.read(len(_MAGIC))
+            if magic != _MAGIC:
+                raise ValueError(f'{path} is not a packed dl_ext container')
+            header_len, = struct.unpack('<Q', f.read(8))
+            header = json.loads(f.read(header_len).decode())
+        self.path = path
+        self.meta = header['meta']
+        self._layout = header['arrays']
+        self._buffer = np.memmap(path, dtype=np.uint8, mode='r')
+        self._data_start = _align(len(_MAGIC) + 8 + header_len)
+        self._arrays = {}
+
+    def __contains__(self, name):
+        return name in self._layout
+
+    def keys(self):
+        return self._layout.keys()
+
+    def __getitem__(self, name) -> np.ndarray:
+        if name not in self._arrays:
+            spec = self._layout[name]
+            dtype = np.dtype(spec['dtype'])
+            begin = self._data_start + spec['offset']
+            nbytes = int(np.prod(spec['shape'])) * dtype.itemsize
+            self._arrays[name] = np.asarray(self._buffer[begin:begin + nbytes]).view(dtype).reshape(spec['shape'])
+        return self._arrays[name]
+
+
+class PackedSplit(_Container):
+    """
+    A packed kitti split, see pack_split.
+    """
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        ids = self['ids']
+        self._contiguous = len(ids) == 0 or (ids[0] == 0 and ids[-1] == len(ids) - 1)
+
+    def row(self, imgid: Union[str, int]):
+        """
+        :return: row of imgid in the packed arrays, None if imgid is not packed.
+        """
+        imgid = int(imgid)
+        ids = self['ids']
+        if self._contiguous:
+            return imgid if 0 <= imgid < len(ids) else None
+        row = int(np.searchsorted(ids, imgid))
+        if row < len(ids) and ids[row] == imgid:
+            return row
+        return None
+
+    def label_arrays(self, row: int, view: int):
+        prefix = f'label_{view}/'
+        if prefix + 'offsets' not in self:
+            return None
+        offsets = self[prefix + 'offsets']
+        begin, end = offsets[row], offsets[row + 1]
+        return {k[len(prefix):]: self[k][begin:end] for k in self.keys()
+                if k.startswith(prefix) and k != prefix + 'offsets'}
+
+
+def default_packed_path(kitti_root: str, split: str):
+    return os.path.join(kitti_root, 'object', f'{split}.dlpack')
+
+
+def register_packed(kitti_root: str, split: str, path: str):
+    """
+    Use the packed file at path for (kitti_root, split), e.g. when the dataset directory is read-only.
+    """
+    key = (os.path.abspath(kitti_root), split)
+    _packed_paths[key] = path
+    _packed_splits.pop(key, None)
+
+
+def _get_packed(kitti_root: str, split: str):
+    """
+    :return: PackedSplit of (kitti_root, split), None if the split has not been packed.
+    """
+    key = (os.path.abspath(kitti_root), split)
+    if key not in _packed_splits:
+        path = _packed_paths.get(key, default_packed_path(kitti_root, split))
+        _packed_splits[key] = PackedSplit(path) if os.path.exists(path) else None
+    return _packed_splits[key]
+
+
+def _packed_row(kitti_root: str, split: str, imgid: Union[str, int]):
+    packed = _get_packed(kitti_root, split)
+    if packed is None:
+        return None, None
+    row = packed.row(imgid)
+    if row is None:
+        return None, None
+    return packed, row
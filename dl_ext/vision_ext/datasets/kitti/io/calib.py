@@ -1,27 +1,174 @@
 import os.path as osp
 import os
+from collections import OrderedDict
 from typing import Union
 
 import numpy as np
 from ..structures.calib import Calibration
 from .image_info import load_image_info
+from ._packed import _packed_row, _get_packed
 
+_calib_shapes = {'P0': (3, 4),
+                 'P1': (3, 4),
+                 'P2': (3, 4),
+                 'P3': (3, 4),
+                 'R0_rect': (3, 3),
+                 'Tr_velo_to_cam': (3, 4),
+                 'Tr_imu_to_velo': (3, 4)}
 
-def load_calib(kitti_root: str, split: str, imgid: Union[str, int]):
+
+def _calib_path(kitti_root: str, split: str, imgid: Union[str, int]):
     if not isinstance(imgid, str):
         imgid = '%06d' % imgid
     calib_dir = os.path.join(kitti_root, 'object', split, 'calib')
-    absolute_path = osp.join(calib_dir, imgid + '.txt')
+    return osp.join(calib_dir, imgid + '.txt')
+
+
+def _parse_calib_text(text: str):
+    values = {}
+    for line in text.splitlines():
+        key, sep, rest = line.partition(':')
+        if sep:
+            values[key.strip()] = rest
+    return {k: np.array(values[k].split(), dtype=np.float64).reshape(shape) for k, shape in _calib_shapes.items()}
+
+
+def _parse_calib_file(absolute_path: str):
     with open(absolute_path) as f:
-        lines = {line.strip().split(':')[0]: list(map(float, line.strip().split(':')[1].split())) for line in
-                 f.readlines()[:-1]}
-    calibs = {'P0': np.array(lines['P0']).reshape((3, 4)),
-              'P1': np.array(lines['P1']).reshape((3, 4)),
-              'P2': np.array(lines['P2']).reshape((3, 4)),
-              'P3': np.array(lines['P3']).reshape((3, 4)),
-              'R0_rect': np.array(lines['R0_rect']).reshape((3, 3)),
-              'Tr_velo_to_cam': np.array(lines['Tr_velo_to_cam']).reshape((3, 4)),
-              'Tr_imu_to_velo': np.array(lines['Tr_imu_to_velo']).reshape((3, 4))}
-    H, W, _ = load_image_info(kitti_root, split, imgid)
-    image_size = (W, H)
+        return _parse_calib_text(f.read())
+
+
+def _parse_calib_files(paths):
+    """
+    Parse many calib files at once into (N, 7, 12) rows, see _calibs_to_row.
+    Files laid out as the kitti object calibs (keys in the order of _calib_shapes) are converted
+    by a single np.fromstring over the values of all files, others are parsed one by one.
+    """
+    texts = []
+    for path in paths:
+        with open(path) as f:
+            texts.append(f.read())
+    text = '\n'.join(texts)
+    tokens = text.split()
+    sizes = [shape[0] * shape[1] for shape in _calib_shapes.values()]
+    key_cols = np.cumsum([0] + [1 + n for n in sizes[:-1]])
+    num_cols = sum(sizes) + len(sizes)
+    if len(tokens) == len(texts) * num_cols and \
+            all(tokens[col::num_cols] == [k + ':'] * len(texts) for col, k in zip(key_cols, _calib_shapes)):
+        values = np.fromstring(' '.join([t for t in tokens if t[-1] != ':']), dtype=np.float64, sep=' ')
+        if values.size == len(texts) * sum(sizes):
+            values = values.reshape(len(texts), sum(sizes))
+            rows = np.zeros((len(texts), len(_calib_shapes), 12), dtype=np.float64)
+            begin = 0
+            for i, n in enumerate(sizes):
+                rows[:, i, :n] = values[:, begin:begin + n]
+                begin += n
+            return rows
+    return np.stack([_calibs_to_row(_parse_calib_text(t)) for t in texts]).reshape(-1, len(_calib_shapes), 12)
+
+
+def _calibs_to_row(calibs):
+    """
+    Flatten calib matrices to a (7, 12) row of the packed calib array, R0_rect is zero padded.
+    """
+    row = np.zeros((len(_calib_shapes), 12), dtype=np.float64)
+    for i, k in enumerate(_calib_shapes):
+        row[i, :calibs[k].size] = calibs[k].reshape(-1)
+    return row
+
+
+def _row_to_calibs(row):
+    return {k: np.array(row[i, :shape[0] * shape[1]]).reshape(shape)
+            for i, (k, shape) in enumerate(_calib_shapes.items())}
+
+
+class _CalibStore:
+    """
+    Calibs of a whole (root, split) as one read-only (N, 7, 12) float64 array, parsed once,
+    or the calib array of the packed split if there is one. get returns in O(1) a Calibration
+    whose matrices are views of the array, crop and resize of such a Calibration copy them.
+    """
+    instances = OrderedDict()
+    max_instances = 8
+
+    def __init__(self):
+        raise SyntaxError('can not instance, please use get_instance')
+
+    @staticmethod
+    def get_instance(root, split):
+        key = (os.path.abspath(root), split)
+        instances = _CalibStore.instances
+        if key in instances:
+            instances.move_to_end(key)
+        else:
+            instance = object.__new__(_CalibStore)
+            instance.post_init(*key)
+            instances[key] = instance
+            while len(instances) > _CalibStore.max_instances:
+                instances.popitem(last=False)
+        return instances[key]
+
+    def post_init(self, root, split):
+        self.root = root
+        self.split = split
+        packed = _get_packed(root, split)
+        if packed is not None:
+            self.ids = packed['ids']
+            self.calibs = packed['calib']
+            self.image_shapes = packed['image_shape']
+        else:
+            calib_dir = os.path.join(root, 'object', split, 'calib')
+            self.ids = np.array(sorted(int(name[:-4]) for name in os.listdir(calib_dir) if name.endswith('.txt')),
+                                dtype=np.int64)
+            self.calibs = _parse_calib_files([_calib_path(root, split, int(imgid)) for imgid in self.ids])
+            self.calibs.setflags(write=False)
+            self.image_shapes = None
+        self._contiguous = len(self.ids) == 0 or (self.ids[0] == 0 and self.ids[-1] == len(self.ids) - 1)
+
+    def row(self, imgid: Union[str, int]):
+        imgid = int(imgid)
+        if self._contiguous:
+            row = imgid if 0 <= imgid < len(self.ids) else None
+        else:
+            row = int(np.searchsorted(self.ids, imgid))
+            row = row if row < len(self.ids) and self.ids[row] == imgid else None
+        if row is None:
+            raise FileNotFoundError(_calib_path(self.root, self.split, imgid))
+        return row
+
+    def get(self, imgid: Union[str, int], image_size=None):
+        row = self.row(imgid)
+        if image_size is None:
+            if self.image_shapes is not None:
+                H, W, _ = self.image_shapes[row]
+            else:
+                H, W, _ = load_image_info(self.root, self.split, imgid)
+            image_size = (int(W), int(H))
+        calibs = {k: self.calibs[row, i, :shape[0] * shape[1]].reshape(shape)
+                  for i, (k, shape) in enumerate(_calib_shapes.items())}
+        return Calibration(calibs, image_size)
+
+
+def load_calib(kitti_root: str, split: str, imgid: Union[str, int], image_size=None, cache=False):
+    """
+    :param kitti_root:
+    :param split:
+    :param imgid:
+    :param image_size: width, height. Default read from the image info, pass it to skip the lookup.
+    :param cache: parse all calibs of the split on the first call and return Calibration of read-only
+                  views into them afterwards, see _CalibStore
+    :return: Calibration
+    """
+    if cache:
+        return _CalibStore.get_instance(kitti_root, split).get(imgid, image_size)
+    packed, row = _packed_row(kitti_root, split, imgid)
+    if packed is not None:
+        if image_size is None:
+            H, W, _ = packed['image_shape'][row]
+            image_size = (int(W), int(H))
+        return Calibration(_row_to_calibs(packed['calib'][row]), image_size)
+    calibs = _parse_calib_file(_calib_path(kitti_root, split, imgid))
+    if image_size is None:
+        H, W, _ = load_image_info(kitti_root, split, imgid)
+        image_size = (W, H)
     return Calibration(calibs, image_size)
@@ -0,0 +1,149 @@
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Sequence, Union
+
+from .calib import load_calib
+from .image_2 import load_image_2
+from .image_3 import load_image_3
+from .image_tensor import load_image_2_tensor, load_image_3_tensor, load_stereo_tensor
+from .label_2 import load_label_2
+from .label_3 import load_label_3
+from .velodyne import load_velodyne
+
+
+def _load_image(loader):
+    def load(kitti_root, split, imgid):
+        img = loader(kitti_root, split, imgid)
+        img.load()  # PIL decodes lazily, force decoding in the worker thread
+        return img
+
+    return load
+
+
+class KITTIFrameReader:
+    """
+    Iterate over kitti frames in order while the next frames are loaded by a thread pool.
+    Each frame is a dict with key 'imgid' and one key per modality.
+    Example:
+        >>> reader = KITTIFrameReader(KITTIROOT, 'training', range(7481), ('image_2', 'calib', 'label_2'))
+        >>> for frame in reader:
+        >>>     img, calib, labels = frame['image_2'], frame['calib'], frame['label_2']
+        >>> print(reader.stats)
+    """
+    index_key = 'imgid'
+    loaders = {'image_2': _load_image(load_image_2),
+               'image_3': _load_image(load_image_3),
+               'image_2_tensor': load_image_2_tensor,
+               'image_3_tensor': load_image_3_tensor,
+               'stereo_tensor': load_stereo_tensor,
+               'calib': load_calib,
+               'label_2': load_label_2,
+               'label_3': load_label_3,
+               'velodyne': load_velodyne}
+
+    def __init__(self, kitti_root: str, split: str, imgids: Sequence[Union[str, int]],
+                 modalities=('image_2', 'calib', 'label_2'), prefetch=8, num_workers=4):
+        """
+        :param kitti_root:
+        :param split:
+        :param imgids:
+        :param modalities: subset of image_2, image_3, calib, label_2, label_3, velodyne,
+                           image_2_tensor, image_3_tensor, stereo_tensor (uint8 CHW tensors, see image_tensor.py)
+        :param prefetch: number of frames loaded ahead of the consumer
+        :param num_workers: number of loading threads
+        """
+        for m in modalities:
+            if m not in self.loaders:
+                raise ValueError(f'expect modality in {list(self.loaders)}, but found {m}')
+        assert prefetch >= 1
+        self.kitti_root = kitti_root
+        self.split = split
+        self.imgids = imgids
+        self.modalities = modalities
+        self.prefetch = prefetch
+        self.num_workers = num_workers
+        self._pending = deque()
+        self.reset_stats()
+
+    def __len__(self):
+        return len(self.imgids)
+
+    def reset_stats(self):
+        self.frames = 0
+        self.stalls = 0
+        self.stall_time = 0.0
+        self._depth_sum = 0
+
+    @property
+    def queue_depth(self):
+        """
+        Number of frames submitted to the pool that have finished loading and wait to be consumed.
+        """
+        return sum(all(f.done() for f in futures.values()) for _, futures in self._pending)
+
+    @property
+    def stats(self):
+        """
+        frames: frames yielded so far
+        stalls: frames the consumer had to wait for
+        stall_time: total seconds the consumer waited
+        mean_queue_depth: average number of ready frames when a frame was requested,
+            close to 0 means the reader is the bottleneck, close to prefetch means the consumer is.
+        """
+        return {'frames': self.frames,
+                'stalls': self.stalls,
+                'stall_time': self.stall_time,
+                'mean_queue_depth': self._depth_sum / max(self.frames, 1)}
+
+    def _load(self, modality, imgid):
+        return self.loaders[modality](self.kitti_root, self.split, imgid)
+
+    def _submit(self, executor, imgid):
+        futures = {m: executor.submit(self._load, m, imgid) for m in self.modalities}
+        self._pending.append((imgid, futures))
+
+    def windows(self, size: int, stride: int = 1):
+        """
+        Iterate over sliding windows of consecutive frames, each frame is loaded once.
+        :param size: number of frames in a window
+        :param stride: number of frames between the first frames of two windows
+        :return: iterator of lists of frames
+        """
+        window = deque(maxlen=size)
+        for i, frame in enumerate(self):
+            window.append(frame)
+            if len(window) == size and (i - size + 1) % stride == 0:
+                yield list(window)
+
+    def __iter__(self):
+        executor = ThreadPoolExecutor(self.num_workers)
+        imgids = iter(self.imgids)
+        try:
+            for imgid in imgids:
+                self._submit(executor, imgid)
+                if len(self._pending) >= self.prefetch:
+                    break
+            while len(self._pending) > 0:
+                self._depth_sum += self.queue_depth
+                imgid, futures = self._pending.popleft()
+                if not all(f.done() for f in futures.values()):
+                    self.stalls += 1
+                    begin = time.perf_counter()
+                    for f in futures.values():
+                        f.result()
+                    self.stall_time += time.perf_counter() - begin
+                frame = {self.index_key: imgid}
+                for m, f in futures.items():
+                    frame[m] = f.result()
+                imgid = next(imgids, None)
+                if imgid is not None:
+                    self._submit(executor, imgid)
+                self.frames += 1
+                yield frame
+        finally:
+            for _, futures in self._pending:
+                for f in futures.values():
+                    f.cancel()
+            self._pending.clear()
+            executor.shutdown(wait=False)
@@ -1,51 +1,181 @@
+import hashlib
+import json
 import os
-import pickle
+import struct
+import tempfile
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Union
 
+from PIL import Image
 from tqdm import tqdm
 import numpy as np
 
+from ._packed import _packed_row
+
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# png color type -> number of channels
+_PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+
+def read_image_shape(path: str):
+    """
+    Read (H, W, C) of an image from its header without decoding the pixels.
+    :param path:
+    :return:
+    """
+    with open(path, 'rb') as f:
+        head = f.read(26)
+    if head[:8] == _PNG_SIGNATURE and head[12:16] == b'IHDR':
+        width, height = struct.unpack('>II', head[16:24])
+        return height, width, _PNG_CHANNELS[head[25]]
+    with Image.open(path) as img:
+        width, height = img.size
+        return height, width, len(img.getbands())
+
 
 class _ImageInfoCache:
-    instance = None
+    """
+    Image shapes of one (root, split), stored as a (max_id + 1, 3) int32 array of H, W, C
+    (rows of missing ids are -1) under ~/.dl_ext, together with a fingerprint of the image_2 directory
+    (file names, sizes and mtimes). The cache is re-validated once per process and updated incrementally,
+    a missing id only triggers a rescan if the directory was modified since the last one.
+    """
+    instances = OrderedDict()
+    max_instances = 8
+    num_workers = 16
 
     def __init__(self):
         raise SyntaxError('can not instance, please use get_instance')
 
     @staticmethod
     def get_instance(root, split):
-        if _ImageInfoCache.instance is None:
-            _ImageInfoCache.instance = object.__new__(_ImageInfoCache)
-            _ImageInfoCache.instance.post_init(root, split)
-        return _ImageInfoCache.instance
+        key = (os.path.abspath(root), split)
+        instances = _ImageInfoCache.instances
+        if key in instances:
+            instances.move_to_end(key)
+        else:
+            instance = object.__new__(_ImageInfoCache)
+            instance.post_init(*key)
+            instances[key] = instance
+            while len(instances) > _ImageInfoCache.max_instances:
+                instances.popitem(last=False)
+        return instances[key]
 
     def post_init(self, root, split):
 
         cache_dir = os.path.expanduser('~/.dl_ext/vision_ext/datasets/kitti/image_info')
-        self.cache_path = os.path.join(cache_dir, f'{split}.pkl')
+        name = f'{split}_{hashlib.sha1(root.encode()).hexdigest()[:16]}'
+        self.cache_path = os.path.join(cache_dir, name + '.npy')
+        self.meta_path = os.path.join(cache_dir, name + '.json')
         os.makedirs(cache_dir, exist_ok=True)
         self.root = root
         self.split = split
+        self.image_dir = os.path.join(root, 'object', split, 'image_2')
+        self.dir_mtime_ns = None
+        self.fingerprint = None
         self.infos = self.load_info()
 
+    def scan(self):
+        """
+        :return: {imgid: (mtime_ns, size)} of images in image_dir and the fingerprint of the listing
+        """
+        # before listing, so that images added during the scan trigger the next one, and not trusted if recent
+        # since changes within the timestamp granularity of the file system would not modify it
+        dir_mtime_ns = os.stat(self.image_dir).st_mtime_ns
+        self.dir_mtime_ns = dir_mtime_ns if time.time_ns() - dir_mtime_ns > 2 * 10 ** 9 else None
+        stats = {}
+        with os.scandir(self.image_dir) as it:
+            for entry in it:
+                if entry.name.endswith('.png'):
+                    st = entry.stat()
+                    stats[int(entry.name[:-4])] = (st.st_mtime_ns, st.st_size)
+        fingerprint = hashlib.sha1(json.dumps(sorted(stats.items())).encode()).hexdigest()
+        return stats, fingerprint
+
     def load_info(self):
-        if os.path.exists(self.cache_path):
-            return pickle.load(open(self.cache_path, 'rb'))
+        stats, fingerprint = self.scan()
+        meta = None
+        if os.path.exists(self.cache_path) and os.path.exists(self.meta_path):
+            with open(self.meta_path) as f:
+                meta = json.load(f)
+            if meta['fingerprint'] == fingerprint:
+                self.fingerprint = fingerprint
+                return np.load(self.cache_path)
+        if meta is not None:
+            img_shapes = np.load(self.cache_path)
+            indexed_at = meta['indexed_at']
         else:
-            print('Image info cache not found. Generating...')
-            from .image_2 import load_image_2
-            img_shapes = []
-            n = len(os.listdir(os.path.join(self.root, 'object', self.split, 'image_2')))
-            for i in tqdm(range(n), leave=False):
-                img2 = np.array(load_image_2(self.root, self.split, i))
-                img_shapes.append(img2.shape)
-            pickle.dump(img_shapes, open(self.cache_path, 'wb'))
+            img_shapes = np.zeros((0, 3), dtype=np.int32)
+            indexed_at = 0
+        return self.update_info(img_shapes, stats, fingerprint, indexed_at)
+
+    def update_info(self, img_shapes, stats, fingerprint, indexed_at):
+        """
+        Index the images that are missing in img_shapes or were modified after indexed_at
+        by reading their headers in a thread pool.
+        """
+        indexed_at_now = time.time_ns()
+        num = max(stats) + 1 if len(stats) > 0 else 0
+        infos = np.full((num, 3), -1, dtype=np.int32)
+        n = min(num, len(img_shapes))
+        infos[:n] = img_shapes[:n]
+        new_ids = [i for i, (mtime, _) in sorted(stats.items()) if infos[i, 0] < 0 or mtime >= indexed_at]
+        removed = np.ones((num,), dtype=bool)
+        removed[list(stats)] = False
+        infos[removed] = -1
+        if len(new_ids) > 0:
+            print(f'Indexing {len(new_ids)} images...')
+            paths = [os.path.join(self.image_dir, '%06d.png' % i) for i in new_ids]
+            with ThreadPoolExecutor(self.num_workers) as executor:
+                shapes = list(tqdm(executor.map(read_image_shape, paths, chunksize=64), total=len(paths),
+                                   leave=False))
+            infos[new_ids] = shapes
             print('Done.')
-            return img_shapes
+        # temporary files then os.replace, the json last, so that concurrent readers never see a partial file
+        # or a fingerprint newer than the shapes
+        self._replace(self.cache_path, lambda f: np.save(f, infos), 'wb')
+        self._replace(self.meta_path, lambda f: json.dump({'root': self.root, 'split': self.split,
+                                                           'fingerprint': fingerprint,
+                                                           'indexed_at': indexed_at_now}, f), 'w')
+        self.fingerprint = fingerprint
+        return infos
+
+    @staticmethod
+    def _replace(path, write, mode):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with open(fd, mode) as f:
+                write(f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def refresh(self):
+        stats, fingerprint = self.scan()
+        if fingerprint == self.fingerprint:
+            return
+        with open(self.meta_path) as f:
+            indexed_at = json.load(f)['indexed_at']
+        self.infos = self.update_info(self.infos, stats, fingerprint, indexed_at)
+
+    def get(self, imgid: int):
+        if (imgid >= len(self.infos) or self.infos[imgid, 0] < 0) and \
+                os.stat(self.image_dir).st_mtime_ns != self.dir_mtime_ns:
+            self.refresh()
+        if imgid >= len(self.infos) or self.infos[imgid, 0] < 0:
+            raise FileNotFoundError(os.path.join(self.image_dir, '%06d.png' % imgid))
+        H, W, C = self.infos[imgid].tolist()
+        return H, W, C
 
 
 def load_image_info(kitti_root: str, split: str, imgid: Union[int, str]):
     if not isinstance(imgid, int):
         imgid = int(imgid)
+    packed, row = _packed_row(kitti_root, split, imgid)
+    if packed is not None:
+        return tuple(packed['image_shape'][row].tolist())
     img_info = _ImageInfoCache.get_instance(kitti_root, split)
-    return img_info.infos[imgid]
+    return img_info.get(imgid)
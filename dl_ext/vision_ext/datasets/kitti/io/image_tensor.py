@@ -0,0 +1,99 @@
+"""
+Load kitti images as uint8 (3, H, W) tensors, decoded by torchvision straight to CHW without going through PIL
+and numpy, optionally into preallocated (pinned or shared memory) buffers.
+Normalize on the GPU after batching, see vision_ext.transforms.imagenet_normalize_uint8.
+Example:
+    >>> ring = ImageBufferRing(16, (2, 3, 376, 1242), pin_memory=True)
+    >>> pair = load_stereo_tensor(KITTIROOT, 'training', 3, out=ring.next())
+    >>> pair = pair.cuda(non_blocking=True)
+"""
+import os
+from typing import Union
+
+import torch
+from torchvision.io import decode_image, read_file, ImageReadMode
+
+
+def _image_path(kitti_root: str, split: str, imgid: Union[str, int], view: int):
+    if not isinstance(imgid, str):
+        imgid = '%06d' % imgid
+    return os.path.join(kitti_root, 'object', split, f'image_{view}', imgid + '.png')
+
+
+def _copy_into(img: torch.Tensor, out: torch.Tensor):
+    """
+    Copy img to the top left of out and zero the rest, so that images of different sizes can share a batch buffer.
+    """
+    H, W = img.shape[-2:]
+    if out.shape[-2:] == (H, W):
+        return out.copy_(img)
+    assert out.shape[-2] >= H and out.shape[-1] >= W, f'image of size {(H, W)} does not fit in {tuple(out.shape)}'
+    out[..., :H, :W].copy_(img)
+    out[..., H:, :].zero_()
+    out[..., :H, W:].zero_()
+    return out
+
+
+def _load_image_i_tensor(kitti_root: str, split: str, imgid: Union[str, int], view: int, out=None):
+    img = decode_image(read_file(_image_path(kitti_root, split, imgid, view)), mode=ImageReadMode.RGB)
+    # decoders write interleaved HWC pixels and img is a CHW view of them, the copy into out is the
+    # de-interleaving that a contiguous CHW buffer needs anyway (~2 ms against ~14 ms of decoding a kitti png)
+    if out is None:
+        return img
+    return _copy_into(img, out)
+
+
+def load_image_2_tensor(kitti_root: str, split: str, imgid: Union[str, int], out: torch.Tensor = None):
+    """
+    :param out: uint8 (3, H', W') buffer with H' >= H, W' >= W, the image is zero padded to its size
+    :return: uint8 (3, H, W), or out
+    """
+    return _load_image_i_tensor(kitti_root, split, imgid, 2, out)
+
+
+def load_image_3_tensor(kitti_root: str, split: str, imgid: Union[str, int], out: torch.Tensor = None):
+    return _load_image_i_tensor(kitti_root, split, imgid, 3, out)
+
+
+def load_stereo_tensor(kitti_root: str, split: str, imgid: Union[str, int], out: torch.Tensor = None):
+    """
+    Load image_2 and image_3 into one buffer.
+    :param out: uint8 (2, 3, H', W') buffer, see load_image_2_tensor
+    :return: uint8 (2, 3, H, W), left then right, or out
+    """
+    left = _load_image_i_tensor(kitti_root, split, imgid, 2)
+    if out is None:
+        out = torch.empty((2,) + tuple(left.shape), dtype=torch.uint8)
+    _copy_into(left, out[0])
+    _load_image_i_tensor(kitti_root, split, imgid, 3, out[1])
+    return out
+
+
+class ImageBufferRing:
+    """
+    num_slots preallocated uint8 buffers handed out in turn by next(). A slot is reused num_slots calls later,
+    so its content must have been consumed (e.g. copied to the GPU) by then.
+    """
+
+    def __init__(self, num_slots: int, shape, pin_memory=False, shared=False):
+        """
+        :param num_slots:
+        :param shape: shape of a slot, e.g. (3, H, W) for images or (2, 3, H, W) for stereo pairs
+        :param pin_memory: allocate in page-locked memory for asynchronous host to device copies,
+                           ignored if cuda is not available
+        :param shared: allocate in shared memory, to fill the slots from dataloader worker processes
+        """
+        assert not (pin_memory and shared), 'a buffer can not be both pinned and shared'
+        pin_memory = pin_memory and torch.cuda.is_available()
+        self.buffer = torch.empty((num_slots,) + tuple(shape), dtype=torch.uint8, pin_memory=pin_memory)
+        if shared:
+            self.buffer.share_memory_()
+        self.index = 0
+
+    def __len__(self):
+        return self.buffer.shape[0]
+
+    def next(self) -> torch.Tensor:
+        slot = self.buffer[self.index]
+        self.index = (self.index + 1) % len(self)
+        return slot
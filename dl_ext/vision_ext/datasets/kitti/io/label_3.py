@@ -1,7 +1,15 @@
-from typing import Union
+from typing import Union, Sequence
 
-from ._label import _load_label_i
+from ._label import _load_label_i, _load_label_i_arrays, _load_labels_i_arrays
 
 
 def load_label_3(kitti_root: str, split: str, imgid: Union[str, int], interest_classes=None):
     return _load_label_i(kitti_root, split, imgid, 3, interest_classes)
+
+
+def load_label_3_arrays(kitti_root: str, split: str, imgid: Union[str, int], interest_classes=None):
+    return _load_label_i_arrays(kitti_root, split, imgid, 3, interest_classes)
+
+
+def load_labels_3_arrays(kitti_root: str, split: str, imgids: Sequence[Union[str, int]], interest_classes=None):
+    return _load_labels_i_arrays(kitti_root, split, imgids, 3, interest_classes)
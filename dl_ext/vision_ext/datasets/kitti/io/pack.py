@@ -0,0 +1,64 @@
+import os
+
+import numpy as np
+from tqdm import tqdm
+
+from ._label import _read_labels_arrays
+from ._packed import _write_container, default_packed_path, register_packed
+from .calib import _calib_path, _parse_calib_file, _calibs_to_row
+from .image_info import _ImageInfoCache
+
+
+def _list_imgids(kitti_root: str, split: str, modality: str = 'calib'):
+    names = os.listdir(os.path.join(kitti_root, 'object', split, modality))
+    return sorted(int(os.path.splitext(name)[0]) for name in names if not name.startswith('.'))
+
+
+def pack_split(kitti_root: str, split: str, out_path: str = None, include_velodyne: bool = False):
+    """
+    Pack calibs, image shapes, label_2/label_3 and velodyne offsets of a whole split into a single file.
+    Once packed, load_calib, load_label_2, load_label_3, load_image_info and load_velodyne read from one
+    memory-mapped file instead of opening and parsing a small file per call.
+    :param kitti_root:
+    :param split:
+    :param out_path: default kitti_root/object/{split}.dlpack, which is picked up automatically.
+                     Other paths need register_packed in every process that reads them.
+    :param include_velodyne: also pack velodyne points, this makes the file as large as the velodyne directory.
+    :return: out_path
+    """
+    if out_path is None:
+        out_path = default_packed_path(kitti_root, split)
+    ids = _list_imgids(kitti_root, split)
+    specs = {'ids': np.array(ids, dtype=np.int64)}
+
+    calibs = np.zeros((len(ids), 7, 12), dtype=np.float64)
+    for i, imgid in enumerate(tqdm(ids, desc='calib', leave=False)):
+        calibs[i] = _calibs_to_row(_parse_calib_file(_calib_path(kitti_root, split, imgid)))
+    specs['calib'] = calibs
+
+    image_info = _ImageInfoCache.get_instance(kitti_root, split)
+    specs['image_shape'] = np.array([image_info.get(imgid) for imgid in ids], dtype=np.int32).reshape(len(ids), 3)
+
+    for view in (2, 3):
+        if not os.path.isdir(os.path.join(kitti_root, 'object', split, f'label_{view}')):
+            continue
+        arrays, counts = _read_labels_arrays(kitti_root, split, ids, view)
+        offsets = np.zeros((len(ids) + 1,), dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        specs[f'label_{view}/offsets'] = offsets
+        for k, v in arrays.items():
+            specs[f'label_{view}/{k}'] = v
+
+    velodyne_dir = os.path.join(kitti_root, 'object', split, 'velodyne')
+    if os.path.isdir(velodyne_dir):
+        paths = [os.path.join(velodyne_dir, '%06d.bin' % imgid) for imgid in ids]
+        offsets = np.zeros((len(ids) + 1,), dtype=np.int64)
+        np.cumsum([os.path.getsize(p) // 16 for p in paths], out=offsets[1:])
+        specs['velodyne/offsets'] = offsets
+        if include_velodyne:
+            chunks = (np.fromfile(p, dtype=np.float32).reshape(-1, 4) for p in tqdm(paths, desc='velodyne', leave=False))
+            specs['velodyne/points'] = (np.float32, (int(offsets[-1]), 4), chunks)
+
+    _write_container(out_path, specs, {'kitti_root': os.path.abspath(kitti_root), 'split': split})
+    register_packed(kitti_root, split, out_path)
+    return out_path
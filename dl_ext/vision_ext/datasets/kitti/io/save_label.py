@@ -0,0 +1,131 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Sequence, Union
+
+import numpy as np
+
+from ._label import _empty_label_arrays
+from ._packed import _write_container
+from ..structures.kitti_object_3d import KITTIObject3D
+from ..structures.kitti_objects import KITTIObjects
+
+
+def _to_kitti_objects(objects) -> KITTIObjects:
+    """
+    :param objects: KITTIObjects, columnar label arrays (see load_label_2_arrays) or list of KITTIObject3D
+    """
+    if isinstance(objects, KITTIObjects):
+        return objects
+    if isinstance(objects, dict):
+        return KITTIObjects.from_arrays(objects)
+    return KITTIObjects.from_objects(objects)
+
+
+def _label_file(out_dir: str, imgid: Union[str, int]):
+    if not isinstance(imgid, str):
+        imgid = '%06d' % imgid
+    return os.path.join(out_dir, imgid + '.txt')
+
+
+def save_label(out_dir: str, imgid: Union[str, int], objects: Union[KITTIObjects, dict, List[KITTIObject3D]]):
+    """
+    Write objects to out_dir/{imgid}.txt in kitti format, with a score column if objects have scores.
+    Floats are written exactly (shortest float32 repr), files are read back unchanged by load_label_2_arrays.
+    :param out_dir:
+    :param imgid:
+    :param objects: KITTIObjects, columnar label arrays or list of KITTIObject3D
+    :return: path of the written file
+    """
+    path = _label_file(out_dir, imgid)
+    content = _to_kitti_objects(objects).to_lines()
+    with open(path, 'w') as f:
+        f.write(content)
+    return path
+
+
+class KITTILabelWriter:
+    """
+    Write label files from a thread pool while the caller keeps running inference.
+    Example:
+        >>> with KITTILabelWriter('output/data', packed_path='output/results.dlpack') as writer:
+        >>>     for imgid, objects in predictions:
+        >>>         writer.write(imgid, objects)
+    """
+
+    def __init__(self, out_dir: str, num_workers=4, packed_path: str = None):
+        """
+        :param out_dir: directory of the txt files, None to only write the packed file
+        :param num_workers: number of writing threads
+        :param packed_path: also write all labels to one packed file, read by PackedSplit
+                            (ids, label_2/offsets and label_2 columns, as pack_split) and by eval.evaluate
+        """
+        assert out_dir is not None or packed_path is not None
+        if out_dir is not None:
+            os.makedirs(out_dir, exist_ok=True)
+        self.out_dir = out_dir
+        self.packed_path = packed_path
+        self._executor = ThreadPoolExecutor(num_workers) if out_dir is not None else None
+        self._futures = []
+        self._packed = {}
+
+    def write(self, imgid: Union[str, int], objects: Union[KITTIObjects, dict, List[KITTIObject3D]]):
+        objects = _to_kitti_objects(objects)
+        if self._executor is not None:
+            self._futures.append(self._executor.submit(save_label, self.out_dir, imgid, objects))
+            # surface errors early and keep the list of pending writes short
+            while self._futures and self._futures[0].done():
+                self._futures.pop(0).result()
+        if self.packed_path is not None:
+            self._packed[int(imgid)] = objects
+
+    def close(self):
+        if self._executor is not None:
+            for f in self._futures:
+                f.result()
+            self._futures = []
+            self._executor.shutdown()
+            self._executor = None
+        if self.packed_path is not None:
+            self._write_packed()
+
+    def _write_packed(self):
+        ids = sorted(self._packed)
+        objects = [self._packed[imgid] for imgid in ids]
+        has_score = any(o.has_score for o in objects)
+        if any(o.has_score != has_score for o in objects if len(o) > 0):
+            raise ValueError('labels with and without scores can not be packed together')
+        specs = {'ids': np.array(ids, dtype=np.int64)}
+        offsets = np.zeros((len(ids) + 1,), dtype=np.int64)
+        np.cumsum([len(o) for o in objects], out=offsets[1:])
+        specs['label_2/offsets'] = offsets
+        records = [o.records for o in objects if len(o) > 0]
+        if records:
+            arrays = KITTIObjects(np.concatenate(records)).to_arrays()
+        else:
+            arrays = _empty_label_arrays(has_score)
+        for k, v in arrays.items():
+            specs[f'label_2/{k}'] = v
+        _write_container(self.packed_path, specs, {'results': True})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def save_labels_bulk(out_dir: str, imgids: Sequence[Union[str, int]],
+                     objects: Sequence[Union[KITTIObjects, dict, List[KITTIObject3D]]],
+                     num_workers=8, packed_path: str = None):
+    """
+    save_label for many images, files are written by a thread pool.
+    :param out_dir: None to only write the packed file
+    :param imgids:
+    :param objects: per image, KITTIObjects, columnar label arrays or list of KITTIObject3D
+    :param num_workers:
+    :param packed_path: also write all labels to one packed file, see KITTILabelWriter
+    """
+    assert len(imgids) == len(objects)
+    with KITTILabelWriter(out_dir, num_workers, packed_path) as writer:
+        for imgid, o in zip(imgids, objects):
+            writer.write(imgid, o)
@@ -0,0 +1,253 @@
+"""
+Readers of kitti raw and tracking sequences, which share one calibration and have oxts poses per frame.
+kitti raw:
+    raw_root
+        --2011_09_26
+            --calib_cam_to_cam.txt
+            --calib_velo_to_cam.txt
+            --calib_imu_to_velo.txt
+            --2011_09_26_drive_0001_sync
+                --image_02/data/0000000000.png
+                --image_03/data/0000000000.png
+                --velodyne_points/data/0000000000.bin
+                --oxts/data/0000000000.txt
+kitti tracking:
+    tracking_root
+        --training
+            --calib/0000.txt
+            --image_02/0000/000000.png
+            --image_03/0000/000000.png
+            --velodyne/0000/000000.bin
+            --oxts/0000.txt
+            --label_02/0000.txt
+Example:
+    >>> seq = KITTIRawSequence(RAWROOT, '2011_09_26', 1, ('image_02', 'velodyne'))
+    >>> for frames in seq.windows(3):
+    >>>     imgs = [f['image_02'] for f in frames]
+    >>>     poses = [f['pose'] for f in frames]
+"""
+import os
+from typing import Sequence, Union
+
+import numpy as np
+from PIL import Image
+
+from ._label import _parse_label_text, _empty_label_arrays
+from .frame_reader import KITTIFrameReader
+from .image_info import read_image_shape
+from ..structures.calib import Calibration
+
+_EARTH_RADIUS = 6378137.0
+
+
+def _parse_key_values(path: str):
+    """
+    Lines of 'key: values' or 'key values', lines whose values are not all numbers are skipped.
+    """
+    values = {}
+    with open(path) as f:
+        for line in f:
+            tokens = line.replace(':', ' ', 1).split()
+            if len(tokens) < 2:
+                continue
+            try:
+                values[tokens[0]] = np.array(tokens[1:], dtype=np.float64)
+            except ValueError:
+                continue
+    return values
+
+
+def _rigid(R, T):
+    return np.concatenate((R.reshape(3, 3), T.reshape(3, 1)), axis=1)
+
+
+def load_raw_calib(raw_root: str, date: str):
+    """
+    :param raw_root:
+    :param date: e.g. 2011_09_26
+    :return: Calibration of the rectified cameras of the day
+    """
+    cam = _parse_key_values(os.path.join(raw_root, date, 'calib_cam_to_cam.txt'))
+    velo = _parse_key_values(os.path.join(raw_root, date, 'calib_velo_to_cam.txt'))
+    imu = _parse_key_values(os.path.join(raw_root, date, 'calib_imu_to_velo.txt'))
+    calibs = {f'P{i}': cam[f'P_rect_0{i}'].reshape(3, 4) for i in range(4)}
+    calibs['R0_rect'] = cam['R_rect_00'].reshape(3, 3)
+    calibs['Tr_velo_to_cam'] = _rigid(velo['R'], velo['T'])
+    calibs['Tr_imu_to_velo'] = _rigid(imu['R'], imu['T'])
+    width, height = cam['S_rect_02'].astype(int).tolist()
+    return Calibration(calibs, (width, height))
+
+
+def load_tracking_calib(tracking_root: str, split: str, seq: int, image_size=None):
+    """
+    :param tracking_root:
+    :param split:
+    :param seq:
+    :param image_size: width, height, default read from the header of the first image_02 of the sequence
+    :return: Calibration of the sequence
+    """
+    values = _parse_key_values(os.path.join(tracking_root, split, 'calib', '%04d.txt' % seq))
+    calibs = {f'P{i}': values[f'P{i}'].reshape(3, 4) for i in range(4)}
+    calibs['R0_rect'] = values['R_rect'].reshape(3, 3)
+    calibs['Tr_velo_to_cam'] = values['Tr_velo_cam'].reshape(3, 4)
+    calibs['Tr_imu_to_velo'] = values['Tr_imu_velo'].reshape(3, 4)
+    if image_size is None:
+        image_dir = os.path.join(tracking_root, split, 'image_02', '%04d' % seq)
+        H, W, _ = read_image_shape(os.path.join(image_dir, min(os.listdir(image_dir))))
+        image_size = (W, H)
+    return Calibration(calibs, image_size)
+
+
+def oxts_to_poses(oxts: np.ndarray):
+    """
+    Poses of the imu from oxts packets, mercator projection scaled at the latitude of the first packet,
+    translated so that the first pose is at the origin.
+    :param oxts: (N, 30) lat, lon, alt, roll, pitch, yaw, ...
+    :return: (N, 4, 4) imu to world
+    """
+    lat, lon, alt, roll, pitch, yaw = (oxts[:, i] for i in range(6))
+    scale = np.cos(lat[0] * np.pi / 180.)
+    t = np.stack((scale * _EARTH_RADIUS * lon * np.pi / 180.,
+                  scale * _EARTH_RADIUS * np.log(np.tan((90. + lat) * np.pi / 360.)),
+                  alt), axis=1)
+    t -= t[:1]
+    cr, sr, cp, sp, cy, sy = np.cos(roll), np.sin(roll), np.cos(pitch), np.sin(pitch), np.cos(yaw), np.sin(yaw)
+    # Rz(yaw) @ Ry(pitch) @ Rx(roll)
+    R = np.stack((np.stack((cy * cp, cy * sp * sr - sy * cr, cy * sp * cr + sy * sr), axis=1),
+                  np.stack((sy * cp, sy * sp * sr + cy * cr, sy * sp * cr - cy * sr), axis=1),
+                  np.stack((-sp, cp * sr, cp * cr), axis=1)), axis=1)
+    poses = np.zeros((oxts.shape[0], 4, 4), dtype=np.float64)
+    poses[:, :3, :3] = R
+    poses[:, :3, 3] = t
+    poses[:, 3, 3] = 1
+    return poses
+
+
+def _load_image(path):
+    img = Image.open(path)
+    img.load()  # PIL decodes lazily, force decoding in the worker thread
+    return img
+
+
+def _load_velodyne(path):
+    return np.fromfile(path, dtype=np.float32).reshape(-1, 4)
+
+
+def _parse_tracking_labels(text: str):
+    """
+    :return: frame (N,), columnar labels with an extra track_id column, see _load_label_i_arrays
+    """
+    lines = [l.split() for l in text.splitlines() if l.strip()]
+    if len(lines) == 0:
+        arrays = _empty_label_arrays()
+        arrays['track_id'] = np.zeros((0,), dtype=np.int32)
+        return np.zeros((0,), dtype=np.int64), arrays
+    frame = np.array([int(l[0]) for l in lines], dtype=np.int64)
+    arrays = _parse_label_text('\n'.join(' '.join(l[2:]) for l in lines))
+    arrays['track_id'] = np.array([int(l[1]) for l in lines], dtype=np.int32)
+    return frame, arrays
+
+
+class _SequenceReader(KITTIFrameReader):
+    """
+    A KITTIFrameReader over the frames of one sequence, frames are dicts with key 'frame',
+    one key per modality, 'calib' (the Calibration shared by the whole sequence) and 'pose' if oxts are available.
+    """
+    index_key = 'frame'
+
+    def __init__(self, frames, modalities, prefetch, num_workers):
+        super().__init__(None, None, frames, modalities, prefetch, num_workers)
+        self.poses = oxts_to_poses(self.oxts) if self.oxts is not None and len(self.oxts) > 0 else None
+
+    def _load(self, modality, frame):
+        return self.loaders[modality](self, frame)
+
+    def __iter__(self):
+        for frame in super().__iter__():
+            frame['calib'] = self.calib
+            if self.poses is not None:
+                frame['pose'] = self.poses[frame['frame']]
+            yield frame
+
+
+class KITTIRawSequence(_SequenceReader):
+    loaders = {'image_02': lambda self, i: _load_image(self._path('image_02', i, '.png')),
+               'image_03': lambda self, i: _load_image(self._path('image_03', i, '.png')),
+               'velodyne': lambda self, i: _load_velodyne(self._path('velodyne_points', i, '.bin')),
+               'oxts': lambda self, i: self.oxts[i]}
+
+    def __init__(self, raw_root: str, date: str, drive: Union[str, int], modalities=('image_02', 'velodyne'),
+                 frames: Sequence[int] = None, prefetch=8, num_workers=4):
+        """
+        :param raw_root:
+        :param date: e.g. 2011_09_26
+        :param drive: e.g. 1 or '0001'
+        :param modalities: subset of image_02, image_03, velodyne, oxts
+        :param frames: default all frames of the drive
+        :param prefetch: number of frames loaded ahead of the consumer
+        :param num_workers: number of loading threads
+        """
+        if not isinstance(drive, str):
+            drive = '%04d' % drive
+        self.drive_dir = os.path.join(raw_root, date, f'{date}_drive_{drive}_sync')
+        self.calib = load_raw_calib(raw_root, date)
+        oxts_dir = os.path.join(self.drive_dir, 'oxts', 'data')
+        if os.path.isdir(oxts_dir):
+            self.oxts = np.stack([np.loadtxt(os.path.join(oxts_dir, name)) for name in sorted(os.listdir(oxts_dir))])
+        else:
+            self.oxts = None
+        if frames is None:
+            frames = list(range(len(os.listdir(os.path.join(self.drive_dir, 'image_02', 'data')))))
+        super().__init__(frames, modalities, prefetch, num_workers)
+
+    def _path(self, modality, frame, ext):
+        return os.path.join(self.drive_dir, modality, 'data', '%010d' % frame + ext)
+
+
+class KITTITrackingSequence(_SequenceReader):
+    loaders = {'image_02': lambda self, i: _load_image(self._path('image_02', i, '.png')),
+               'image_03': lambda self, i: _load_image(self._path('image_03', i, '.png')),
+               'velodyne': lambda self, i: _load_velodyne(self._path('velodyne', i, '.bin')),
+               'oxts': lambda self, i: self.oxts[i],
+               'label_02': lambda self, i: self.labels(i)}
+
+    def __init__(self, tracking_root: str, split: str, seq: int, modalities=('image_02', 'velodyne', 'label_02'),
+                 frames: Sequence[int] = None, prefetch=8, num_workers=4):
+        """
+        :param tracking_root:
+        :param split: training or testing
+        :param seq: sequence id
+        :param modalities: subset of image_02, image_03, velodyne, oxts, label_02
+        :param frames: default all frames of the sequence
+        :param prefetch: number of frames loaded ahead of the consumer
+        :param num_workers: number of loading threads
+        """
+        self.split_dir = os.path.join(tracking_root, split)
+        self.seq = seq
+        self.calib = load_tracking_calib(tracking_root, split, seq)
+        oxts_path = os.path.join(self.split_dir, 'oxts', '%04d.txt' % seq)
+        self.oxts = np.loadtxt(oxts_path, ndmin=2) if os.path.exists(oxts_path) else None
+        label_path = os.path.join(self.split_dir, 'label_02', '%04d.txt' % seq)
+        if os.path.exists(label_path):
+            with open(label_path) as f:
+                label_frames, arrays = _parse_tracking_labels(f.read())
+            order = np.argsort(label_frames, kind='stable')
+            self._label_frames = label_frames[order]
+            self._label_arrays = {k: v[order] for k, v in arrays.items()}
+        else:
+            self._label_frames = None
+        if frames is None:
+            frames = list(range(len(os.listdir(os.path.join(self.split_dir, 'image_02', '%04d' % seq)))))
+        super().__init__(frames, modalities, prefetch, num_workers)
+
+    def _path(self, modality, frame, ext):
+        return os.path.join(self.split_dir, modality, '%04d' % self.seq, '%06d' % frame + ext)
+
+    def labels(self, frame: int):
+        """
+        :return: columnar labels of the frame with an extra (N,) int32 track_id, see load_label_2_arrays
+        """
+        if self._label_frames is None:
+            raise FileNotFoundError(os.path.join(self.split_dir, 'label_02', '%04d.txt' % self.seq))
+        begin, end = np.searchsorted(self._label_frames, [frame, frame + 1])
+        return {k: v[begin:end] for k, v in self._label_arrays.items()}
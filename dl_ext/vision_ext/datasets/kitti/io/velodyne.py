@@ -2,10 +2,62 @@ import os.path as osp
 import os
 import numpy as np
 
+from ._packed import _packed_row
+from ..structures.calib import Calibration
 
-def load_velodyne(kitti_root, split, imgid):
+
+def load_velodyne(kitti_root, split, imgid, mmap=False):
+    """
+    :param kitti_root:
+    :param split:
+    :param imgid:
+    :param mmap: return a read-only memory-mapped (N, 4) view instead of reading the scan into a new array.
+    :return:
+    """
+    packed, row = _packed_row(kitti_root, split, imgid)
+    if packed is not None and 'velodyne/points' in packed:
+        offsets = packed['velodyne/offsets']
+        points = packed['velodyne/points'][offsets[row]:offsets[row + 1]]
+        return points if mmap else np.array(points)
     if not isinstance(imgid, str):
         imgid = '%06d' % imgid
     velodyne_dir = os.path.join(kitti_root, 'object', split, 'velodyne')
-    velodyne = np.fromfile(osp.join(velodyne_dir, imgid + '.bin'), dtype=np.float32).reshape(-1, 4)
+    path = osp.join(velodyne_dir, imgid + '.bin')
+    if mmap:
+        return np.memmap(path, dtype=np.float32, mode='r').reshape(-1, 4)
+    velodyne = np.fromfile(path, dtype=np.float32).reshape(-1, 4)
     return velodyne
+
+
+def load_velodyne_fov(kitti_root, split, imgid, calib: Calibration, chunk_size=32768, return_intensity=False):
+    """
+    Load velodyne points inside the field of view of image_2, in rect coordinate.
+    Equivalent to calib.lidar_to_rect followed by calib.filter_fov_pts, but the scan is memory-mapped
+    and transformed chunk by chunk so that only the points in fov are materialized.
+    :param kitti_root:
+    :param split:
+    :param imgid:
+    :param calib:
+    :param chunk_size: number of points transformed at once
+    :param return_intensity: append the intensity as the 4th column
+    :return: (M, 3) or (M, 4) float32
+    """
+    velodyne = load_velodyne(kitti_root, split, imgid, mmap=True)
+    V2R = calib.numpy_affine('V2R', np.float32)  # 3 x 4
+    P2 = calib.numpy_affine('P2', np.float32)
+    keeps = []
+    for begin in range(0, velodyne.shape[0], chunk_size):
+        chunk = np.asarray(velodyne[begin:begin + chunk_size])
+        pts_rect = chunk[:, :3] @ V2R[:, :3].T + V2R[:, 3]
+        pts_2d = pts_rect @ P2[:, :3].T + P2[:, 3]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            u = pts_2d[:, 0] / pts_rect[:, 2]
+            v = pts_2d[:, 1] / pts_rect[:, 2]
+        keep = (u >= 0) & (u < calib.width) & (v >= 0) & (v < calib.height) & (pts_2d[:, 2] - P2[2, 3] >= 0)
+        if return_intensity:
+            keeps.append(np.concatenate((pts_rect[keep], chunk[keep, 3:4]), axis=1))
+        else:
+            keeps.append(pts_rect[keep])
+    if len(keeps) == 0:
+        return np.zeros((0, 4 if return_intensity else 3), dtype=np.float32)
+    return np.concatenate(keeps, axis=0)
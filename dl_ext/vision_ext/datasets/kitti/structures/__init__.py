@@ -1,2 +1,6 @@
 from .calib import Calibration
-from .kitti_object_3d import KITTIObjectClass, KITTIObject3D
+from .batched_calib import BatchedCalibration
+from .kitti_object_3d import KITTIObjectClass, KITTIObject3D, KITTIObject3DSlots
+from .kitti_objects import KITTIObjects
+from .box3d import boxes3d_from_arrays, boxes3d_to_bev, boxes3d_to_corners, bev_to_corners, \
+    box2d_iou, bev_iou, box3d_iou, points_in_boxes3d, rotated_nms
@@ -0,0 +1,236 @@
+from typing import Sequence
+
+import numpy as np
+import torch
+
+from .calib import Calibration, _pixel_grid, _compact_depth_maps, _dtype_name, _depth_buffer
+
+
+class BatchedCalibration:
+    """
+    Calibrations of B frames stacked into (B, 3, 4) / (B, 3, 3) tensors, so that points of a whole batch
+    are transformed with one batched matmul instead of one Calibration call per frame.
+    Points are either padded, shape (B, N, 3), or ragged, shape (N_total, 3) together with
+    offsets (B + 1,) such that points of frame b are pts[offsets[b]:offsets[b + 1]].
+    Inputs are cast to the dtype of the matrices, which is the dtype of the results.
+    """
+
+    def __init__(self, calibs: Sequence[Calibration], device='cpu', dtype=torch.float32):
+        def stack(name):
+            return torch.as_tensor(np.stack([getattr(c, name) for c in calibs]), dtype=dtype, device=device)
+
+        self.P2 = stack('P2')  # B x 3 x 4
+        self.P3 = stack('P3')  # B x 3 x 4
+        self.R0 = stack('R0')  # B x 3 x 3
+        self.V2C = stack('V2C')  # B x 3 x 4
+        self.C2V = stack('C2V')  # B x 3 x 4
+        self.I2V = stack('I2V')  # B x 3 x 4
+        self.V2I = stack('V2I')  # B x 3 x 4
+        self.size = torch.as_tensor([c.size for c in calibs], device=device)  # B x 2, width, height
+        self.V2R = torch.as_tensor(np.stack([c.affine('V2R') for c in calibs]), dtype=dtype,
+                                   device=device)  # B x 3 x 4, lidar to rect
+        self.R2V = torch.as_tensor(np.stack([c.affine('R2V') for c in calibs]), dtype=dtype,
+                                   device=device)  # B x 3 x 4, rect to lidar
+
+    def __len__(self):
+        return self.P2.shape[0]
+
+    def to(self, device=None, dtype=None):
+        for k, v in vars(self).items():
+            if isinstance(v, torch.Tensor):
+                setattr(self, k, v.to(device=device, dtype=dtype if v.is_floating_point() else None))
+        return self
+
+    @property
+    def cu(self):
+        return self.P2[:, 0, 2]
+
+    @property
+    def cv(self):
+        return self.P2[:, 1, 2]
+
+    @property
+    def fu(self):
+        return self.P2[:, 0, 0]
+
+    @property
+    def fv(self):
+        return self.P2[:, 1, 1]
+
+    @property
+    def tx(self):
+        return self.P2[:, 0, 3] / (-self.fu)
+
+    @property
+    def ty(self):
+        return self.P2[:, 1, 3] / (-self.fv)
+
+    @property
+    def width(self):
+        return self.size[:, 0]
+
+    @property
+    def height(self):
+        return self.size[:, 1]
+
+    @staticmethod
+    def batch_index(offsets, device=None):
+        """
+        :param offsets: (B + 1,)
+        :return: (N_total,) index of the frame of each point
+        """
+        offsets = torch.as_tensor(offsets, device=device)
+        counts = offsets[1:] - offsets[:-1]
+        return torch.repeat_interleave(torch.arange(counts.shape[0], device=offsets.device), counts)
+
+    def _cast(self, x):
+        return x.to(self.P2.dtype)
+
+    def _per_point(self, x, pts, offsets):
+        """
+        Expand a per-frame tensor x (B, ...) to match pts: (B, 1, ...) for padded, (N_total, ...) for ragged.
+        """
+        if offsets is None:
+            return x.unsqueeze(1)
+        return x[self.batch_index(offsets, device=pts.device)]
+
+    def _affine(self, mats, pts, offsets=None):
+        """
+        :param mats: (B, 3, 4)
+        :param pts: (B, N, 3) or (N_total, 3)
+        :return: pts @ mats[..., :3].T + mats[..., 3]
+        """
+        if offsets is None:
+            return torch.baddbmm(mats[:, None, :, 3], pts, mats[:, :, :3].transpose(1, 2))
+        mats = self._per_point(mats, pts, offsets)
+        return torch.bmm(mats[:, :, :3], pts.unsqueeze(-1)).squeeze(-1) + mats[:, :, 3]
+
+    def lidar_to_rect(self, pts_lidar, offsets=None):
+        """
+        :param pts_lidar: (B, N, 3) or (N_total, 3)
+        :param offsets: None for padded points, (B + 1,) for ragged points
+        :return pts_rect: same shape as pts_lidar
+        """
+        return self._affine(self.V2R, self._cast(pts_lidar[..., :3]), offsets)
+
+    def rect_to_lidar(self, pts_rect, offsets=None):
+        return self._affine(self.R2V, self._cast(pts_rect), offsets)
+
+    def rect_to_img(self, pts_rect, offsets=None):
+        """
+        :param pts_rect: (B, N, 3) or (N_total, 3)
+        :param offsets: None for padded points, (B + 1,) for ragged points
+        :return pts_img: (B, N, 2) or (N_total, 2), pts_rect_depth: (B, N) or (N_total,)
+        """
+        pts_rect = self._cast(pts_rect)
+        pts_2d_hom = self._affine(self.P2, pts_rect, offsets)
+        pts_img = pts_2d_hom[..., 0:2] / pts_rect[..., 2:3]
+        pts_rect_depth = pts_2d_hom[..., 2] - self._per_point(self.P2[:, 2, 3], pts_rect, offsets)
+        return pts_img, pts_rect_depth
+
+    def lidar_to_img(self, pts_lidar, offsets=None):
+        pts_rect = self.lidar_to_rect(pts_lidar, offsets)
+        return self.rect_to_img(pts_rect, offsets)
+
+    def lidar_to_depth_maps(self, pts_lidar, offsets=None, size=None):
+        """
+        Sparse depth maps of the lidar points of each frame, keeping the nearest depth per pixel.
+        :param pts_lidar: (B, N, 3+) or (N_total, 3+)
+        :param offsets: None for padded points, (B + 1,) for ragged points
+        :param size: width, height of the depth maps, pixels are scaled as in Calibration.resize.
+                     Default the image size, which then must be the same for all frames.
+        :return: (B, H, W), 0 where there is no point
+        """
+        pts_img, depth = self.lidar_to_img(pts_lidar[..., :3], offsets)
+        if size is None:
+            if not bool((self.size == self.size[0]).all()):
+                raise ValueError('image sizes differ in the batch, size must be given')
+            size = self.size[0].tolist()
+        width, height = map(int, size)
+        scale = torch.stack((width / self.width, height / self.height), dim=1).to(pts_img.dtype)
+        pts_img = pts_img * self._per_point(scale, pts_img, offsets)
+        if offsets is None:
+            b = torch.arange(depth.shape[0], device=depth.device)[:, None].expand_as(depth).reshape(-1)
+            pts_img, depth = pts_img.reshape(-1, 2), depth.reshape(-1)
+        else:
+            b = self.batch_index(offsets, device=depth.device)
+        return _depth_buffer(pts_img[:, 0], pts_img[:, 1], depth, b, len(self), width, height)
+
+    def img_to_rect(self, u, v, depth_rect, offsets=None):
+        """
+        :param u: (B, N) or (N_total,)
+        :param v: (B, N) or (N_total,)
+        :param depth_rect: (B, N) or (N_total,)
+        :param offsets: None for padded points, (B + 1,) for ragged points
+        :return: pts_rect: (B, N, 3) or (N_total, 3)
+        """
+        u, v, depth_rect = self._cast(u), self._cast(v), self._cast(depth_rect)
+        if offsets is None:
+            cu, cv, fu, fv, tx, ty = (x[:, None] for x in (self.cu, self.cv, self.fu, self.fv, self.tx, self.ty))
+        else:
+            index = self.batch_index(offsets, device=u.device)
+            cu, cv, fu, fv, tx, ty = (x[index] for x in (self.cu, self.cv, self.fu, self.fv, self.tx, self.ty))
+        x = ((u - cu) * depth_rect) / fu + tx
+        y = ((v - cv) * depth_rect) / fv + ty
+        return torch.stack((x, y, depth_rect), dim=-1)
+
+    def depth_map_to_rect(self, depth_maps):
+        """
+        :param depth_maps: (B, H, W)
+        :return: pts_rect(B, H*W, 3), x_idxs(H*W), y_idxs(H*W)
+        """
+        B, H, W = depth_maps.shape
+        device = depth_maps.device
+        y_idxs, x_idxs = torch.meshgrid(torch.arange(H, device=device), torch.arange(W, device=device),
+                                        indexing='ij')
+        x_idxs, y_idxs = x_idxs.reshape(-1), y_idxs.reshape(-1)
+        depth = depth_maps.reshape(B, H * W)
+        u = x_idxs.to(depth.dtype).expand(B, -1)
+        v = y_idxs.to(depth.dtype).expand(B, -1)
+        pts_rect = self.img_to_rect(u, v, depth)
+        return pts_rect, x_idxs, y_idxs
+
+    def depth_maps_to_points(self, depth_maps, mask=None, min_depth=0, max_depth=None, stride=1,
+                             return_pixels=False):
+        """
+        Back-project the valid pixels of the depth maps of each frame with its own intrinsics.
+        :param depth_maps: (B, H, W)
+        :param mask: bool (B, H, W), False pixels are dropped
+        :param min_depth: pixels with depth <= min_depth are dropped
+        :param max_depth: pixels with depth > max_depth are dropped
+        :param stride: keep one pixel every stride pixels in both directions
+        :param return_pixels: also return (u, v) of each point
+        :return: pts_rect (M, 3), offsets (B + 1,), [pixels (M, 2)]
+        """
+        _, H, W = depth_maps.shape
+        depth, b, p, offsets = _compact_depth_maps(depth_maps, _dtype_name(self.P2.dtype), mask,
+                                                   min_depth, max_depth, stride)
+        pixels, _ = _pixel_grid(H, W, stride, depth)
+        d = depth[b, p]
+        uv = pixels[p]
+        pts_rect = self.img_to_rect(uv[:, 0], uv[:, 1], d, offsets)
+        if return_pixels:
+            return pts_rect, offsets, uv
+        return pts_rect, offsets
+
+    def disparity_map_to_depth_map(self, disparity_maps, epsilon=1e-6):
+        stereo_baseline = self.P2[:, 0, 3] - self.P3[:, 0, 3]
+        return stereo_baseline[:, None, None] / (self._cast(disparity_maps) + epsilon)
+
+    def corners3d_to_img_boxes(self, corners3d, offsets=None):
+        """
+        :param corners3d: (B, N, 8, 3) or (N_total, 8, 3) corners in rect coordinate
+        :param offsets: None for padded boxes, (B + 1,) for ragged boxes
+        :return: boxes: (B, N, 4) or (N_total, 4) [x1, y1, x2, y2] in rgb coordinate
+        :return: boxes_corner: (B, N, 8, 2) or (N_total, 8, 2) [xi, yi] in rgb coordinate
+        """
+        corners3d = self._cast(corners3d)
+        if offsets is None:
+            B, N = corners3d.shape[:2]
+            img_pts = self._affine(self.P2, corners3d.reshape(B, N * 8, 3)).reshape(B, N, 8, 3)
+        else:
+            P2 = self._per_point(self.P2, corners3d, offsets)  # N_total x 3 x 4
+            img_pts = corners3d @ P2[:, :, :3].transpose(1, 2) + P2[:, None, :, 3]
+        boxes_corner = img_pts[..., 0:2] / img_pts[..., 2:3]
+        boxes = torch.cat((boxes_corner.min(dim=-2).values, boxes_corner.max(dim=-2).values), dim=-1)
+        return boxes, boxes_corner
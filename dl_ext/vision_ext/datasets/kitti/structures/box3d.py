@@ -0,0 +1,293 @@
+"""
+Vectorized 3D box operations in kitti rect camera coordinate (x right, y down, z forward).
+A box3d is (x, y, z, h, w, l, ry) where (x, y, z) is the bottom center, as in KITTIObject3D.
+A bev box is (x, z, l, w, ry), the footprint of a box3d on the x-z plane.
+Every function accepts numpy arrays or torch tensors and returns the same type.
+"""
+from functools import wraps
+
+import numpy as np
+import torch
+
+
+def _numpy_compatible(fn):
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        is_numpy = any(isinstance(a, np.ndarray) for a in args)
+        args = [torch.from_numpy(np.ascontiguousarray(a)) if isinstance(a, np.ndarray) else a for a in args]
+        out = fn(*args, **kwargs)
+        if not is_numpy:
+            return out
+        if isinstance(out, tuple):
+            return tuple(o.cpu().numpy() for o in out)
+        return out.cpu().numpy()
+
+    return wrapper
+
+
+def boxes3d_from_arrays(arrays):
+    """
+    :param arrays: columnar labels, see load_label_2_arrays
+    :return: (N, 7) float32 x, y, z, h, w, l, ry
+    """
+    return np.concatenate((arrays['loc'], arrays['dims'], arrays['ry'][:, None]), axis=1).astype(np.float32)
+
+
+@_numpy_compatible
+def boxes3d_to_bev(boxes3d):
+    """
+    :param boxes3d: (N, 7)
+    :return: (N, 5) x, z, l, w, ry
+    """
+    return boxes3d[:, [0, 2, 5, 4, 6]]
+
+
+@_numpy_compatible
+def boxes3d_to_corners(boxes3d):
+    """
+    :param boxes3d: (N, 7)
+    :return: (N, 8, 3) corners in rect coordinate, 0-3 are the bottom face, 4-7 the top face.
+    """
+    h, w, l, ry = boxes3d[:, 3:4], boxes3d[:, 4:5], boxes3d[:, 5:6], boxes3d[:, 6:7]
+    zeros = torch.zeros_like(h)
+    x_corners = torch.cat([l / 2, l / 2, -l / 2, -l / 2] * 2, dim=1)
+    y_corners = torch.cat([zeros] * 4 + [-h] * 4, dim=1)
+    z_corners = torch.cat([w / 2, -w / 2, -w / 2, w / 2] * 2, dim=1)
+    c, s = torch.cos(ry), torch.sin(ry)
+    x = c * x_corners + s * z_corners + boxes3d[:, 0:1]
+    y = y_corners + boxes3d[:, 1:2]
+    z = -s * x_corners + c * z_corners + boxes3d[:, 2:3]
+    return torch.stack((x, y, z), dim=2)
+
+
+@_numpy_compatible
+def bev_to_corners(bev):
+    """
+    :param bev: (N, 5) x, z, l, w, ry
+    :return: (N, 4, 2) corners (x, z) in the same order as the bottom face of boxes3d_to_corners.
+    """
+    l, w, ry = bev[:, 2:3], bev[:, 3:4], bev[:, 4:5]
+    x_corners = torch.cat([l / 2, l / 2, -l / 2, -l / 2], dim=1)
+    z_corners = torch.cat([w / 2, -w / 2, -w / 2, w / 2], dim=1)
+    c, s = torch.cos(ry), torch.sin(ry)
+    x = c * x_corners + s * z_corners + bev[:, 0:1]
+    z = -s * x_corners + c * z_corners + bev[:, 1:2]
+    return torch.stack((x, z), dim=2)
+
+
+def _cross(a, b):
+    return a[..., 0] * b[..., 1] - a[..., 1] * b[..., 0]
+
+
+def _convex_intersection_area(ca, cb, eps=1e-8):
+    """
+    Intersection area of pairs of rectangles.
+    :param ca: (K, 4, 2) corners in order
+    :param cb: (K, 4, 2)
+    :return: (K,)
+    """
+
+    def inside(pts, rect):
+        # pts (K, P, 2) inside rect (K, 4, 2)
+        origin = rect[:, None, 0]
+        ab = (rect[:, 1] - rect[:, 0])[:, None]
+        ad = (rect[:, 3] - rect[:, 0])[:, None]
+        ap = pts - origin
+        p_ab = (ap * ab).sum(-1)
+        p_ad = (ap * ad).sum(-1)
+        return (p_ab >= -eps) & (p_ab <= (ab * ab).sum(-1) + eps) & (p_ad >= -eps) & (p_ad <= (ad * ad).sum(-1) + eps)
+
+    # edge-edge intersections, 4 x 4 per pair
+    p = ca[:, :, None]  # K, 4, 1, 2
+    r = (ca.roll(-1, dims=1) - ca)[:, :, None]
+    q = cb[:, None]  # K, 1, 4, 2
+    s = (cb.roll(-1, dims=1) - cb)[:, None]
+    denom = _cross(r, s)
+    parallel = denom.abs() < eps
+    denom = torch.where(parallel, torch.ones_like(denom), denom)
+    t = _cross(q - p, s) / denom
+    u = _cross(q - p, r) / denom
+    edge_valid = ~parallel & (t >= 0) & (t <= 1) & (u >= 0) & (u <= 1)
+    edge_pts = p + t[..., None] * r
+
+    K = ca.shape[0]
+    pts = torch.cat((ca, cb, edge_pts.reshape(K, 16, 2)), dim=1)  # K, 24, 2
+    valid = torch.cat((inside(ca, cb), inside(cb, ca), edge_valid.reshape(K, 16)), dim=1)
+    num_valid = valid.sum(1)
+    center = (pts * valid[..., None]).sum(1) / num_valid.clamp(min=1)[:, None]
+    angles = torch.atan2(pts[..., 1] - center[:, None, 1], pts[..., 0] - center[:, None, 0])
+    angles = torch.where(valid, angles, torch.full_like(angles, 10.0))
+    order = angles.argsort(dim=1)
+    pts = pts.gather(1, order[..., None].expand(-1, -1, 2))
+    valid = valid.gather(1, order)
+    # invalid points are replaced by the first vertex, they add zero area to the shoelace sum
+    pts = torch.where(valid[..., None], pts, pts[:, :1])
+    area = _cross(pts, pts.roll(-1, dims=1)).sum(1).abs() / 2
+    return torch.where(num_valid >= 3, area, torch.zeros_like(area))
+
+
+def _overlap_pairs(bev_a, bev_b):
+    """
+    Index pairs whose bounding circles overlap, the only pairs with a possibly non zero intersection.
+    """
+    ra = (bev_a[:, 2] ** 2 + bev_a[:, 3] ** 2).sqrt() / 2
+    rb = (bev_b[:, 2] ** 2 + bev_b[:, 3] ** 2).sqrt() / 2
+    dist = torch.cdist(bev_a[:, :2], bev_b[:, :2])
+    return (dist < ra[:, None] + rb[None]).nonzero(as_tuple=True)
+
+
+def _bev_intersection(bev_a, bev_b, chunk_size=1 << 18):
+    inter = bev_a.new_zeros((bev_a.shape[0], bev_b.shape[0]))
+    if inter.numel() == 0:
+        return inter
+    ia, ib = _overlap_pairs(bev_a, bev_b)
+    ca, cb = bev_to_corners(bev_a), bev_to_corners(bev_b)
+    for begin in range(0, ia.shape[0], chunk_size):
+        ja, jb = ia[begin:begin + chunk_size], ib[begin:begin + chunk_size]
+        inter[ja, jb] = _convex_intersection_area(ca[ja], cb[jb])
+    return inter
+
+
+def _normalize(inter, area_a, area_b, criterion):
+    if criterion == -1:
+        union = area_a[:, None] + area_b[None] - inter
+    elif criterion == 0:
+        union = area_a[:, None].expand_as(inter)
+    elif criterion == 1:
+        union = area_b[None].expand_as(inter)
+    else:
+        return inter
+    return inter / union.clamp(min=1e-8)
+
+
+@_numpy_compatible
+def box2d_iou(boxes_a, boxes_b, criterion=-1):
+    """
+    :param boxes_a: (N, 4) x1, y1, x2, y2
+    :param boxes_b: (M, 4)
+    :param criterion: -1: intersection over union, 0: over area of a, 1: over area of b, other: intersection
+    :return: (N, M)
+    """
+    iw = (torch.min(boxes_a[:, None, 2], boxes_b[None, :, 2]) -
+          torch.max(boxes_a[:, None, 0], boxes_b[None, :, 0])).clamp(min=0)
+    ih = (torch.min(boxes_a[:, None, 3], boxes_b[None, :, 3]) -
+          torch.max(boxes_a[:, None, 1], boxes_b[None, :, 1])).clamp(min=0)
+    area_a = (boxes_a[:, 2] - boxes_a[:, 0]) * (boxes_a[:, 3] - boxes_a[:, 1])
+    area_b = (boxes_b[:, 2] - boxes_b[:, 0]) * (boxes_b[:, 3] - boxes_b[:, 1])
+    return _normalize(iw * ih, area_a, area_b, criterion)
+
+
+@_numpy_compatible
+def bev_iou(bev_a, bev_b, criterion=-1):
+    """
+    Rotated iou on the bird's eye view.
+    :param bev_a: (N, 5) x, z, l, w, ry
+    :param bev_b: (M, 5)
+    :param criterion: see box2d_iou
+    :return: (N, M)
+    """
+    inter = _bev_intersection(bev_a, bev_b)
+    return _normalize(inter, bev_a[:, 2] * bev_a[:, 3], bev_b[:, 2] * bev_b[:, 3], criterion)
+
+
+@_numpy_compatible
+def box3d_iou(boxes_a, boxes_b, criterion=-1):
+    """
+    :param boxes_a: (N, 7) x, y, z, h, w, l, ry
+    :param boxes_b: (M, 7)
+    :param criterion: see box2d_iou
+    :return: (N, M)
+    """
+    inter = _bev_intersection(boxes3d_to_bev(boxes_a), boxes3d_to_bev(boxes_b))
+    # y points down, a box spans [y - h, y]
+    ih = (torch.min(boxes_a[:, None, 1], boxes_b[None, :, 1]) -
+          torch.max(boxes_a[:, None, 1] - boxes_a[:, None, 3], boxes_b[None, :, 1] - boxes_b[None, :, 3])).clamp(min=0)
+    volume_a = boxes_a[:, 3] * boxes_a[:, 4] * boxes_a[:, 5]
+    volume_b = boxes_b[:, 3] * boxes_b[:, 4] * boxes_b[:, 5]
+    return _normalize(inter * ih, volume_a, volume_b, criterion)
+
+
+@_numpy_compatible
+def points_in_boxes3d(points, boxes3d, cell_size=4.0):
+    """
+    Points are first bucketed into a coarse bev grid, only points in the cells covered by the
+    axis aligned footprint of a box are tested against the rotated box.
+    :param points: (P, 3+) in rect coordinate
+    :param boxes3d: (B, 7)
+    :param cell_size: size in meters of the grid cells
+    :return: point indices and box indices of every (point, box) pair with the point inside the box
+    """
+    empty = torch.zeros((0,), dtype=torch.long, device=points.device)
+    if points.shape[0] == 0 or boxes3d.shape[0] == 0:
+        return empty, empty
+    xz = points[:, [0, 2]]
+    origin = xz.min(0).values
+    cells = ((xz - origin) / cell_size).floor().long()
+    num_cols = int(cells[:, 1].max()) + 1
+    order = (cells[:, 0] * num_cols + cells[:, 1]).argsort()
+    keys = (cells[:, 0] * num_cols + cells[:, 1])[order]
+
+    corners = bev_to_corners(boxes3d_to_bev(boxes3d))
+    lo = ((corners.min(1).values - origin) / cell_size).floor().long().cpu()
+    hi = ((corners.max(1).values - origin) / cell_size).floor().long().cpu()
+    lo[:, 1].clamp_(min=0)
+    hi[:, 1].clamp_(max=num_cols - 1)
+    # every row of cells covered by a box is a contiguous range of sorted keys
+    rows, row_boxes = [], []
+    for b in range(boxes3d.shape[0]):
+        if lo[b, 1] > hi[b, 1]:
+            continue
+        for r in range(max(int(lo[b, 0]), 0), int(hi[b, 0]) + 1):
+            rows.append((r * num_cols + lo[b, 1], r * num_cols + hi[b, 1]))
+            row_boxes.append(b)
+    if len(rows) == 0:
+        return empty, empty
+    rows = torch.as_tensor(rows, dtype=keys.dtype, device=keys.device).t().contiguous()
+    begins = torch.searchsorted(keys, rows[0])
+    ends = torch.searchsorted(keys, rows[1], right=True)
+    counts = ends - begins
+    row_index = torch.arange(len(counts), device=keys.device).repeat_interleave(counts)
+    within = torch.arange(int(counts.sum()), device=keys.device) - (counts.cumsum(0) - counts)[row_index]
+    point_idx = order[begins[row_index] + within]
+    box_idx = torch.as_tensor(row_boxes, dtype=torch.long, device=keys.device)[row_index]
+
+    boxes = boxes3d[box_idx]
+    pts = points[point_idx]
+    dx, dz = pts[:, 0] - boxes[:, 0], pts[:, 2] - boxes[:, 2]
+    c, s = torch.cos(boxes[:, 6]), torch.sin(boxes[:, 6])
+    # inverse of the rotation in boxes3d_to_corners
+    local_x = c * dx - s * dz
+    local_z = s * dx + c * dz
+    inside = ((local_x.abs() <= boxes[:, 5] / 2) & (local_z.abs() <= boxes[:, 4] / 2) &
+              (pts[:, 1] <= boxes[:, 1]) & (pts[:, 1] >= boxes[:, 1] - boxes[:, 3]))
+    return point_idx[inside], box_idx[inside]
+
+
+@_numpy_compatible
+def rotated_nms(boxes, scores, iou_threshold, mode='bev'):
+    """
+    Greedy nms with rotated iou.
+    :param boxes: (N, 7) box3d, or (N, 5) bev box when mode is bev
+    :param scores: (N,)
+    :param iou_threshold:
+    :param mode: bev or 3d
+    :return: indices of kept boxes, sorted by decreasing score
+    """
+    if mode not in ('bev', '3d'):
+        raise ValueError(f'expect mode in [bev, 3d], but found {mode}')
+    order = scores.argsort(descending=True)
+    boxes = boxes[order]
+    if mode == '3d':
+        iou = box3d_iou(boxes, boxes)
+    else:
+        iou = bev_iou(boxes if boxes.shape[1] == 5 else boxes3d_to_bev(boxes),
+                      boxes if boxes.shape[1] == 5 else boxes3d_to_bev(boxes))
+    overlapped = (iou > iou_threshold).cpu().numpy()
+    suppressed = np.zeros((boxes.shape[0],), dtype=bool)
+    keep = []
+    for i in range(boxes.shape[0]):
+        if suppressed[i]:
+            continue
+        keep.append(i)
+        suppressed |= overlapped[i]
+    return order[torch.as_tensor(keep, dtype=torch.long, device=order.device)]
@@ -1,17 +1,154 @@
+from collections import OrderedDict
 from warnings import warn
 
 import numpy as np
 import torch
 
-from ..utils import inverse_rigid_trans, check_type
+from ..utils import inverse_rigid_trans, check_type, compose_affine
+
+
+def _dtype_name(dtype):
+    """
+    :param dtype: str, numpy dtype or torch dtype
+    :return: e.g. 'float32'
+    """
+    if isinstance(dtype, torch.dtype):
+        return str(dtype).split('.')[-1]
+    return np.dtype(dtype).name
+
+
+def _to_dtype(arr, dtype: str):
+    if isinstance(arr, np.ndarray):
+        return arr.astype(dtype, copy=False)
+    return arr.to(getattr(torch, dtype))
+
+
+def _cast(arr, like):
+    if isinstance(like, np.ndarray):
+        return arr.astype(like.dtype, copy=False)
+    return arr.to(like.dtype)
+
+
+_pixel_grid_cache = OrderedDict()
+_PIXEL_GRID_CACHE_SIZE = 16
+
+
+def _pixel_grid(height, width, stride, like, intrinsics=None):
+    """
+    Pixel coordinates (u, v) of an image subsampled by stride, cached per (size, stride, intrinsics, device, dtype).
+    :param like: array or tensor giving backend, device and dtype
+    :param intrinsics: None, or (cu, cv, fu, fv) to also return the rays ((u - cu) / fu, (v - cv) / fv)
+    :return: pixels (H' * W', 2), rays (H' * W', 2) or None
+    """
+    if isinstance(like, np.ndarray):
+        key = (height, width, stride, intrinsics, 'numpy', like.dtype.name)
+    else:
+        key = (height, width, stride, intrinsics, like.device, like.dtype)
+    if key in _pixel_grid_cache:
+        _pixel_grid_cache.move_to_end(key)
+        return _pixel_grid_cache[key]
+    if isinstance(like, np.ndarray):
+        v, u = np.meshgrid(np.arange(0, height, stride), np.arange(0, width, stride), indexing='ij')
+        pixels = np.stack((u.reshape(-1), v.reshape(-1)), axis=1).astype(like.dtype)
+    else:
+        v, u = torch.meshgrid(torch.arange(0, height, stride, device=like.device),
+                              torch.arange(0, width, stride, device=like.device), indexing='ij')
+        pixels = torch.stack((u.reshape(-1), v.reshape(-1)), dim=1).to(like.dtype)
+    rays = None
+    if intrinsics is not None:
+        cu, cv, fu, fv = intrinsics
+        rays = (pixels - pixels.new_tensor([cu, cv]) if isinstance(pixels, torch.Tensor)
+                else pixels - np.array([cu, cv], dtype=pixels.dtype))
+        rays[:, 0] /= fu
+        rays[:, 1] /= fv
+    _pixel_grid_cache[key] = (pixels, rays)
+    while len(_pixel_grid_cache) > _PIXEL_GRID_CACHE_SIZE:
+        _pixel_grid_cache.popitem(last=False)
+    return pixels, rays
+
+
+def _compact_depth_maps(depth_maps, dtype, mask=None, min_depth=0, max_depth=None, stride=1):
+    """
+    Subsample and flatten (B, H, W) depth maps and find the valid pixels.
+    :return: depth (B, H' * W'), batch index (M,), pixel index (M,), offsets (B + 1,)
+    """
+    B = depth_maps.shape[0]
+    depth = _to_dtype(depth_maps[:, ::stride, ::stride], dtype).reshape(B, -1)
+    valid = depth > min_depth
+    if max_depth is not None:
+        valid &= depth <= max_depth
+    if mask is not None:
+        valid &= mask[:, ::stride, ::stride].reshape(B, -1)
+    if isinstance(depth, np.ndarray):
+        b, p = np.nonzero(valid)
+        offsets = np.zeros((B + 1,), dtype=np.int64)
+        np.cumsum(valid.sum(axis=1), out=offsets[1:])
+    else:
+        b, p = valid.nonzero(as_tuple=True)
+        offsets = torch.zeros((B + 1,), dtype=torch.long, device=depth.device)
+        torch.cumsum(valid.sum(dim=1), dim=0, out=offsets[1:])
+    return depth, b, p, offsets
+
+
+def _depth_buffer(u, v, depth, b, batch_size, width, height):
+    """
+    Z-buffer: rasterize projected points into (B, H, W) depth maps keeping the nearest depth per pixel,
+    0 where no point projects.
+    :param u: (N,) pixel coordinates, rounded to the nearest pixel
+    :param v: (N,)
+    :param depth: (N,) points with depth <= 0 are dropped
+    :param b: (N,) frame index of each point, None for a single frame
+    """
+    if isinstance(depth, np.ndarray):
+        u, v = np.round(u).astype(np.int64), np.round(v).astype(np.int64)
+        keep = (depth > 0) & (u >= 0) & (u < width) & (v >= 0) & (v < height)
+        index = (v * width + u)[keep]
+        if b is not None:
+            index += b[keep] * (height * width)
+        depth = depth[keep]
+        out = np.zeros((batch_size * height * width,), dtype=depth.dtype)
+        if depth.dtype.itemsize <= 4:
+            # bits of positive floats sort as integers, one sort of (index, depth) packed in int64
+            # is much faster than lexsort
+            key = (index << 32) | depth.astype(np.float32).view(np.uint32).astype(np.int64)
+            key.sort()
+            index = key >> 32
+            depth = (key & 0xffffffff).astype(np.uint32).view(np.float32).astype(depth.dtype, copy=False)
+        else:
+            order = np.lexsort((depth, index))
+            index, depth = index[order], depth[order]
+        first = np.ones((index.shape[0],), dtype=bool)
+        first[1:] = index[1:] != index[:-1]
+        out[index[first]] = depth[first]
+        return out.reshape(batch_size, height, width)
+    u, v = torch.round(u).long(), torch.round(v).long()
+    keep = (depth > 0) & (u >= 0) & (u < width) & (v >= 0) & (v < height)
+    index = (v * width + u)[keep]
+    if b is not None:
+        index += b[keep] * (height * width)
+    out = depth.new_full((batch_size * height * width,), float('inf'))
+    out.scatter_reduce_(0, index, depth[keep], 'amin')
+    out[torch.isinf(out)] = 0
+    return out.reshape(batch_size, height, width)
 
 
 class Calibration:
-    def __init__(self, calibs, image_size):
+    _matrix_names = ('P0', 'P1', 'P2', 'P3', 'R0', 'V2C', 'I2V', 'C2V', 'V2I')
+
+    def __init__(self, calibs, image_size, dtype=None):
         """
+        Transforms use the calib matrices cast to the result dtype (and device), cached per (device, dtype).
+        The caches are keyed on the content of the matrices, so that in place edits
+        (e.g. calib.P2[0, 2] -= x0) are taken into account.
         :param calibs:
         :param image_size: width, height
+        :param dtype: dtype of the results of both numpy and torch inputs, e.g. 'float32', 'float64' or
+                      'float16' (for GPU). None keeps the dtype of floating point inputs and uses float32 otherwise.
         """
+        self._affine_cache = {}
+        self._cast_cache = {}
+        self._cache_key = None
+        self.dtype = _dtype_name(dtype) if dtype is not None else None
         self.P0 = calibs['P0']  # 3 x 4
         self.P1 = calibs['P1']  # 3 x 4
         self.P2 = calibs['P2']  # 3 x 4
@@ -23,6 +160,98 @@ class Calibration:
         self.V2I = inverse_rigid_trans(self.I2V)
         self.size = image_size
 
+    def __setattr__(self, key, value):
+        if key in self._matrix_names:
+            self.clear_cache()
+        super().__setattr__(key, value)
+
+    def clear_cache(self):
+        self._affine_cache.clear()
+        self._cast_cache.clear()
+
+    def _check_cache(self):
+        # the matrices are ~100 floats, comparing their bytes is cheap compared to a transform
+        key = b''.join(getattr(self, name).tobytes() for name in self._matrix_names)
+        if key != self._cache_key:
+            self.clear_cache()
+            self._cache_key = key
+
+    def affine(self, name):
+        """
+        Composed transforms as (3, 4) or (4, 4) [R|t] numpy matrices, applied as pts @ R.T + t.
+        V2R: lidar to rect, R2V: rect to lidar, R2Ref: rect to ref, Ref2R: ref to rect,
+        I2R: imu to rect, R2I: rect to imu, V2Img: lidar to (u * z, v * z, w, z) of image_2,
+        and the 3 x 4 matrices C2V, I2V, V2I, P2, C0to2, C2to0.
+        """
+        self._check_cache()
+        if name not in self._affine_cache:
+            zeros = np.zeros((3, 1))
+            if name == 'V2R':
+                A = compose_affine(np.concatenate((self.R0, zeros), axis=1), self.V2C)
+            elif name == 'R2Ref':
+                A = np.concatenate((np.linalg.inv(self.R0), zeros), axis=1)
+            elif name == 'Ref2R':
+                A = np.concatenate((self.R0, zeros), axis=1)
+            elif name == 'R2V':
+                A = compose_affine(self.C2V, self.affine('R2Ref'))
+            elif name == 'I2R':
+                A = compose_affine(self.affine('V2R'), self.I2V)
+            elif name == 'R2I':
+                A = compose_affine(self.V2I, self.affine('R2V'))
+            elif name == 'V2Img':
+                V2R = self.affine('V2R')
+                A = np.concatenate((compose_affine(self.P2, V2R), V2R[2:3]), axis=0)
+            elif name in ('C0to2', 'C2to0'):
+                A = getattr(self, name)[:3]
+            else:
+                A = getattr(self, name)
+            self._affine_cache[name] = A
+        return self._affine_cache[name]
+
+    def numpy_affine(self, name, dtype='float64'):
+        """
+        affine(name) cast to dtype, cached.
+        """
+        self._check_cache()
+        key = (name, 'numpy', _dtype_name(dtype))
+        if key not in self._cast_cache:
+            self._cast_cache[key] = self.affine(name).astype(key[2])
+        return self._cast_cache[key]
+
+    def torch_affine(self, name, device, dtype=torch.float32):
+        """
+        affine(name) as a tensor, cached per (device, dtype) so that repeated calls do no host to device copy.
+        """
+        self._check_cache()
+        key = (name, torch.device(device), dtype)
+        if key not in self._cast_cache:
+            self._cast_cache[key] = torch.as_tensor(self.affine(name), dtype=dtype, device=device)
+        return self._cast_cache[key]
+
+    def result_dtype(self, pts):
+        """
+        :return: name of the dtype of transform results of pts under the dtype policy
+        """
+        if self.dtype is not None:
+            return self.dtype
+        if isinstance(pts, np.ndarray):
+            return pts.dtype.name if np.issubdtype(pts.dtype, np.floating) else 'float32'
+        return _dtype_name(pts.dtype) if pts.is_floating_point() else 'float32'
+
+    def _apply(self, name, pts):
+        """
+        pts @ R.T + t of affine(name), without building homogeneous coordinates.
+        """
+        check_type(pts)
+        dtype = self.result_dtype(pts)
+        if isinstance(pts, np.ndarray):
+            A = self.numpy_affine(name, dtype)
+            out = pts.astype(dtype, copy=False) @ A[:, :3].T
+            out += A[:, 3]
+            return out
+        A = self.torch_affine(name, pts.device, getattr(torch, dtype))
+        return torch.addmm(A[:, 3], pts.to(getattr(torch, dtype)), A[:, :3].t())
+
     @property
     def cu(self):
         return self.P2[0, 2]
@@ -73,10 +302,12 @@ class Calibration:
         """
         check_type(pts)
         if isinstance(pts, np.ndarray):
-            pts_hom = np.hstack((pts, np.ones((pts.shape[0], 1), dtype=np.float32)))
+            dtype = pts.dtype if np.issubdtype(pts.dtype, np.floating) else np.float32
+            pts_hom = np.hstack((pts, np.ones((pts.shape[0], 1), dtype=dtype)))
         else:
-            ones = torch.ones((pts.shape[0], 1), dtype=torch.float32, device=pts.device)
-            pts_hom = torch.cat((pts, ones), dim=1)
+            dtype = pts.dtype if pts.is_floating_point() else torch.float32
+            ones = torch.ones((pts.shape[0], 1), dtype=dtype, device=pts.device)
+            pts_hom = torch.cat((pts.to(dtype), ones), dim=1)
         return pts_hom
 
     @staticmethod
@@ -93,105 +324,71 @@ class Calibration:
         :param pts_lidar: (N, 3)
         :return pts_rect: (N, 3)
         """
-
-        check_type(pts_lidar)
-        pts_lidar_hom = self.cart_to_hom(pts_lidar)
-        if isinstance(pts_lidar_hom, np.ndarray):
-            pts_rect = np.dot(pts_lidar_hom, np.dot(self.V2C.T, self.R0.T))
-        else:
-            device = pts_lidar_hom.device
-            pts_rect = pts_lidar_hom @ torch.tensor(self.V2C).float().t().to(device=device) @ torch.tensor(
-                self.R0).float().t().to(device=device)
-        return pts_rect
+        return self._apply('V2R', pts_lidar)
 
     def rect_to_lidar(self, pts_rect):
-        pts_ref = self.rect_to_ref(pts_rect)
-        pts_lidar = self.ref_to_lidar(pts_ref)
-        return pts_lidar
+        return self._apply('R2V', pts_rect)
 
     def rect_to_ref(self, pts_rect):
-        check_type(pts_rect)
-        if isinstance(pts_rect, np.ndarray):
-            return np.transpose(np.dot(np.linalg.inv(self.R0), np.transpose(pts_rect)))
-        else:
-            device = pts_rect.device
-            R0 = torch.tensor(self.R0).float().to(device=device)
-            return (torch.inverse(R0) @ pts_rect.t()).t()
+        return self._apply('R2Ref', pts_rect)
 
     def ref_to_rect(self, pts_ref):
-        check_type(pts_ref)
-        if isinstance(pts_ref, np.ndarray):
-            return np.transpose(np.dot(self.R0, np.transpose(pts_ref)))
-        else:
-            device = pts_ref.device
-            R0 = torch.tensor(self.R0).float().to(device=device)
-            return (R0 @ pts_ref.t()).t()
+        return self._apply('Ref2R', pts_ref)
 
     def ref_to_lidar(self, pts_ref):
-        check_type(pts_ref)
-        pts_3d_ref = self.cart_to_hom(pts_ref)  # nx4
-        if isinstance(pts_3d_ref, np.ndarray):
-            return np.dot(pts_3d_ref, np.transpose(self.C2V))
-        else:
-            device = pts_3d_ref.device
-            C2V = torch.tensor(self.C2V).float().to(device=device)
-            return pts_3d_ref @ C2V.t()
+        return self._apply('C2V', pts_ref)
 
     def rect_to_img(self, pts_rect):
         """
         :param pts_rect: (N, 3)
         :return pts_img: (N, 2)
         """
-        check_type(pts_rect)
-        pts_rect_hom = self.cart_to_hom(pts_rect)
-        if isinstance(pts_rect_hom, np.ndarray):
-            pts_2d_hom = np.dot(pts_rect_hom, self.P2.T)
-            pts_img = (pts_2d_hom[:, 0:2].T / pts_rect_hom[:, 2]).T  # (N, 2)
-            pts_rect_depth = pts_2d_hom[:, 2] - self.P2.T[3, 2]  # depth in rect camera coord
-        else:
-            device = pts_rect_hom.device
-            P2 = torch.tensor(self.P2).float().to(device=device)
-            pts_2d_hom = pts_rect_hom @ P2.t()
-            pts_img = (pts_2d_hom[:, 0:2].t() / pts_rect_hom[:, 2]).t()
-            pts_rect_depth = pts_2d_hom[:, 2] - P2.t()[3, 2]  # depth in rect camera coord
+        pts_2d_hom = self._apply('P2', pts_rect)
+        pts_img = pts_2d_hom[:, 0:2] / _cast(pts_rect[:, 2:3], pts_2d_hom)  # (N, 2)
+        pts_rect_depth = pts_2d_hom[:, 2] - float(self.P2[2, 3])  # depth in rect camera coord
         return pts_img, pts_rect_depth
 
     def rect_to_cam2(self, pts):
-        if isinstance(pts, np.ndarray):
-            C0to2 = self.C0to2
-            pts = self.cart_to_hom(pts)
-            pts = pts @ C0to2.T
-            pts = self.hom_to_cart(pts)
-        else:
-            C0to2 = torch.from_numpy(self.C0to2).to(device=pts.device).float()
-            pts = self.cart_to_hom(pts)
-            pts = pts @ C0to2.t()
-            pts = self.hom_to_cart(pts)
-        return pts
+        return self._apply('C0to2', pts)
 
     def cam2_to_rect(self, pts):
-        if isinstance(pts, np.ndarray):
-            C2to0 = self.C2to0
-            pts = self.cart_to_hom(pts)
-            pts = pts @ C2to0.T
-            pts = self.hom_to_cart(pts)
-        else:
-            C2to0 = torch.from_numpy(self.C2to0).to(device=pts.device).float()
-            pts = self.cart_to_hom(pts)
-            pts = pts @ C2to0.t()
-            pts = self.hom_to_cart(pts)
-        return pts
+        return self._apply('C2to0', pts)
 
     def lidar_to_img(self, pts_lidar):
         """
         :param pts_lidar: (N, 3)
         :return pts_img: (N, 2)
         """
-        check_type(pts_lidar)
-        pts_rect = self.lidar_to_rect(pts_lidar)
-        pts_img, pts_depth = self.rect_to_img(pts_rect)
+        pts_2d_hom = self._apply('V2Img', pts_lidar)
+        pts_img = pts_2d_hom[:, 0:2] / pts_2d_hom[:, 3:4]
+        pts_depth = pts_2d_hom[:, 2] - float(self.P2[2, 3])
         return pts_img, pts_depth
 
+    def lidar_to_depth_map(self, pts_lidar, size=None, offsets=None):
+        """
+        Sparse depth map of lidar points, the nearest depth is kept when several points fall into one pixel.
+        :param pts_lidar: (N, 3+)
+        :param size: width, height of the depth map, default the image size.
+                     Pixels are those of self.resize(size), crop the calibration first for crops.
+        :param offsets: (B + 1,) to rasterize B frames sharing this calibration at once, see depth_maps_to_points
+        :return: (H, W), or (B, H, W) if offsets is given, 0 where there is no point
+        """
+        check_type(pts_lidar)
+        calib = self
+        if size is not None and tuple(size) != tuple(self.size):
+            calib = self.resize(size)
+        width, height = map(int, calib.size)
+        pts_img, depth = calib.lidar_to_img(pts_lidar[:, :3])
+        if offsets is None:
+            return _depth_buffer(pts_img[:, 0], pts_img[:, 1], depth, None, 1, width, height)[0]
+        if isinstance(depth, np.ndarray):
+            offsets = np.asarray(offsets)
+            b = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+        else:
+            offsets = torch.as_tensor(offsets, device=depth.device)
+            b = torch.repeat_interleave(torch.arange(len(offsets) - 1, device=depth.device), offsets.diff())
+        return _depth_buffer(pts_img[:, 0], pts_img[:, 1], depth, b, len(offsets) - 1, width, height)
+
     def img_to_rect(self, u, v, depth_rect):
         """
         :param u: (N)
@@ -202,12 +399,15 @@ class Calibration:
         check_type(u)
         check_type(v)
         check_type(depth_rect)
-        x = ((u - self.cu) * depth_rect) / self.fu + self.tx
-        y = ((v - self.cv) * depth_rect) / self.fv + self.ty
+        dtype = self.result_dtype(depth_rect)
+        u, v, depth_rect = (_to_dtype(a, dtype) for a in (u, v, depth_rect))
+        cu, cv, fu, fv, tx, ty = map(float, (self.cu, self.cv, self.fu, self.fv, self.tx, self.ty))
+        x = ((u - cu) * depth_rect) / fu + tx
+        y = ((v - cv) * depth_rect) / fv + ty
         if isinstance(depth_rect, np.ndarray):
-            pts_rect = np.concatenate((x.reshape(-1, 1), y.reshape(-1, 1), depth_rect.reshape(-1, 1)), axis=1)
+            pts_rect = np.stack((x.reshape(-1), y.reshape(-1), depth_rect.reshape(-1)), axis=1)
         else:
-            pts_rect = torch.cat((x.reshape(-1, 1), y.reshape(-1, 1), depth_rect.reshape(-1, 1)), dim=1)
+            pts_rect = torch.stack((x.reshape(-1), y.reshape(-1), depth_rect.reshape(-1)), dim=1)
         return pts_rect
 
     def depth_map_to_rect(self, depth_map):
@@ -229,19 +429,54 @@ class Calibration:
         pts_rect = self.img_to_rect(x_idxs, y_idxs, depth)
         return pts_rect, x_idxs, y_idxs
 
+    def depth_maps_to_points(self, depth_maps, mask=None, min_depth=0, max_depth=None, stride=1,
+                             return_pixels=False):
+        """
+        Back-project the valid pixels of a batch of depth maps sharing this calibration.
+        Unlike depth_map_to_rect, the pixel rays are cached per image size and intrinsics,
+        and only the kept pixels are turned into points.
+        :param depth_maps: (B, H, W) or (H, W)
+        :param mask: bool, same shape as depth_maps, False pixels are dropped
+        :param min_depth: pixels with depth <= min_depth are dropped
+        :param max_depth: pixels with depth > max_depth are dropped
+        :param stride: keep one pixel every stride pixels in both directions
+        :param return_pixels: also return (u, v) of each point
+        :return: pts_rect (M, 3), offsets (B + 1,) so that points of depth_maps[b] are pts_rect[offsets[b]:offsets[b + 1]],
+                 [pixels (M, 2)]
+        """
+        check_type(depth_maps)
+        if depth_maps.ndim == 2:
+            depth_maps = depth_maps[None]
+            mask = mask[None] if mask is not None else None
+        _, H, W = depth_maps.shape
+        depth, b, p, offsets = _compact_depth_maps(depth_maps, self.result_dtype(depth_maps), mask,
+                                                   min_depth, max_depth, stride)
+        intrinsics = tuple(map(float, (self.cu, self.cv, self.fu, self.fv)))
+        pixels, rays = _pixel_grid(H, W, stride, depth, intrinsics)
+        d = depth[b, p]
+        x = d * rays[p, 0] + float(self.tx)
+        y = d * rays[p, 1] + float(self.ty)
+        if isinstance(d, np.ndarray):
+            pts_rect = np.stack((x, y, d), axis=1)
+        else:
+            pts_rect = torch.stack((x, y, d), dim=1)
+        if return_pixels:
+            return pts_rect, offsets, pixels[p]
+        return pts_rect, offsets
+
     def disparity_map_to_rect(self, disparity_map, epsilon=1e-6):
         check_type(disparity_map)
-        depth_map = self.stereo_baseline / (disparity_map + epsilon)
+        depth_map = float(self.stereo_baseline) / (disparity_map + epsilon)
         return self.depth_map_to_rect(depth_map)
 
     def disparity_map_to_depth_map(self, disparity_map, epsilon=1e-6):
         check_type(disparity_map)
-        depth_map = self.stereo_baseline / (disparity_map + epsilon)
+        depth_map = float(self.stereo_baseline) / (disparity_map + epsilon)
         return depth_map
 
     def depth_map_to_disparity_map(self, depth_map, epsilon=1e-6):
         check_type(depth_map)
-        disparity_map = self.stereo_baseline / (depth_map + epsilon)
+        disparity_map = float(self.stereo_baseline) / (depth_map + epsilon)
         return disparity_map
 
     def corners3d_to_img_boxes(self, corners3d):
@@ -252,11 +487,8 @@ class Calibration:
         """
         check_type(corners3d)
         sample_num = corners3d.shape[0]
+        img_pts = self._apply('P2', corners3d.reshape(-1, 3)).reshape(sample_num, 8, 3)
         if isinstance(corners3d, np.ndarray):
-            corners3d_hom = np.concatenate((corners3d, np.ones((sample_num, 8, 1))), axis=2)  # (N, 8, 4)
-
-            img_pts = np.matmul(corners3d_hom, self.P2.T)  # (N, 8, 3)
-
             x, y = img_pts[:, :, 0] / img_pts[:, :, 2], img_pts[:, :, 1] / img_pts[:, :, 2]
             x1, y1 = np.min(x, axis=1), np.min(y, axis=1)
             x2, y2 = np.max(x, axis=1), np.max(y, axis=1)
@@ -264,12 +496,6 @@ class Calibration:
             boxes = np.concatenate((x1.reshape(-1, 1), y1.reshape(-1, 1), x2.reshape(-1, 1), y2.reshape(-1, 1)), axis=1)
             boxes_corner = np.concatenate((x.reshape(-1, 8, 1), y.reshape(-1, 8, 1)), axis=2)
         else:
-            device = corners3d.device
-            ones = torch.ones((sample_num, 8, 1), dtype=torch.float).to(device=device)
-            corners3d_hom = torch.cat((corners3d, ones),
-                                      dim=2)  # (N, 8, 4)
-            P2 = torch.tensor(self.P2).float().to(device=device)
-            img_pts = corners3d_hom @ P2.t()  # (N, 8, 3)
             x, y = img_pts[:, :, 0] / img_pts[:, :, 2], img_pts[:, :, 1] / img_pts[:, :, 2]
             x1, y1 = torch.min(x, dim=1).values, torch.min(y, dim=1).values
             x2, y2 = torch.max(x, dim=1).values, torch.max(y, dim=1).values
@@ -290,9 +516,12 @@ class Calibration:
         check_type(v)
         check_type(d)
         assert self.fu == self.fv, '%.8f != %.8f' % (self.fu, self.fv)
-        fd = ((u - self.cu) ** 2 + (v - self.cv) ** 2 + self.fu ** 2) ** 0.5
-        x = ((u - self.cu) * d) / fd + self.tx
-        y = ((v - self.cv) * d) / fd + self.ty
+        dtype = self.result_dtype(d)
+        u, v, d = (_to_dtype(a, dtype) for a in (u, v, d))
+        cu, cv, fu, tx, ty = map(float, (self.cu, self.cv, self.fu, self.tx, self.ty))
+        fd = ((u - cu) ** 2 + (v - cv) ** 2 + fu ** 2) ** 0.5
+        x = ((u - cu) * d) / fd + tx
+        y = ((v - cv) * d) / fd + ty
         z = (d ** 2 - x ** 2 - y ** 2) ** 0.5
         if isinstance(x, np.ndarray):
             pts_rect = np.concatenate((x.reshape(-1, 1), y.reshape(-1, 1), z.reshape(-1, 1)), axis=1)
@@ -301,24 +530,16 @@ class Calibration:
         return pts_rect
 
     def imu_to_velo(self, pts_3d_imu):
-        pts_3d_imu = self.cart_to_hom(pts_3d_imu)  # nx4
-        if isinstance(pts_3d_imu, np.ndarray):
-            return np.dot(pts_3d_imu, np.transpose(self.I2V))
-        else:
-            return pts_3d_imu @ torch.from_numpy(self.I2V).to(pts_3d_imu.device).float().t()
+        return self._apply('I2V', pts_3d_imu)
 
     def velo_to_imu(self, pts_3d_velo):
-        pts_3d_velo = self.cart_to_hom(pts_3d_velo)  # nx4
-        if isinstance(pts_3d_velo, np.ndarray):
-            return pts_3d_velo @ self.V2I.T
-        else:
-            return pts_3d_velo @ torch.from_numpy(self.V2I).to(pts_3d_velo.device).float().t()
+        return self._apply('V2I', pts_3d_velo)
 
     def rect_to_imu(self, pts):
-        return self.velo_to_imu(self.rect_to_lidar(pts))
+        return self._apply('R2I', pts)
 
     def imu_to_rect(self, pts):
-        return self.lidar_to_rect(self.imu_to_velo(pts))
+        return self._apply('I2R', pts)
 
     def todict(self):
         calibs = {}
@@ -335,7 +556,7 @@ class Calibration:
     def crop(self, box):
         x1, y1, x2, y2 = box
         d = self.todict()
-        ret = Calibration(d['calibs'], (x2 - x1, y2 - y1))
+        ret = Calibration({k: v.copy() for k, v in d['calibs'].items()}, (x2 - x1, y2 - y1), self.dtype)
         ret.P0[0, 2] = ret.P0[0, 2] - x1
         ret.P0[1, 2] = ret.P0[1, 2] - y1
         ret.P2[0, 2] = ret.P2[0, 2] - x1
@@ -355,7 +576,7 @@ class Calibration:
             return self
         width, height = dst_size
         d = self.todict()
-        ret = Calibration(d['calibs'], (width, height))
+        ret = Calibration({k: v.copy() for k, v in d['calibs'].items()}, (width, height), self.dtype)
         ret.P0[0] = ret.P0[0] / self.width * width
         ret.P0[1] = ret.P0[1] / self.height * height
         ret.P2[0] = ret.P2[0] / self.width * width
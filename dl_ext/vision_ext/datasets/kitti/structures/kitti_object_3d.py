@@ -54,3 +54,22 @@ class KITTIObject3D:
     def __repr__(self):
         s = f'{self.cls.name};truncated={self.truncated},occluded={self.occluded},x1,y1,x2,y2={self.x1},{self.y1},{self.x2},{self.y2};xyz={self.x},{self.y},{self.z},hwl={self.h},{self.w},{self.l};ry={self.ry}'
         return s
+
+
+class KITTIObject3DSlots:
+    """
+    KITTIObject3D without a per-instance __dict__, to hold the labels of a whole dataset in memory.
+    Other attributes can not be set. See also KITTIObjects, which stores many objects in one record array.
+    """
+    __slots__ = ('cls', 'truncated', 'occluded', 'alpha', 'x1', 'y1', 'x2', 'y2',
+                 'h', 'w', 'l', 'x', 'y', 'z', 'ry')
+
+    def __init__(self, cls: KITTIObjectClass, truncated: float, occluded: float, alpha: float,
+                 x1: float, y1: float, x2: float, y2: float,
+                 h: float, w: float, l: float,
+                 x: float, y: float, z: float, ry: float) -> None:
+        for name, value in zip(self.__slots__, (cls, truncated, occluded, alpha, x1, y1, x2, y2,
+                                                h, w, l, x, y, z, ry)):
+            setattr(self, name, value)
+
+    __repr__ = KITTIObject3D.__repr__
@@ -0,0 +1,170 @@
+from itertools import chain
+from typing import List, Sequence, Union
+
+import numpy as np
+import torch
+from numpy.lib import recfunctions
+
+from .kitti_object_3d import KITTIObjectClass, KITTIObject3D
+
+_fields = [('cls', np.int8), ('truncated', np.float32), ('occluded', np.int8), ('alpha', np.float32),
+           ('x1', np.float32), ('y1', np.float32), ('x2', np.float32), ('y2', np.float32),
+           ('h', np.float32), ('w', np.float32), ('l', np.float32),
+           ('x', np.float32), ('y', np.float32), ('z', np.float32), ('ry', np.float32)]
+_columns = {'box2d': ['x1', 'y1', 'x2', 'y2'], 'dims': ['h', 'w', 'l'], 'loc': ['x', 'y', 'z']}
+
+_class_names = np.array([''] + [c.name for c in KITTIObjectClass])
+_line_format = '%s %s %d' + ' %s' * 12
+_score_format = ' %s'
+
+
+def _float_strings(x):
+    """
+    Shortest repr of the float32 values, which is read back unchanged. Integral values are written as integers,
+    e.g. the -1 -1 -10 ... -1000 -10 of DontCare objects and unset fields, as in kitti label files.
+    """
+    x = x.astype(np.float32)
+    text = x.astype(str)
+    integral = np.char.endswith(text, '.0')
+    text[integral] = x[integral].astype(np.int64).astype(str)
+    return text.tolist()
+
+
+def _format_label_lines(names, values, scores=None):
+    """
+    Format label lines of a whole file at once, one % operation on a repeated format instead of one per line.
+    Floats are written as _float_strings.
+    :param names: (N,) class names
+    :param values: (N, 14) truncated ... ry
+    :param scores: (N,) or None
+    :return: str, one line per object
+    """
+    if len(names) == 0:
+        return ''
+    line_format = _line_format + (_score_format if scores is not None else '') + '\n'
+    columns = [names.tolist()] + [_float_strings(values[:, i]) if i != 1 else values[:, i].tolist()
+                                  for i in range(values.shape[1])]
+    if scores is not None:
+        columns.append(_float_strings(scores))
+    return (line_format * len(names)) % tuple(chain.from_iterable(zip(*columns)))
+
+
+class KITTIObjects:
+    """
+    Labels of many objects in one numpy record array, the fields are those of KITTIObject3D and optionally score.
+    Compared to a list of KITTIObject3D, it takes ~60 bytes per object and is pickled to dataloader
+    workers as one buffer.
+    """
+    dtype = np.dtype(_fields)
+    dtype_with_score = np.dtype(_fields + [('score', np.float32)])
+
+    def __init__(self, records: np.ndarray = None, with_score=False):
+        if records is None:
+            records = np.zeros((0,), dtype=self.dtype_with_score if with_score else self.dtype)
+        assert records.dtype in (self.dtype, self.dtype_with_score), records.dtype
+        self.records = records
+
+    @property
+    def has_score(self):
+        return 'score' in self.records.dtype.names
+
+    def __len__(self):
+        return self.records.shape[0]
+
+    def __getitem__(self, item) -> Union[KITTIObject3D, 'KITTIObjects']:
+        """
+        :param item: int for a KITTIObject3D, slice, index array or bool mask for KITTIObjects
+        """
+        if isinstance(item, (int, np.integer)):
+            r = self.records[item]
+            # shortest decimal repr of float32, values equal those parsed from text as in load_label_2
+            return KITTIObject3D(KITTIObjectClass(int(r['cls'])), *(float(str(r[name])) for name, _ in _fields[1:]))
+        return KITTIObjects(np.atleast_1d(self.records[item]))
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def __getattr__(self, name):
+        # fields as columns, e.g. objects.ry
+        if name != 'records' and name in self.records.dtype.names:
+            return self.records[name]
+        raise AttributeError(name)
+
+    def __repr__(self):
+        return f'KITTIObjects(num_objects={len(self)}, has_score={self.has_score})'
+
+    def filter(self, classes: Sequence[Union[str, int]]) -> 'KITTIObjects':
+        """
+        :param classes: class names or KITTIObjectClass
+        """
+        ids = [KITTIObjectClass[c] if isinstance(c, str) else int(c) for c in classes]
+        return KITTIObjects(self.records[np.isin(self.records['cls'], ids)])
+
+    @staticmethod
+    def from_objects(objects: List[KITTIObject3D]) -> 'KITTIObjects':
+        records = np.array([(int(o.cls),) + tuple(getattr(o, name) for name, _ in _fields[1:]) for o in objects],
+                           dtype=KITTIObjects.dtype)
+        return KITTIObjects(records)
+
+    def to_objects(self) -> List[KITTIObject3D]:
+        return list(self)
+
+    @staticmethod
+    def from_arrays(arrays: dict) -> 'KITTIObjects':
+        """
+        :param arrays: columnar labels, see load_label_2_arrays
+        """
+        dtype = KITTIObjects.dtype_with_score if 'score' in arrays else KITTIObjects.dtype
+        records = np.empty((arrays['cls'].shape[0],), dtype=dtype)
+        for k, v in arrays.items():
+            if k in _columns:
+                for i, name in enumerate(_columns[k]):
+                    records[name] = v[:, i]
+            else:
+                records[k] = v
+        return KITTIObjects(records)
+
+    def to_arrays(self) -> dict:
+        """
+        :return: columnar labels, see load_label_2_arrays
+        """
+        arrays = {}
+        for name in self.records.dtype.names:
+            if name in ('x1', 'h', 'x'):
+                k = {'x1': 'box2d', 'h': 'dims', 'x': 'loc'}[name]
+                arrays[k] = recfunctions.structured_to_unstructured(self.records[_columns[k]])
+            elif not any(name in v for v in _columns.values()):
+                arrays[name] = self.records[name].copy()
+        return arrays
+
+    def to_tensor(self, device='cpu', dtype=torch.float32) -> torch.Tensor:
+        """
+        :return: (N, 15) or (N, 16) with score, columns in the order of the kitti label format, cls as id
+        """
+        values = recfunctions.structured_to_unstructured(self.records, dtype=np.float32)
+        return torch.as_tensor(values, device=device, dtype=dtype)
+
+    @staticmethod
+    def from_tensor(tensor: torch.Tensor) -> 'KITTIObjects':
+        """
+        :param tensor: (N, 15) or (N, 16), see to_tensor
+        """
+        dtype = KITTIObjects.dtype_with_score if tensor.shape[1] == len(_fields) + 1 else KITTIObjects.dtype
+        values = tensor.detach().cpu().numpy().copy()
+        values[:, [0, 2]] = np.round(values[:, [0, 2]])
+        return KITTIObjects(recfunctions.unstructured_to_structured(values, dtype=dtype))
+
+    def to_lines(self) -> str:
+        """
+        :return: content of a kitti label file, scores are written as a 16th column if present
+        """
+        values = recfunctions.structured_to_unstructured(self.records[[name for name, _ in _fields[1:]]],
+                                                         dtype=np.float64)
+        return _format_label_lines(_class_names[self.records['cls']], values,
+                                   self.records['score'] if self.has_score else None)
+
+    @staticmethod
+    def concatenate(objects: Sequence['KITTIObjects']) -> 'KITTIObjects':
+        if len(objects) == 0:
+            return KITTIObjects()
+        return KITTIObjects(np.concatenate([o.records for o in objects]))
@@ -13,5 +13,15 @@ def inverse_rigid_trans(Tr):
     return inv_Tr
 
 
+def compose_affine(A, B):
+    """
+    Compose two [R|t] transforms, the result applies B first, then A.
+    :param A: (M, 4)
+    :param B: (3, 4)
+    :return: (M, 4)
+    """
+    return np.concatenate((A[:, :3] @ B[:, :3], A[:, :3] @ B[:, 3:] + A[:, 3:]), axis=1)
+
+
 def check_type(arr):
     assert isinstance(arr, (np.ndarray, torch.Tensor))
@@ -1,10 +1,13 @@
+import math
 from numbers import Number
 from warnings import warn
 
 import numpy as np
 import torch
 from torch import Tensor
-from multipledispatch import dispatch
+from multipledispatch import Dispatcher
+
+from .rotation import _euler_xyz_entries, euler_xyz_to_matrix, compose_pose
 
 
 def project_K(pts3d, K, pose):
@@ -16,10 +19,9 @@ def project_K(pts3d, K, pose):
     """
     p = pts3d.t()
     n = p.shape[1]
-    p = K @ pose @ torch.cat([p, torch.ones(1, n)])
-    p[0] = p[0] / p[2]
-    p[1] = p[1] / p[2]
-    pts2d = p[0:2]
+    p = K @ pose @ torch.cat([p, p.new_ones(1, n)])
+    # out of place, so that gradients flow to K and pose
+    pts2d = p[0:2] / p[2:3]
     pts2d = pts2d.t()
     return pts2d
 
@@ -34,13 +36,11 @@ def project_P2(pts3d, P2, pose):
     """
     p = pts3d.t()  # 3,n
     n = pts3d.shape[0]
-    p = torch.cat([p, torch.ones(1, n)])
+    p = torch.cat([p, p.new_ones(1, n)])
     p = pose @ p  # 3,14
-    p = torch.cat([p, torch.ones(1, n)])
+    p = torch.cat([p, p.new_ones(1, n)])
     p = P2 @ p  # 3,14
-    p[0] = p[0] / p[2]
-    p[1] = p[1] / p[2]
-    pts2d = p[0:2]
+    pts2d = p[0:2] / p[2:3]
     pts2d = pts2d.t()
     return pts2d
 
@@ -63,8 +63,7 @@ def pts3d_induction(pts3d):
     return pts3d
 
 
-@dispatch((np.ndarray, Tensor), (np.ndarray, Tensor), (np.ndarray, Tensor))
-def project(pts3d, intrinsic_matrix, pose, return_type=torch.Tensor):
+def _project_pose(pts3d, intrinsic_matrix, pose, return_type=torch.Tensor):
     """
     :param pts3d:
     :param intrinsic_matrix:
@@ -73,8 +72,8 @@ def project(pts3d, intrinsic_matrix, pose, return_type=torch.Tensor):
     :return:
     """
     pts3d = torch.as_tensor(pts3d).float()
-    intrinsic_matrix = torch.as_tensor(intrinsic_matrix).float()
-    pose = torch.as_tensor(pose).float()
+    intrinsic_matrix = torch.as_tensor(intrinsic_matrix, device=pts3d.device).float()
+    pose = torch.as_tensor(pose, device=pts3d.device).float()
     pts3d = pts3d_induction(pts3d)
     assert pose.shape == (3, 4), f'pose must have shape (3,4), got {pose.shape}'
     if intrinsic_matrix.shape == (3, 3):
@@ -84,15 +83,14 @@ def project(pts3d, intrinsic_matrix, pose, return_type=torch.Tensor):
     else:
         raise ValueError(f'intrinsic matrix must have shape (3,3) or (3,4), got {intrinsic_matrix.shape}')
     if return_type == torch.Tensor:
-        return torch.Tensor(result)
+        return result
     elif return_type == np.ndarray:
-        return np.array(result)
+        return result.detach().cpu().numpy()
     else:
-        return ValueError(f'return_type must be torch.Tensor or numpy.ndarray, got {return_type}')
+        raise ValueError(f'return_type must be torch.Tensor or numpy.ndarray, got {return_type}')
 
 
-@dispatch((np.ndarray, Tensor), (np.ndarray, Tensor), (np.ndarray, Tensor), (np.ndarray, Tensor))
-def project(pts3d, intrinsic_matrix, R, t, return_type=torch.Tensor):
+def _project_Rt(pts3d, intrinsic_matrix, R, t, return_type=torch.Tensor):
     """
     :param return_type:
     :param pts3d:
@@ -101,33 +99,44 @@ def project(pts3d, intrinsic_matrix, R, t, return_type=torch.Tensor):
     :return:
     """
     R = torch.as_tensor(R).float()
-    t = torch.as_tensor(t).float()
+    t = torch.as_tensor(t, device=R.device).float()
     assert R.shape == (3, 3), f'R.shape {R.shape} != (3,3)'
     if t.shape == (3,):
         t = t.unsqueeze(-1)
     assert t.shape == (3, 1), f't.shape {t.shape} != (3,1) or (3,)'
     pose = torch.cat([R, t], dim=1)
     assert pose.shape == (3, 4)
-    return project(pts3d, intrinsic_matrix, pose, return_type=return_type)
-
-
-@dispatch((np.ndarray, Tensor), (np.ndarray, Tensor), Number, Number, Number, (np.ndarray, Tensor))
-def project(pts3d, intrinsic_matrix, rx, ry, rz, t, return_type=torch.Tensor):
-    Rx = torch.as_tensor(np.array([[1, 0, 0],
-                                   [0, np.cos(rx), -np.sin(rx)],
-                                   [0, np.sin(rx), np.cos(rx)]]))
-    Ry = torch.as_tensor(np.array([[np.cos(ry), 0, np.sin(ry)],
-                                   [0, 1, 0],
-                                   [-np.sin(ry), 0, np.cos(ry)]]))
-    Rz = torch.as_tensor(np.array([[np.cos(rz), -np.sin(rz), 0],
-                                   [np.sin(rz), np.cos(rz), 0],
-                                   [0, 0, 1]]))
-    R = Rx @ Ry @ Rz
-    return project(pts3d, intrinsic_matrix, R, t, return_type=return_type)
-
-
-@dispatch((np.ndarray, Tensor), (np.ndarray, Tensor), Number, Number, Number, Number, Number, Number)
-def project(pts3d, intrinsic_matrix, rx, ry, rz, tx, ty, tz, return_type=torch.Tensor):
+    return _project_pose(pts3d, intrinsic_matrix, pose, return_type=return_type)
+
+
+def _project_euler_t(pts3d, intrinsic_matrix, rx, ry, rz, t, return_type=torch.Tensor):
+    # python floats, one host computation and one allocation, see rotation.euler_xyz_to_matrix for tensors
+    entries = _euler_xyz_entries(math.cos(rx), math.cos(ry), math.cos(rz), math.sin(rx), math.sin(ry), math.sin(rz))
+    R = torch.tensor(entries, dtype=torch.float64, device=t.device if isinstance(t, Tensor) else None).view(3, 3)
+    return _project_Rt(pts3d, intrinsic_matrix, R, t, return_type=return_type)
+
+
+def _project_euler_tensor_t(pts3d, intrinsic_matrix, rx, ry, rz, t, return_type=torch.Tensor):
+    """
+    Tensor angles, differentiable with respect to the angles and t.
+    Angles of shape (B,) with t of shape (B, 3) project the points with B poses at once to (B, N, 2).
+    """
+    R = euler_xyz_to_matrix(torch.stack(torch.broadcast_tensors(rx, ry, rz), dim=-1))
+    if R.dim() == 2:
+        return _project_Rt(pts3d, intrinsic_matrix, R, t, return_type=return_type)
+    pts3d = pts3d_induction(torch.as_tensor(pts3d, device=R.device).float())
+    intrinsic_matrix = torch.as_tensor(intrinsic_matrix, device=R.device).float()
+    pose = compose_pose(R.float(), torch.as_tensor(t, device=R.device).float().reshape(R.shape[:-2] + (3,)))
+    result = project_batch(pts3d.expand(R.shape[:-2] + pts3d.shape), intrinsic_matrix, pose)[0]
+    if return_type == torch.Tensor:
+        return result
+    elif return_type == np.ndarray:
+        return result.detach().cpu().numpy()
+    else:
+        raise ValueError(f'return_type must be torch.Tensor or numpy.ndarray, got {return_type}')
+
+
+def _project_euler(pts3d, intrinsic_matrix, rx, ry, rz, tx, ty, tz, return_type=torch.Tensor):
     """
     :param return_type:
     :param pts3d:
@@ -135,4 +144,47 @@ def project(pts3d, intrinsic_matrix, rx, ry, rz, tx, ty, tz, return_type=torch.T
     :param pose:
     :return:
     """
-    return project(pts3d, intrinsic_matrix, rx, ry, rz, torch.Tensor([[tx, ty, tz]]).t(), return_type=return_type)
+    return _project_euler_t(pts3d, intrinsic_matrix, rx, ry, rz, torch.tensor([[tx], [ty], [tz]]),
+                            return_type=return_type)
+
+
+# the overloads call each other directly, a call is resolved once by the dispatcher (which caches the resolution
+# per argument types) instead of once per overload in the chain
+_array = (np.ndarray, Tensor)
+project = Dispatcher('project')
+project.add((_array, _array, _array), _project_pose)
+project.add((_array, _array, _array, _array), _project_Rt)
+project.add((_array, _array, Number, Number, Number, _array), _project_euler_t)
+project.add((_array, _array, Tensor, Tensor, Tensor, _array), _project_euler_tensor_t)
+project.add((_array, _array, Number, Number, Number, Number, Number, Number), _project_euler)
+
+
+def project_batch(pts3d, intrinsic_matrix, pose, image_size=None):
+    """
+    Project B point sets with their own camera, on the device and in the dtype of the inputs, numpy or torch.
+    The projection matrix is composed once per camera and applied to all points in one matmul.
+    :param pts3d: (B, N, 3)
+    :param intrinsic_matrix: (B, 3, 3) K, or (B, 3, 4) P2 applied after pose as in project, or unbatched
+    :param pose: (B, 3, 4) world to camera, e.g. rotation.compose_pose(rotation.euler_xyz_to_matrix(angles), t)
+                 for many pose hypotheses at once, differentiable with respect to angles and t
+    :param image_size: width, height, if given points projecting outside the image are not visible
+    :return: pts2d (B, N, 2), depth (B, N) z in the camera, visible (B, N) bool, in front of the camera and
+             in the image if image_size is given
+    """
+    if intrinsic_matrix.shape[-1] == 3:
+        P = intrinsic_matrix @ pose
+    elif intrinsic_matrix.shape[-1] == 4:
+        P = intrinsic_matrix[..., :3] @ pose
+        P[..., 3] += intrinsic_matrix[..., 3]
+    else:
+        raise ValueError(f'intrinsic matrix must have shape (B,3,3) or (B,3,4), got {intrinsic_matrix.shape}')
+    p = pts3d @ P[..., :3].swapaxes(-1, -2) + P[..., None, :, 3]
+    depth = pts3d @ pose[..., 2, :3, None]
+    depth = depth[..., 0] + pose[..., 2, None, 3]
+    pts2d = p[..., :2] / p[..., 2:]
+    visible = p[..., 2] > 0
+    if image_size is not None:
+        width, height = image_size
+        u, v = pts2d[..., 0], pts2d[..., 1]
+        visible = visible & (u >= 0) & (u < width) & (v >= 0) & (v < height)
+    return pts2d, depth, visible
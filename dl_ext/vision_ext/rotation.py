@@ -0,0 +1,93 @@
+"""
+Batched, differentiable rotation matrices from several parametrizations, computed on the device of the input.
+All functions take (..., k) parameters and return (..., 3, 3).
+Example:
+    >>> angles = torch.zeros(256, 3, device='cuda', requires_grad=True)
+    >>> t = torch.zeros(256, 3, device='cuda', requires_grad=True)
+    >>> pts2d, depth, visible = project_batch(pts3d, K, compose_pose(euler_xyz_to_matrix(angles), t))
+"""
+import torch
+from torch import Tensor
+
+
+def _as_float_tensor(x):
+    if isinstance(x, Tensor):
+        return x if x.is_floating_point() else x.float()
+    return torch.as_tensor(x, dtype=torch.get_default_dtype())
+
+
+def _euler_xyz_entries(cx, cy, cz, sx, sy, sz):
+    """
+    Row-major entries of Rx @ Ry @ Rz from the cosines and sines of the angles, floats or tensors.
+    """
+    return (cy * cz, -cy * sz, sy,
+            sx * sy * cz + cx * sz, -sx * sy * sz + cx * cz, -sx * cy,
+            -cx * sy * cz + sx * sz, cx * sy * sz + sx * cz, cx * cy)
+
+
+def euler_xyz_to_matrix(angles) -> Tensor:
+    """
+    :param angles: (..., 3) rx, ry, rz in radians
+    :return: Rx @ Ry @ Rz, as in project(pts3d, K, rx, ry, rz, t)
+    """
+    angles = _as_float_tensor(angles)
+    c, s = torch.cos(angles), torch.sin(angles)
+    R = torch.stack(_euler_xyz_entries(*c.unbind(-1), *s.unbind(-1)), dim=-1)
+    return R.view(angles.shape[:-1] + (3, 3))
+
+
+def _skew(v):
+    x, y, z = v.unbind(-1)
+    zero = torch.zeros_like(x)
+    return torch.stack((zero, -z, y, z, zero, -x, -y, x, zero), dim=-1).view(v.shape[:-1] + (3, 3))
+
+
+def axis_angle_to_matrix(axis_angle, eps=1e-6) -> Tensor:
+    """
+    Rodrigues' formula, with series expansions below eps so that gradients at the identity are finite.
+    :param axis_angle: (..., 3) rotation axis scaled by the angle in radians
+    """
+    axis_angle = _as_float_tensor(axis_angle)
+    theta2 = (axis_angle * axis_angle).sum(-1)
+    small = theta2 < eps
+    theta = torch.sqrt(torch.where(small, torch.ones_like(theta2), theta2))
+    a = torch.where(small, 1 - theta2 / 6, torch.sin(theta) / theta)  # sin(t) / t
+    b = torch.where(small, 0.5 - theta2 / 24, (1 - torch.cos(theta)) / (theta * theta))  # (1 - cos(t)) / t^2
+    K = _skew(axis_angle)
+    eye = torch.eye(3, dtype=axis_angle.dtype, device=axis_angle.device)
+    return eye + a[..., None, None] * K + b[..., None, None] * (K @ K)
+
+
+def quaternion_to_matrix(quaternion) -> Tensor:
+    """
+    :param quaternion: (..., 4) w, x, y, z, normalized here
+    """
+    quaternion = _as_float_tensor(quaternion)
+    w, x, y, z = (quaternion / quaternion.norm(dim=-1, keepdim=True)).unbind(-1)
+    R = torch.stack((1 - 2 * (y * y + z * z), 2 * (x * y - w * z), 2 * (x * z + w * y),
+                     2 * (x * y + w * z), 1 - 2 * (x * x + z * z), 2 * (y * z - w * x),
+                     2 * (x * z - w * y), 2 * (y * z + w * x), 1 - 2 * (x * x + y * y)), dim=-1)
+    return R.view(quaternion.shape[:-1] + (3, 3))
+
+
+def rotation_6d_to_matrix(d6) -> Tensor:
+    """
+    The continuous 6D representation of Zhou et al., CVPR 2019, orthonormalized by Gram-Schmidt.
+    :param d6: (..., 6) first two rows of the matrix
+    """
+    d6 = _as_float_tensor(d6)
+    a1, a2 = d6[..., :3], d6[..., 3:]
+    b1 = torch.nn.functional.normalize(a1, dim=-1)
+    b2 = torch.nn.functional.normalize(a2 - (b1 * a2).sum(-1, keepdim=True) * b1, dim=-1)
+    b3 = torch.cross(b1, b2, dim=-1)
+    return torch.stack((b1, b2, b3), dim=-2)
+
+
+def compose_pose(R: Tensor, t) -> Tensor:
+    """
+    :param R: (..., 3, 3)
+    :param t: (..., 3)
+    :return: (..., 3, 4) [R | t]
+    """
+    t = torch.as_tensor(t, dtype=R.dtype, device=R.device)
+    return torch.cat((R, t[..., None].expand(R.shape[:-2] + (3, 1))), dim=-1)
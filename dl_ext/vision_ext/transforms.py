@@ -1,3 +1,4 @@
+import torch
 from torch import Tensor
 from torchvision import transforms
 import numpy as np
@@ -6,6 +7,28 @@ imagenet_normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
                                           std=[0.229, 0.224, 0.225])
 
 
+def normalize_uint8(images: Tensor, mean, std, dtype=torch.float32):
+    """
+    (images / 255 - mean) / std of uint8 images in one conversion and two in-place ops,
+    meant to run on the GPU on a whole batch instead of ToTensor and Normalize per image on the CPU.
+    :param images: uint8 [b,c,h,w] or [c,h,w]
+    :param mean: c values, for images in [0, 1]
+    :param std: c values, for images in [0, 1]
+    :param dtype:
+    :return: dtype tensor on the device of images
+    """
+    mean = torch.as_tensor(mean, dtype=dtype, device=images.device).view(-1, 1, 1) * 255
+    std = torch.as_tensor(std, dtype=dtype, device=images.device).view(-1, 1, 1) * 255
+    return images.to(dtype).sub_(mean).div_(std)
+
+
+def imagenet_normalize_uint8(images: Tensor, dtype=torch.float32):
+    """
+    imagenet_normalize(ToTensor()(img)) of a batch of uint8 images, see normalize_uint8.
+    """
+    return normalize_uint8(images, [0.485, 0.456, 0.406], [0.229, 0.224, 0.225], dtype)
+
+
 def imagnet_revert_normalize(rgb):
     '''
 
@@ -0,0 +1,217 @@
+"""
+Voxelization and BEV rasterization of point clouds, e.g. from load_velodyne or Calibration.lidar_to_rect,
+for numpy arrays and torch tensors (on any device).
+A batch is given as a list of (N_i, C) point sets, results then carry a batch index.
+Example:
+    >>> voxels, coords, num_points = voxelize(pts_lidar, (0.05, 0.05, 0.1), (0, -40, -3, 70.4, 40, 1))
+    >>> maps = bev_maps([pts_lidar1, pts_lidar2], (0, -40, -2, 70.4, 40, 1.25), 0.1, num_slices=5)
+"""
+import math
+from typing import Sequence, Union
+
+import numpy as np
+import torch
+
+
+def _concat_batch(points):
+    """
+    :return: (N, C) points, (N,) batch index or None, batch size
+    """
+    if not isinstance(points, (list, tuple)):
+        return points, None, 1
+    if isinstance(points[0], np.ndarray):
+        b = np.repeat(np.arange(len(points)), [p.shape[0] for p in points])
+        return np.concatenate(points, axis=0), b, len(points)
+    b = torch.repeat_interleave(torch.arange(len(points), device=points[0].device),
+                                torch.tensor([p.shape[0] for p in points], device=points[0].device))
+    return torch.cat(points, dim=0), b, len(points)
+
+
+def _is_cpu_tensor(points):
+    p = points[0] if isinstance(points, (list, tuple)) else points
+    return isinstance(p, torch.Tensor) and p.device.type == 'cpu'
+
+
+def _to_numpy(points):
+    if isinstance(points, (list, tuple)):
+        return [p.detach().numpy() for p in points]
+    return points.detach().numpy()
+
+
+def _grid_size(voxel_size, point_range):
+    point_range = np.asarray(point_range, dtype=np.float64)
+    return np.round((point_range[3:] - point_range[:3]) / np.asarray(voxel_size, dtype=np.float64)).astype(np.int64)
+
+
+def voxelize(points: Union[np.ndarray, torch.Tensor, Sequence], voxel_size: Sequence[float],
+             point_range: Sequence[float], max_points=32, max_voxels: int = None):
+    """
+    Group points by voxel: one sort of the linear voxel index instead of a hash table, voxels are ordered by
+    (batch, z, y, x) and the points of a voxel keep their input order, so the result is deterministic.
+    :param points: (N, C) with xyz in the first 3 columns, or a list of them for a batch
+    :param voxel_size: x, y, z
+    :param point_range: xmin, ymin, zmin, xmax, ymax, zmax, points outside are dropped
+    :param max_points: points of a voxel beyond the first max_points are dropped
+    :param max_voxels: voxels beyond the first max_voxels (in the above order) are dropped
+    :return: voxels (V, max_points, C) zero padded, coords (V, 3) int32 z, y, x or (V, 4) batch, z, y, x,
+             num_points (V,) int32
+    """
+    if _is_cpu_tensor(points):
+        # the numpy implementation is faster on cpu
+        return tuple(torch.from_numpy(x) for x in
+                     _voxelize(_to_numpy(points), voxel_size, point_range, max_points, max_voxels))
+    return _voxelize(points, voxel_size, point_range, max_points, max_voxels)
+
+
+def _voxelize(points, voxel_size, point_range, max_points, max_voxels):
+    points, b, _ = _concat_batch(points)
+    gx, gy, gz = _grid_size(voxel_size, point_range).tolist()
+    if isinstance(points, np.ndarray):
+        # per column on contiguous temporaries, truncation equals floor once negative values are dropped
+        x, y, z = ((points[:, i] - point_range[i]) / voxel_size[i] for i in range(3))
+        idx = np.flatnonzero((x >= 0) & (x < gx) & (y >= 0) & (y < gy) & (z >= 0) & (z < gz))
+        index = (z[idx].astype(np.int64) * gy + y[idx].astype(np.int64)) * gx + x[idx].astype(np.int64)
+        if b is not None:
+            index += b[idx] * (gz * gy * gx)
+        n = idx.shape[0]
+        if n > 0 and int(index.max()) < np.iinfo(np.int64).max // n:
+            # (index, position) packed in one int64, an unstable sort of the keys is a stable sort of index
+            key = index * n + np.arange(n)
+            key.sort()
+            order, index = key % n, key // n
+        else:
+            order = np.argsort(index, kind='stable')
+            index = index[order]
+        first = np.ones((n,), dtype=bool)
+        first[1:] = index[1:] != index[:-1]
+        starts = np.nonzero(first)[0]
+        voxel = np.cumsum(first) - 1
+        rank = np.arange(n) - starts[voxel]
+        num_points = np.diff(np.append(starts, n))
+        num_voxels = starts.shape[0] if max_voxels is None else min(starts.shape[0], max_voxels)
+        sel = (rank < max_points) & (voxel < num_voxels)
+        voxels = np.zeros((num_voxels, max_points, points.shape[1]), dtype=points.dtype)
+        voxels.reshape(-1, points.shape[1])[voxel[sel] * max_points + rank[sel]] = points[idx[order[sel]]]
+        index = index[starts[:num_voxels]]
+        coords = np.stack((index // (gx * gy) % gz, index // gx % gy, index % gx), axis=1)
+        if b is not None:
+            coords = np.concatenate(((index // (gz * gy * gx))[:, None], coords), axis=1)
+        return voxels, coords.astype(np.int32), np.minimum(num_points[:num_voxels], max_points).astype(np.int32)
+    x, y, z = ((points[:, i] - point_range[i]) / voxel_size[i] for i in range(3))
+    idx = torch.nonzero((x >= 0) & (x < gx) & (y >= 0) & (y < gy) & (z >= 0) & (z < gz))[:, 0]
+    index = (z[idx].long() * gy + y[idx].long()) * gx + x[idx].long()
+    if b is not None:
+        index += b[idx] * (gz * gy * gx)
+    n = idx.shape[0]
+    if n > 0 and int(index.max()) < torch.iinfo(torch.int64).max // n:
+        key, _ = torch.sort(index * n + torch.arange(n, device=points.device))
+        order, index = key % n, key // n
+    else:
+        index, order = torch.sort(index, stable=True)
+    first = torch.ones((n,), dtype=torch.bool, device=points.device)
+    first[1:] = index[1:] != index[:-1]
+    starts = torch.nonzero(first)[:, 0]
+    voxel = torch.cumsum(first, 0) - 1
+    rank = torch.arange(n, device=points.device) - starts[voxel]
+    num_points = torch.diff(starts, append=starts.new_tensor([n]))
+    num_voxels = starts.shape[0] if max_voxels is None else min(starts.shape[0], max_voxels)
+    sel = (rank < max_points) & (voxel < num_voxels)
+    voxels = points.new_zeros((num_voxels, max_points, points.shape[1]))
+    voxels.view(-1, points.shape[1])[voxel[sel] * max_points + rank[sel]] = points[idx[order[sel]]]
+    index = index[starts[:num_voxels]]
+    coords = torch.stack((index // (gx * gy) % gz, index // gx % gy, index % gx), dim=1)
+    if b is not None:
+        coords = torch.cat(((index // (gz * gy * gx))[:, None], coords), dim=1)
+    return voxels, coords.int(), num_points[:num_voxels].clamp(max=max_points).int()
+
+
+# forward, lateral and up axis and the sign of up
+_bev_frames = {'lidar': (0, 1, 2, 1), 'rect': (2, 0, 1, -1)}
+
+
+def bev_maps(points: Union[np.ndarray, torch.Tensor, Sequence], point_range: Sequence[float], resolution: float,
+             num_slices=1, frame='lidar'):
+    """
+    Rasterize points into bird's eye view maps, channels are
+        num_slices maps of the max height above the floor of the range in each height slice, 0 if empty,
+        the intensity of the highest point,
+        the density min(1, log(n + 1) / log(64)) of the n points in a cell.
+    Rows index the forward axis (x in lidar, z in rect) and columns the lateral axis (y in lidar, x in rect).
+    :param points: (N, 4) x, y, z, intensity, or a list of them for a batch
+    :param point_range: xmin, ymin, zmin, xmax, ymax, zmax in the frame of the points, points outside are dropped
+    :param resolution: cell size in meters
+    :param num_slices: number of height slices
+    :param frame: lidar (x forward, z up) or rect (z forward, y down)
+    :return: (num_slices + 2, H, W), or (B, num_slices + 2, H, W) for a batch, in the dtype of points
+    """
+    if _is_cpu_tensor(points):
+        return torch.from_numpy(_bev_maps(_to_numpy(points), point_range, resolution, num_slices, frame))
+    return _bev_maps(points, point_range, resolution, num_slices, frame)
+
+
+def _bev_maps(points, point_range, resolution, num_slices, frame):
+    points, b, batch_size = _concat_batch(points)
+    batched = b is not None
+    assert points.shape[1] >= 4, 'points need an intensity column'
+    forward, lateral, up, sign = _bev_frames[frame]
+    H = int(round((point_range[forward + 3] - point_range[forward]) / resolution))
+    W = int(round((point_range[lateral + 3] - point_range[lateral]) / resolution))
+    floor, ceil = (point_range[up], point_range[up + 3]) if sign > 0 else (-point_range[up + 3], -point_range[up])
+    slice_height = (ceil - floor) / num_slices
+    C = num_slices + 2
+    if isinstance(points, np.ndarray):
+        r = (points[:, forward] - point_range[forward]) / resolution
+        c = (points[:, lateral] - point_range[lateral]) / resolution
+        height = sign * points[:, up] - floor
+        keep = np.flatnonzero((r >= 0) & (r < H) & (c >= 0) & (c < W) & (height >= 0) & (height < ceil - floor))
+        height, intensity = height[keep], points[keep, 3]
+        pixel = r[keep].astype(np.int64) * W + c[keep].astype(np.int64)
+        channel = np.minimum((height / slice_height).astype(np.int64), num_slices - 1)
+        cell = pixel
+        if b is not None:
+            b = b[keep]
+            cell = pixel + b * (H * W)
+            channel += b * C
+        # flat indices, ufunc.at is much slower with tuple indices
+        maps = np.zeros((batch_size * C * H * W,), dtype=points.dtype)
+        np.maximum.at(maps, channel * (H * W) + pixel, height)
+        top = np.full((batch_size * H * W,), -np.inf, dtype=points.dtype)
+        np.maximum.at(top, cell, height)
+        is_top = np.flatnonzero(height == top[cell])
+        cell_top = cell[is_top]
+        np.maximum.at(maps, (cell_top // (H * W) * C + num_slices) * (H * W) + cell_top % (H * W), intensity[is_top])
+        # counts of the occupied cells only, by sorting the points rather than counting over the whole map
+        cell = np.sort(cell)
+        first = np.ones((cell.shape[0],), dtype=bool)
+        first[1:] = cell[1:] != cell[:-1]
+        starts = np.flatnonzero(first)
+        count = np.diff(np.append(starts, cell.shape[0]))
+        cell = cell[starts]
+        maps[(cell // (H * W) * C + C - 1) * (H * W) + cell % (H * W)] = np.minimum(1, np.log1p(count) / math.log(64))
+        maps = maps.reshape(batch_size, C, H, W)
+        return maps if batched else maps[0]
+    r = (points[:, forward] - point_range[forward]) / resolution
+    c = (points[:, lateral] - point_range[lateral]) / resolution
+    height = sign * points[:, up] - floor
+    keep = torch.nonzero((r >= 0) & (r < H) & (c >= 0) & (c < W) & (height >= 0) & (height < ceil - floor))[:, 0]
+    height, intensity = height[keep], points[keep, 3]
+    pixel = r[keep].long() * W + c[keep].long()
+    channel = torch.clamp((height / slice_height).long(), max=num_slices - 1)
+    cell = pixel
+    if b is not None:
+        b = b[keep]
+        cell = pixel + b * (H * W)
+        channel += b * C
+    maps = points.new_zeros((batch_size * C * H * W,))
+    maps.scatter_reduce_(0, channel * (H * W) + pixel, height, 'amax')
+    top = points.new_full((batch_size * H * W,), -math.inf)
+    top.scatter_reduce_(0, cell, height, 'amax')
+    is_top = torch.nonzero(height == top[cell])[:, 0]
+    cell_top = cell[is_top]
+    maps.scatter_reduce_(0, (cell_top // (H * W) * C + num_slices) * (H * W) + cell_top % (H * W),
+                         intensity[is_top], 'amax')
+    cell, count = torch.unique(cell, return_counts=True)
+    maps[(cell // (H * W) * C + C - 1) * (H * W) + cell % (H * W)] = \
+        torch.clamp(torch.log1p(count.to(points.dtype)) / math.log(64), max=1)
+    maps = maps.view(batch_size, C, H, W)
+    return maps if batched else maps[0]
@@ -0,0 +1,20 @@
+import json
+import os
+
+import numpy as np
+
+from dl_ext.vision_ext.datasets.kitti.eval import evaluate, format_results
+
+# 30 synthetic frames with easy objects of every class, DontCare boxes and noisy scored predictions
+# (no prediction file for frame 7), expected R40 APs computed by a line by line port of the devkit statistics
+# (DontCare boxes suppress false positives for every metric, as in evaluate_object.cpp)
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'kitti_eval')
+with open(os.path.join(ROOT, 'expected_r40.json')) as f:
+    expected = json.load(f)
+for num_workers in (0, 2):
+    results = evaluate(ROOT, 'training', os.path.join(ROOT, 'pred'), num_workers=num_workers)
+    print(format_results(results))
+    for cls, aps in expected.items():
+        for metric, ap in aps.items():
+            np.testing.assert_allclose(results[cls][metric], ap, atol=1e-4, err_msg=f'{cls} {metric}')
+print('ok')
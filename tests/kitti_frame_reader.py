@@ -0,0 +1,9 @@
+from tqdm import tqdm
+
+from dl_ext.vision_ext.datasets.kitti.io import KITTIFrameReader
+
+reader = KITTIFrameReader('/home/linghao/Datasets/kitti', 'training', range(7481),
+                          ('image_2', 'calib', 'label_2', 'velodyne'), prefetch=16, num_workers=8)
+for frame in tqdm(reader):
+    pass
+print(reader.stats)
@@ -0,0 +1,7 @@
+from dl_ext.vision_ext.datasets.kitti.io import *
+
+KITTIROOT = '/home/linghao/Datasets/kitti'
+print(pack_split(KITTIROOT, 'training'))
+calib = load_calib(KITTIROOT, 'training', 3)
+print(calib.P2, calib.size)
+print(load_label_2(KITTIROOT, 'training', 3))
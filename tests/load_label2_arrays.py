@@ -0,0 +1,6 @@
+from dl_ext.vision_ext.datasets.kitti.io import load_label_2_arrays, load_labels_2_arrays
+
+a = load_label_2_arrays('/home/linghao/Datasets/kitti', 'training', 4, ['Car'])
+print(a['cls'], a['box2d'].shape)
+arrays, offsets = load_labels_2_arrays('/home/linghao/Datasets/kitti', 'training', range(7481))
+print(arrays['dims'].shape, offsets[-1])
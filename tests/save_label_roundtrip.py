@@ -0,0 +1,28 @@
+import os
+import tempfile
+
+import numpy as np
+
+from dl_ext.vision_ext.datasets.kitti.io import load_label_2_arrays
+from dl_ext.vision_ext.datasets.kitti.io.save_label import save_label
+
+# non quantized predictions are read back unchanged
+rng = np.random.default_rng(0)
+n = 100
+objects = {'cls': rng.integers(1, 9, n).astype(np.int8),
+           'truncated': rng.random(n).astype(np.float32),
+           'occluded': rng.integers(0, 4, n).astype(np.int8),
+           'alpha': rng.uniform(-np.pi, np.pi, n).astype(np.float32),
+           'box2d': rng.uniform(0, 1242, (n, 4)).astype(np.float32),
+           'dims': rng.uniform(0.5, 5, (n, 3)).astype(np.float32),
+           'loc': rng.normal(0, 20, (n, 3)).astype(np.float32),
+           'ry': rng.uniform(-np.pi, np.pi, n).astype(np.float32),
+           'score': rng.random(n).astype(np.float32) * 1e-3}
+with tempfile.TemporaryDirectory() as root:
+    label_dir = os.path.join(root, 'object', 'training', 'label_2')
+    os.makedirs(label_dir)
+    save_label(label_dir, 0, objects)
+    loaded = load_label_2_arrays(root, 'training', 0)
+for k, v in objects.items():
+    assert loaded[k].dtype == v.dtype and np.array_equal(loaded[k], v), k
+print('ok')